@@ -1,9 +1,67 @@
 '''
     Loggerの切り替えを簡単にするためのユーティリティ
 
+    レベルは環境変数 SORACOM_LOG_LEVEL（debug/info/warning/error）があればそちらを優先する。
+    SORACOM_LOG_ASYNC=1 またはstartQueueListener()で、ログの書き出しを別スレッドに任せる（QueueHandler/QueueListener）。
+    リクエストのループでstderrへの書き込みを待たなくてよくなる。
+
+    ライブラリとして使う時（SoraCamClientなど）はsetLibraryMode()、またはimportする前に環境変数 SORACOM_LOG_LIBRARY=1 にする。
+    各モジュールのロガーに画面出力を付けず、レベルも呼び出し側のロギングの設定に任せる。
+
 '''
 import os, re, sys
-from logging import getLogger, Formatter, FileHandler, StreamHandler, DEBUG, INFO
+import queue
+import atexit
+import threading
+from logging import getLogger, Formatter, FileHandler, StreamHandler, NOTSET, DEBUG, INFO, WARNING, ERROR
+from logging.handlers import QueueHandler, QueueListener
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+# 環境変数でのレベル指定（指定があれば引数のlevelより優先）
+ENV_LOG_LEVEL = 'SORACOM_LOG_LEVEL'
+ENV_LOG_ASYNC = 'SORACOM_LOG_ASYNC'
+ENV_LOG_LIBRARY = 'SORACOM_LOG_LIBRARY'
+
+_LOCK = threading.RLock()
+_LOGGERS = list()       # このモジュールで設定したLogger
+_QUEUE = None
+_LISTENER = None
+_LIBRARY = os.environ.get(ENV_LOG_LIBRARY, '') == '1'
+
+
+def _level(LOGGER, level):
+    _lv = os.environ.get(ENV_LOG_LEVEL, '').lower() or level
+    if _lv not in LEVELS:
+        LOGGER.error('in setLogger : LEVEL must be debug/info/warning/error. set to debug.')
+        _lv = 'debug'
+
+    return LEVELS[_lv]
+
+
+# このモジュールで付けたハンドラーを外す（2回呼ばれても同じ出力が2重にならないように）
+def _removeHandlers(LOGGER):
+    for _h in list(LOGGER.handlers):
+        if getattr(_h, '_log_utils', False):
+            LOGGER.removeHandler(_h)
+            if isinstance(_h, FileHandler):
+                _h.close()
+
+
+def _addHandler(LOGGER, handler, formatter):
+    handler.setFormatter(formatter)
+    handler._log_utils = True
+    if _QUEUE is not None and type(handler) is StreamHandler:
+        # 非同期モード：画面出力はQueueListenerのスレッドで行う
+        LOGGER.addHandler(_TargetQueueHandler(_QUEUE, handler))
+    else:
+        LOGGER.addHandler(handler)
+
+
+def _register(LOGGER):
+    with _LOCK:
+        if LOGGER not in _LOGGERS:
+            _LOGGERS.append(LOGGER)
 
 '''
     Screen出力のロガー
@@ -11,16 +69,24 @@ from logging import getLogger, Formatter, FileHandler, StreamHandler, DEBUG, INF
 def setScreenLogger(LOGGER, LOG_FMT, level):
     formatter = Formatter(LOG_FMT)
 
-    LOGGER.setLevel(DEBUG)
-    if level == 'info':
-        LOGGER.setLevel(INFO)
+    with _LOCK:
+        if _LIBRARY:
+            # ライブラリモード：ハンドラーを付けず、呼び出し側の設定（rootロガーなど）に任せる
+            LOGGER.setLevel(NOTSET)
+            _register(LOGGER)
+            return LOGGER
 
-    if level != 'debug' and level != 'info':
-        LOGGER.error('in setLogger : LEVEL must be debug/info. set to debug.')
+    LOGGER.setLevel(_level(LOGGER, level))
 
-    sh = StreamHandler()
-    sh.setFormatter(formatter)
-    LOGGER.addHandler(sh)
+    with _LOCK:
+        _removeHandlers(LOGGER)
+        sh = StreamHandler()
+        _addHandler(LOGGER, sh, formatter)
+        _register(LOGGER)
+
+    # SORACOM_LOG_ASYNC=1 の時は最初に設定したロガーから非同期モードにする
+    if _LISTENER is None and not _LIBRARY and os.environ.get(ENV_LOG_ASYNC, '') == '1':
+        startQueueListener()
 
     return LOGGER
 
@@ -30,30 +96,135 @@ def setScreenLogger(LOGGER, LOG_FMT, level):
 def setFileLogger(LOGGER, LOG_FMT, level, filepath, screen=False):
     formatter = Formatter(LOG_FMT)
 
-    LOGGER.setLevel(DEBUG)
-    if level == 'info':
-        LOGGER.setLevel(INFO)
+    LOGGER.setLevel(_level(LOGGER, level))
 
-    if level != 'debug' and level != 'info':
-        LOGGER.error('in setLogger : LEVEL must be debug/info. set to debug.')
-
-    if len(filepath) == 0:
-        sh = StreamHandler()
-        sh.setFormatter(formatter)
-        LOGGER.addHandler(sh)
-        LOGGER.error('in setLogger : FILEPATH must be set when file handler is selected. set to stream.')
-    else:
-        fh = FileHandler(filepath)
-        fh.setFormatter(formatter)
-        LOGGER.addHandler(fh)
-        if screen:
+    with _LOCK:
+        _removeHandlers(LOGGER)
+        if len(filepath) == 0:
             sh = StreamHandler()
-            sh.setFormatter(formatter)
-            LOGGER.addHandler(sh)
+            _addHandler(LOGGER, sh, formatter)
+            LOGGER.error('in setLogger : FILEPATH must be set when file handler is selected. set to stream.')
+        else:
+            fh = FileHandler(filepath)
+            _addHandler(LOGGER, fh, formatter)
+            if screen:
+                sh = StreamHandler()
+                _addHandler(LOGGER, sh, formatter)
+        _register(LOGGER)
 
 
     return LOGGER
 
+'''
+    設定済みの全ロガーのレベルを変える（コマンドラインの--log-levelなど）
+'''
+def setLevel(level):
+    if level not in LEVELS:
+        raise ValueError('LEVEL must be debug/info/warning/error. {}'.format(level))
+
+    with _LOCK:
+        for _lg in _LOGGERS:
+            _lg.setLevel(LEVELS[level])
+
+    return None
+
+'''
+    ライブラリモードにする（元には戻さない）
+
+    設定済みの全ロガーから、このモジュールで付けた画面出力を外し、レベルをNOTSETにする。
+    ログはpropagateで呼び出し側のロガー（root）に渡るので、出し先とレベルは呼び出し側で設定する。
+    以後にsetScreenLoggerしたロガーもハンドラーを付けない。
+
+'''
+def setLibraryMode():
+    global _LIBRARY
+
+    stopQueueListener()
+    with _LOCK:
+        _LIBRARY = True
+        for _lg in _LOGGERS:
+            for _h in list(_lg.handlers):
+                if getattr(_h, '_log_utils', False) and not isinstance(_h, FileHandler):
+                    _lg.removeHandler(_h)
+            _lg.setLevel(NOTSET)
+
+    return None
+
+'''
+    画面出力を別スレッド（QueueListener）に任せる
+
+    設定済みの全ロガーの画面出力をQueueHandlerに付け替える。以後に設定したロガーも同じキューを使う。
+    キューに残ったログは終了時に書き出す。
+
+'''
+def startQueueListener():
+    global _QUEUE, _LISTENER
+
+    with _LOCK:
+        if _LISTENER is not None:
+            return _LISTENER
+
+        _QUEUE = queue.SimpleQueue()
+        for _lg in _LOGGERS:
+            for _h in list(_lg.handlers):
+                if getattr(_h, '_log_utils', False) and type(_h) is StreamHandler:
+                    _lg.removeHandler(_h)
+                    _lg.addHandler(_TargetQueueHandler(_QUEUE, _h))
+
+        _LISTENER = _TargetQueueListener(_QUEUE)
+        _LISTENER.start()
+        atexit.register(stopQueueListener)
+
+    return _LISTENER
+
+'''
+    QueueListenerを止めて（キューに残ったログは書き出す）、画面出力を元に戻す
+'''
+def stopQueueListener():
+    global _QUEUE, _LISTENER
+
+    with _LOCK:
+        if _LISTENER is None:
+            return None
+
+        _LISTENER.stop()
+        for _lg in _LOGGERS:
+            for _h in list(_lg.handlers):
+                if isinstance(_h, _TargetQueueHandler):
+                    _lg.removeHandler(_h)
+                    _lg.addHandler(_h.target)
+        _QUEUE = None
+        _LISTENER = None
+
+    return None
+
+
+# 呼び出し側ではメッセージの組み立て（%の展開）だけ行い、元のハンドラーを付けてキューに入れる
+# 同じプロセス内のキューなので、recordの複製や例外情報の文字列化はしない
+class _TargetQueueHandler(QueueHandler):
+    def __init__(self, q, target):
+        super().__init__(q)
+        self.target = target
+        self._log_utils = True
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        record.log_utils_target = self.target
+
+        return record
+
+
+# キューから取り出したログを、元のハンドラー（フォーマット）で書き出す
+class _TargetQueueListener(QueueListener):
+    def __init__(self, q):
+        super().__init__(q)
+
+    def handle(self, record):
+        _h = getattr(record, 'log_utils_target', None)
+        if _h is not None and record.levelno >= _h.level:
+            _h.handle(record)
+
 
 '''
 	main
@@ -0,0 +1,467 @@
+'''
+    性能測定用のスクリプト
+
+    ローカルに立てたSORACOM APIの代役サーバーに対してリクエストを投げ、処理速度を測る。
+    ソラカメの実機やSORACOMのAPIキーは不要。
+
+    引数：   target : 測定対象
+                transport : urlopen（毎回接続）と SH.request（keep-alive接続プール）の requests/sec 比較
+                tracker : エクスポート進捗の突き合わせ（list.remove / in list と SE.ExportTracker）のポーリング1回あたりの時間
+                e2e : downloadEventImages（イベント取得 → エクスポート → 進捗待ち → ダウンロード）の所要時間
+                planner : 長い期間をサブ秒間隔で計画する時の、時刻の並びの作成時間とメモリ（list vs SP.gridTimes）
+                records : 合成したイベントを保持する時のメモリと、変換・項目の読み出しの時間（dict vs SRC.Event）
+            requests : リクエスト数
+            ids : tracker で追跡するexportIdの数
+            tls : 自己署名証明書でHTTPSサーバーを立てる（opensslコマンドが必要）
+            events : e2e のイベント数（カンマ区切りで複数）
+            intervals : e2e の静止画の抽出間隔（sec。カンマ区切りで複数）
+            latency, export-delay, error-rate : 代役サーバー（mock_soracom_server.py）の設定
+            concurrency, download-workers, pipeline : export_sample.py と同じ
+            days, windows, step : planner の期間（日）、区間の数、抽出間隔（ミリ秒）
+            records : records のイベント数
+
+    （例）
+        python benchmark.py transport --requests 2000 --tls
+        python benchmark.py e2e --events 1,5,10 --intervals 5,30 --latency 0.05 --concurrency 8 --pipeline
+        python benchmark.py planner --days 3 --windows 500 --step 500
+        python benchmark.py records --records 100000
+
+'''
+import sys, os
+import json
+import time
+import ssl
+import shutil, subprocess, tempfile
+import argparse
+import copy, uuid
+import random
+import logging
+import tracemalloc
+import urllib.request
+
+from logging import getLogger
+from datetime import datetime, timedelta
+
+import LogUtils as LU
+import soracom_http as SH
+import soracom_exports as SE
+import soracom_planner as SP
+import soracom_records as SRC
+from mock_soracom_server import MockSoracomServer
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'info')
+
+
+'''
+    自己署名証明書を作る。opensslコマンドが無ければNone
+
+'''
+def makeSelfSignedCert(path):
+    if shutil.which('openssl') is None:
+        LOGGER.error('openssl not found. TLS benchmark skipped.')
+        return None
+
+    _cert = os.path.join(path, 'cert.pem')
+    _key = os.path.join(path, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+                    '-keyout', _key, '-out', _cert],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return _cert, _key
+
+
+'''
+    代役サーバーをバックグラウンドで起動する
+
+    tls_files : makeSelfSignedCertの戻り値。指定するとHTTPS
+    kwargs : MockStateの設定（latency, export_delay ...）
+
+'''
+def startServer(tls_files=None, **kwargs):
+    _ctx = None
+    if tls_files is not None:
+        _ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        _ctx.load_cert_chain(*tls_files)
+
+    return MockSoracomServer('localhost', 0, ssl_context=_ctx, **kwargs).start()
+
+
+# 測定中は各モジュールのDEBUGログを止める
+def _quietLoggers():
+    for _name in list(logging.Logger.manager.loggerDict):
+        if _name != SCRIPT_NAME:
+            getLogger(_name).setLevel(logging.WARNING)
+
+
+def _timeit(func, num):
+    _st = time.perf_counter()
+    for _i in range(num):
+        func()
+    return num / (time.perf_counter() - _st)
+
+
+'''
+    transport : urlopen（毎回接続） vs SH.request（接続プール）
+
+'''
+def benchTransport(num, tls):
+    _tmp = tempfile.mkdtemp()
+    try:
+        _tls = makeSelfSignedCert(_tmp) if tls else None
+        if tls and _tls is None:
+            return None
+
+        _server = startServer(_tls)
+        _server.state.tokens.add('token')
+        _url = _server.url + '/v1/sora_cam/devices/7C12345678AB/exports/usage'
+        _headers = SH.apiHeaders('api-key', 'token')
+
+        _ctx = None
+        if _tls is not None:
+            _ctx = ssl.create_default_context(cafile=_tls[0])
+        _pool = SH.ConnectionPool(context=_ctx)
+
+        def _before():
+            _req = urllib.request.Request(url=_url, method='GET', headers=_headers)
+            with urllib.request.urlopen(_req, context=_ctx) as res:
+                json.loads(res.read().decode('utf-8'))
+
+        def _after():
+            with _pool.request('GET', _url, headers=_headers) as res:
+                json.loads(res.read().decode('utf-8'))
+
+        _rb = _timeit(_before, num)
+        _ra = _timeit(_after, num)
+        _pool.clear()
+        _server.stop()
+
+        LOGGER.info('transport ({}, {} requests)'.format('https' if _tls else 'http', num))
+        LOGGER.info('  before (urlopen)    : {:10.1f} req/s'.format(_rb))
+        LOGGER.info('  after  (SH.request) : {:10.1f} req/s'.format(_ra))
+        LOGGER.info('  speedup             : {:10.2f} x'.format(_ra / _rb))
+
+        return _rb, _ra
+    finally:
+        shutil.rmtree(_tmp, ignore_errors=True)
+
+
+'''
+    tracker : ポーリング1回分の突き合わせ処理
+
+    listSoraCamExportImagesが追跡中の全件を返した（半分がcompleted）とする。
+    before は変更前の処理（deepcopy + list.remove、in exported_ids のリスト走査）
+    after はページをSRC.ExportStatusに変換してから突き合わせる（変換の時間も含む）
+
+'''
+def benchTracker(num):
+    _ids = [uuid.uuid4().hex for _i in range(num)]
+    _page = [{'exportId': _id, 'status': 'completed' if _n % 2 == 0 else 'processing'} for _n, _id in enumerate(_ids)]
+    _page.reverse() # APIは新しい順に返す
+
+    def _before():
+        # listSoraCamExportImages
+        _wl = copy.deepcopy(_ids)
+        for _dt in _page:
+            if 'exportId' in _dt:
+                if _dt['exportId'] in _wl:
+                    _wl.remove(_dt['exportId'])
+        # waitSoraCamExportImages
+        _nc = 0
+        for _d in _page:
+            if 'exportId' in _d:
+                if _d['exportId'] in _ids:
+                    _nc += 1
+
+    def _after():
+        _tr = SE.ExportTracker(_ids)
+        # listSoraCamExportImages
+        _wl = _tr.pending()
+        _rl = SRC.parseExportStatuses(_page)
+        for _dt in _rl:
+            _wl.discard(_dt.export_id)
+        # waitSoraCamExportImages
+        for _d in _rl:
+            _tr.update(_d)
+
+    _st = time.perf_counter()
+    _before()
+    _tb = time.perf_counter() - _st
+    _st = time.perf_counter()
+    _after()
+    _ta = time.perf_counter() - _st
+
+    LOGGER.info('tracker ({} export ids, 1 poll)'.format(num))
+    LOGGER.info('  before (list)         : {:10.4f} sec'.format(_tb))
+    LOGGER.info('  after  (ExportTracker): {:10.4f} sec'.format(_ta))
+    LOGGER.info('  speedup               : {:10.1f} x'.format(_tb / _ta))
+    LOGGER.info('  page size             : {} -> {}'.format(num, SE.exportsPageSize(num)))
+
+    return _tb, _ta
+
+
+'''
+    e2e : downloadEventImages の所要時間
+
+    イベント数と抽出間隔の組み合わせごとに代役サーバーを立て直して測る。
+    イベントは長さ60秒、2分間隔。
+
+'''
+def benchE2E(event_counts, intervals, latency=0.0, export_delay=1.0, error_rate=0.0,
+             concurrency=1, download_workers=1, pipeline=False):
+    # export_sample.pyは読み込み時に認証情報の環境変数を参照する
+    os.environ.setdefault('SORACOM_AUTH_KEY_ID', 'mock')
+    os.environ.setdefault('SORACOM_AUTH_KEY', 'mock')
+    import soracom_auth as SA
+    import soracom_utils as SU
+    import export_sample as ES
+    _quietLoggers()
+
+    _duration = timedelta(seconds=60)
+    _gap = timedelta(minutes=2)
+    _st = datetime(2024, 5, 1, 12, 0, 0, tzinfo=ES.TOKYO)
+
+    LOGGER.info('e2e (latency {} sec, export delay {} sec, error rate {}, concurrency {}, download workers {}, pipeline {})'.format(
+                latency, export_delay, error_rate, concurrency, download_workers, pipeline))
+    LOGGER.info('  {:>6} {:>8} {:>7} {:>10} {:>9} {:>10} {:>9}'.format('events', 'interval', 'frames', 'downloaded', 'elapsed', 'frames/s', 'api calls'))
+
+    _rt = list()
+    for _n in event_counts:
+        for _iv in intervals:
+            _server = startServer(latency=latency, export_delay=export_delay, error_rate=error_rate)
+            _server.state.addMotionEvents('*', SU.getUnixtime(_st), _n,
+                                          int(_duration.total_seconds() * 1000), int(_gap.total_seconds() * 1000))
+            _endpoint = SH.API_ENDPOINT
+            SH.setApiEndpoint(_server.url)
+            _tmp = tempfile.mkdtemp()
+            try:
+                akey, token, oid, unm = SA.getToken(SA.authUrl(), 'mock', 'mock')
+                _sm = dict()
+                _t0 = time.perf_counter()
+                ES.downloadEventImages(akey, token, 'MOCKDEVICE', _st, _st + _gap * _n, _iv, _tmp,
+                                       concurrency, download_workers, pipeline, _sm)
+                _el = time.perf_counter() - _t0
+            finally:
+                SH.setApiEndpoint(_endpoint)
+                SH.POOL.clear()
+                _server.stop()
+                shutil.rmtree(_tmp, ignore_errors=True)
+
+            _calls = sum(_server.state.calls.values()) - _server.state.calls.get('auth', 0)
+            LOGGER.info('  {:>6} {:>8} {:>7} {:>10} {:>9.2f} {:>10.1f} {:>9}'.format(
+                        _n, _iv, _sm.get('planned', 0), _sm.get('downloaded', 0), _el, _sm.get('downloaded', 0) / _el, _calls))
+            _rt.append((_n, _iv, _sm, _el))
+
+    return _rt
+
+
+'''
+    planner : 時刻の並びの作成
+
+    days日の期間に、重ならないwindows個の区間をばらまき、step（ミリ秒）間隔の時刻を作る。
+    before は変更前の処理（区間ごとにrangeのリスト内包表記で作り、1件ずつdatetimeに変換してログに渡す）
+
+'''
+def benchPlanner(days, windows, step):
+    _rand = random.Random(0)
+    _span = int(days * 24 * 3600 * 1000)
+    _bounds = sorted(_rand.sample(range(_span), windows * 2))
+    _windows = [(_bounds[_i], _bounds[_i + 1]) for _i in range(0, len(_bounds), 2)]
+
+    def _before():
+        _rl = list()
+        for _st, _ed in _windows:
+            _q = int((_ed - _st) / step)
+            _wl = [_st + step * _i for _i in range(_q + 1)]
+            if _wl[-1] != _ed:
+                _wl.append(_ed)
+            for _t in _wl:
+                # 変更前はログのためにdatetimeへ変換していた
+                datetime.fromtimestamp(_t / 1000)
+            _rl.extend(_wl)
+        return _rl
+
+    def _after():
+        return SP.gridTimes(_windows, step)
+
+    _st = time.perf_counter()
+    _rb = _before()
+    _tb = time.perf_counter() - _st
+    _st = time.perf_counter()
+    _ra = _after()
+    _ta = time.perf_counter() - _st
+
+    # listは要素のintも数える
+    _mb = sys.getsizeof(_rb) + sum(sys.getsizeof(_t) for _t in _rb)
+    _ma = sys.getsizeof(_ra)
+
+    LOGGER.info('planner ({} days, {} windows, step {} ms, {} frames, numpy {})'.format(
+                days, windows, step, len(_ra), SP.np is not None))
+    LOGGER.info('  before (list)          : {:10.4f} sec, {:12d} bytes'.format(_tb, _mb))
+    LOGGER.info('  after  (SP.gridTimes)  : {:10.4f} sec, {:12d} bytes'.format(_ta, _ma))
+    LOGGER.info('  speedup                : {:10.1f} x, {:10.1f} x smaller'.format(_tb / _ta, _mb / _ma))
+    if list(_ra) != _rb:
+        LOGGER.error('planner results differ.')
+        return None
+
+    return _tb, _ta
+
+
+'''
+    records : イベントの保持と読み出し
+
+    listSoraCamDeviceEventsForDeviceの応答と同じ形のイベントをnum件合成し、100件ずつのページ（JSON）にする。
+    before は変更前の処理（json.loadsのdictをそのまま持ち、['eventInfo']['atomEventV1'][...] で読む）
+    after はページごとにSRC.parseEventsで変換し、dictは捨ててレコードだけを持つ
+    メモリは保持しているオブジェクトの大きさ（tracemalloc。時間とは別に測る）。読み出しは録画完了のモーション検知イベントの時刻を全件読む時間。
+
+'''
+def benchRecords(num, page_size=100):
+    _rand = random.Random(0)
+    _devs = ['7CDDE9{:06X}'.format(_i) for _i in range(10)]
+    _st = 1700000000000
+    _pages = list()
+    for _p in range(0, num, page_size):
+        _l = list()
+        for _i in range(_p, min(num, _p + page_size)):
+            _t = _st + _i * 120000
+            _l.append({
+                'deviceId': _devs[_i % len(_devs)],
+                'time': _t,
+                'eventType': 'motion',
+                'eventInfo': {
+                    'atomEventV1': {
+                        'type': 'motion',
+                        'startTime': _t,
+                        'endTime': _t + _rand.randint(5000, 60000),
+                        'recordingStatus': 'completed' if _rand.random() < 0.95 else 'recording',
+                        'picture': 'https://soracom-sora-cam-devices-api-export-file-prod.s3.amazonaws.com/{}/{}.jpg'.format(
+                                   _devs[_i % len(_devs)], uuid.uuid4().hex),
+                        }
+                    }
+                })
+        _pages.append(json.dumps(_l))
+
+    def _measure(func, read):
+        # 時間はtracemallocを止めて測る
+        _st = time.perf_counter()
+        _rl = func()
+        _t = time.perf_counter() - _st
+        _st = time.perf_counter()
+        _wl = read(_rl)
+        _tr = time.perf_counter() - _st
+        del _rl
+        tracemalloc.start()
+        _rl = func()
+        _m = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return _t, _m, _tr, _wl
+
+    def _before():
+        _rl = list()
+        for _pg in _pages:
+            _rl.extend(json.loads(_pg))
+        return _rl
+
+    def _after():
+        _rl = list()
+        for _pg in _pages:
+            _rl.extend(SRC.parseEvents(json.loads(_pg)))
+        return _rl
+
+    def _readDict(events):
+        _wl = list()
+        for _ts in events:
+            if 'eventInfo' in _ts:
+                if 'atomEventV1' in _ts['eventInfo']:
+                    if _ts['eventInfo']['atomEventV1']['type'] == 'motion' and _ts['eventInfo']['atomEventV1']['recordingStatus'] == 'completed':
+                        _wl.append((_ts['eventInfo']['atomEventV1']['startTime'], _ts['eventInfo']['atomEventV1']['endTime']))
+        return _wl
+
+    def _readRecord(events):
+        _wl = list()
+        for _ev in events:
+            if _ev.isCompletedMotion():
+                _wl.append((_ev.start_time, _ev.end_time))
+        return _wl
+
+    _tb, _mb, _rtb, _wb = _measure(_before, _readDict)
+    _ta, _ma, _rta, _wa = _measure(_after, _readRecord)
+
+    LOGGER.info('records ({} events, {} pages)'.format(num, len(_pages)))
+    LOGGER.info('  before (dict)          : parse {:8.4f} sec, read {:8.4f} sec, {:12d} bytes ({:6.0f} bytes/event)'.format(
+                _tb, _rtb, _mb, _mb / num))
+    LOGGER.info('  after  (SRC.Event)     : parse {:8.4f} sec, read {:8.4f} sec, {:12d} bytes ({:6.0f} bytes/event)'.format(
+                _ta, _rta, _ma, _ma / num))
+    LOGGER.info('  ratio                  : parse {:8.2f} x, read {:8.2f} x, {:10.1f} x smaller'.format(
+                _tb / _ta, _rtb / _rta, _mb / _ma))
+    if _wa != _wb:
+        LOGGER.error('records results differ.')
+        return None
+
+    return _mb, _ma
+
+
+'''
+	main
+
+'''
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description='Benchmarks against a local stand-in of the SORACOM API')
+    parser.add_argument('target', choices=['transport', 'tracker', 'e2e', 'planner', 'records'],
+                        help='測定対象')
+    parser.add_argument('--requests', default=1000, type=int,
+                        help='リクエスト数')
+    parser.add_argument('--ids', default=10000, type=int,
+                        help='trackerで追跡するexportIdの数')
+    parser.add_argument('--tls', action='store_true',
+                        help='HTTPSで測定する（opensslコマンドが必要）')
+    parser.add_argument('--events', default='1,5,10',
+                        help='e2eのイベント数（カンマ区切り）')
+    parser.add_argument('--intervals', default='10,30',
+                        help='e2eの静止画の抽出間隔（sec。カンマ区切り）')
+    parser.add_argument('--latency', default=0.02, type=float,
+                        help='代役サーバーの応答遅延（sec）')
+    parser.add_argument('--export-delay', default=1.0, type=float,
+                        help='代役サーバーでエクスポートがcompletedになるまでの時間（sec）')
+    parser.add_argument('--error-rate', default=0.0, type=float,
+                        help='代役サーバーが500を返す確率')
+    parser.add_argument('--concurrency', default=1, type=int,
+                        help='静止画のエクスポートを同時に何件依頼するか')
+    parser.add_argument('--download-workers', default=1, type=int,
+                        help='静止画を同時に何件ダウンロードするか')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='エクスポートが完了した静止画から順にダウンロードする')
+    parser.add_argument('--days', default=3.0, type=float,
+                        help='plannerの期間（日）')
+    parser.add_argument('--windows', default=500, type=int,
+                        help='plannerの区間（イベント）の数')
+    parser.add_argument('--step', default=500, type=int,
+                        help='plannerの抽出間隔（ミリ秒）')
+    parser.add_argument('--records', default=100000, type=int,
+                        help='recordsのイベント数')
+
+    args = parser.parse_args()
+
+    if args.target == 'transport':
+        if benchTransport(args.requests, args.tls) is None:
+            sys.exit(1)
+    elif args.target == 'tracker':
+        benchTracker(args.ids)
+    elif args.target == 'e2e':
+        benchE2E([int(_n) for _n in args.events.split(',')], [float(_i) for _i in args.intervals.split(',')],
+                 args.latency, args.export_delay, args.error_rate,
+                 max(1, args.concurrency), max(1, args.download_workers), args.pipeline)
+    elif args.target == 'planner':
+        benchPlanner(args.days, max(1, args.windows), max(1, args.step))
+    elif args.target == 'records':
+        if benchRecords(max(1, args.records)) is None:
+            sys.exit(1)
@@ -15,12 +15,44 @@
     2024/5/15 t.odaka
 
     引数：   device : device id （クラウドモーション検知 “無制限” 録画ライセンスが適用されていること）
+            devices : 複数のdevice id（カンマ区切り）。deviceと併用可
+            devices-file : device idを1行に1つ書いたファイル
+            max-devices : 同時に処理するデバイス数（デバイスごとの静止画は dir/<device id> に保存）
+            max-inflight : 全デバイス合計で同時に送るAPIリクエスト数の上限
+            rate-limit : 全デバイス合計のAPIリクエスト数の上限（毎秒）。429が返った時はRetry-Afterの間待って送り直す
+            rate-limit-endpoint : endpointごとの上限。"パターン=毎秒の数[:まとめて送れる数]"（例 "POST */images/exports=2:5"）。複数指定可
             dir : 作業ディレクトリ
             start: ダウンロード開始録画時間。フォーマット "%Y%m%d %H%M%S"の文字列
             end : ダウンロード終了録画時間。フォーマット "%Y%m%d %H%M%S"の文字列
             interval : 何秒間隔で静止画を抽出するか？
+            concurrency : 静止画のエクスポートを同時に何件依頼するか
+            download-workers : 静止画を同時に何件ダウンロードするか
+            pipeline : エクスポートの完了を待たずに、完了した静止画から順にダウンロードする
+            quota-strategy : 残りフレーム数が足りない時の計画。widen（インターバルを広げる）/ proportional（イベントの長さに比例して配る）
+            resume : 前回の実行の続きから処理する（作業ディレクトリを消さず、ジャーナルに記録済みのエクスポート・ダウンロードを飛ばす）
+            watch : 止めるまで動き続け、新しいモーション検知イベントの録画が完了したものから順にエクスポートする（start, endは使わない）。
+                    どのイベントまで処理したかをジャーナルに記録するので、再起動しても続きから処理する
+            poll-interval : watchで新しいイベントを確認する間隔（sec）
+            export-deadline : エクスポートの完了を待つ時間の上限（sec）
+            export-timing : エクスポートの完了時間の見積もりを保存するファイル（進捗を確認する間隔を決める。空文字で保存しない）
+            lookback : watchで初めて監視するデバイスは、何秒前からのイベントを処理するか
+            token-cache : APIトークンのキャッシュファイル。指定するとトークンを使い回し、終了時にも無効化しない
+            revoke : token-cache使用時に、終了時にトークンを無効化してキャッシュを消す
+            timelapse : ダウンロードした静止画から、撮影順にタイムラプス動画（dir/timelapse.mp4）を作る（ffmpegが必要）
             fps : フレームレート。1秒間に静止画を何枚見るか。
             maxwidth : 解像度（横幅）の最大値
+            postprocess : ダウンロードした静止画をmaxwidthに縮小・再圧縮する（Pillowが必要）
+            image-format : 後処理で保存する形式（jpeg / webp）
+            quality : 後処理の圧縮品質
+            postprocess-workers : 後処理のプロセス数
+            log-level : ログのレベル（debug / info / warning / error）。環境変数 SORACOM_LOG_LEVEL でも指定できる
+            log-async : ログの書き出しを別スレッドで行う。環境変数 SORACOM_LOG_ASYNC=1 でも指定できる
+            metrics : 終了時にメトリクス（APIごとのレイテンシ、ステータス、リトライ、フレーム数など）を書き出すファイル
+            metrics-format : メトリクスの形式（json / prometheus）
+            export-cache : エクスポート結果のキャッシュのファイル（指定した時だけ使う。例 ~/.soracam_export_cache.sqlite3）。同じデバイス・時刻の静止画は、
+                    URLの有効期限内ならエクスポートせずにキャッシュのURLからダウンロードする
+            store : 静止画の保管庫（ハッシュで1回だけ保存し、device id・撮影時刻の索引を持つ）。作業ディレクトリの外に置くこと。
+                    保管済みの時刻はエクスポートもダウンロードもせずに保管庫から取り出す
             
     
 
@@ -34,21 +66,35 @@
 '''
 import sys, os
 import json
+import sqlite3
 
 from logging import getLogger
 from datetime import datetime, timedelta
-import time, urllib, copy
+import time, urllib.parse, urllib.error
 
 ## TimeZone設定
 from zoneinfo import ZoneInfo
 
 import argparse
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import LogUtils as LU
-import random
 
 import soracom_auth as SA
 import soracom_utils as SU
+import soracom_http as SH
+import soracom_exports as SE
+import soracom_journal as SJ
+import soracom_planner as SP
+import soracom_timelapse as ST
+import soracom_postprocess as SPP
+import soracom_metrics as SM
+import soracom_ratelimit as SR
+import soracom_framestore as SF
+import soracom_exportcache as SC
+import soracom_records as SRC
 
 SCRIPT_NAME = os.path.basename(__file__)
 SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
@@ -61,11 +107,34 @@ LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
 
 
 # 認証情報の取得
-SORACOM_AUTH_KEY_ID = os.environ['SORACOM_AUTH_KEY_ID']
-SORACOM_AUTH_KEY = os.environ['SORACOM_AUTH_KEY']
+# importしただけでは失敗しないように、無い時は空文字にしてmainでチェックする（ライブラリとしてはsoracom_client.SoraCamClientを使う）
+SORACOM_AUTH_KEY_ID = os.environ.get('SORACOM_AUTH_KEY_ID', '')
+SORACOM_AUTH_KEY = os.environ.get('SORACOM_AUTH_KEY', '')
 
 TOKYO = ZoneInfo("Asia/Tokyo")
 
+# listSoraCamDeviceEventsForDeviceで1ページに取得できる件数の上限
+EVENTS_PAGE_SIZE_MAX = 100
+
+# エクスポートの進捗を待つ時間の上限（sec。--export-deadline）
+EXPORT_DEADLINE = SE.EXPORT_WAIT_DEADLINE
+# エクスポートの完了時間の見積もり（全デバイスで共有する。mainで保存先を設定する）
+EXPORT_TIMING = SE.CompletionEstimator()
+
+# watchモード：新しいイベントを確認する間隔（sec）
+WATCH_POLL_INTERVAL = 60
+# watchモード：初めて監視するデバイスは何秒前からのイベントを処理するか
+WATCH_LOOKBACK = 3600
+# watchモード：録画中のイベントの完了を待つ上限（sec）。これより前に始まったイベントは待たずに先へ進む
+WATCH_MAX_RECORDING = 6 * 3600
+# watchモード：終わらなかった区間（残りフレーム不足、エクスポート失敗、期限切れ）をやり直す上限（sec）。これより前に始まった区間は諦めて先へ進む
+WATCH_MAX_RETRY = 6 * 3600
+
+# 静止画の保管庫（SF.FrameStore。--storeを指定した時にmainで開く）
+FRAME_STORE = None
+# エクスポート結果のキャッシュ（SC.ExportCache。mainで開く）
+EXPORT_CACHE = None
+
 '''
     Sora-Camデバイスのエクスポート上限の取得
 
@@ -74,23 +143,14 @@ TOKYO = ZoneInfo("Asia/Tokyo")
     
 '''
 def getSoraCamExportUsage(api_key, token, device_id):
-    url = 'https://api.soracom.io/v1/sora_cam/devices/{}/exports/usage'.format(device_id)
+    url = SH.apiUrl('/v1/sora_cam/devices/{}/exports/usage'.format(device_id))
 
     _method = 'GET'
-    _headers = { 
-        'X-Soracom-API-Key' : api_key,
-        'X-Soracom-Token' : token
-        }
+    _headers = SH.apiHeaders(api_key, token)
     _body = None
 
-    req = urllib.request.Request(
-        url = url, 
-        data = _body, 
-        method = _method,
-        headers = _headers 
-    )
     try:
-        with urllib.request.urlopen(req) as res:
+        with SH.request(_method, url, headers=_headers, body=_body) as res:
             #内容のbyte型への変換 type:byte型
             data = res.read()
             #内容のbite型→文字列型へのデコード type:str型
@@ -110,6 +170,23 @@ def getSoraCamExportUsage(api_key, token, device_id):
 
     return None
 
+
+'''
+    Sora-Camデバイスの残りエクスポート可能フレーム数
+
+        戻り値 : remainingFrames（int）。取得できなかった時はNone
+
+'''
+def getRemainingFrames(api_key, token, device_id):
+    _js = getSoraCamExportUsage(api_key, token, device_id)
+    if _js is not None:
+        if "image" in _js:
+            if "remainingFrames" in _js["image"]:
+                LOGGER.debug("Remaining Num. of Frames : %s", _js["image"]["remainingFrames"])
+                return int(_js["image"]["remainingFrames"])
+
+    return None
+
 '''
     Sora-Camデバイスの静止画イメージのエクスポート開始
 
@@ -118,34 +195,24 @@ def getSoraCamExportUsage(api_key, token, device_id):
 
 '''
 def getSoraCamExportImages(api_key, token, device_id, extime, wide_angle_correction=True):
-    url = 'https://api.soracom.io/v1/sora_cam/devices/{}/images/exports'.format(device_id)
+    url = SH.apiUrl('/v1/sora_cam/devices/{}/images/exports'.format(device_id))
 
     _method = 'POST'
-    _headers = { 
-        'X-Soracom-API-Key' : api_key,
-        'X-Soracom-Token' : token,
-        'Content-Type'  : 'application/json'
-        }
+    _headers = SH.apiHeaders(api_key, token, 'application/json')
     _d = dict()
     if wide_angle_correction:
         _d["imageFilters"] = ["wide_angle_correction"]
     _d["time"] = extime
 
-    LOGGER.debug('exporting image. device_id {}, time {} {}'.format(device_id, extime, SU.getDateTimeFromUnixTime(extime)))
+    LOGGER.debug('exporting image. device_id %s, time %s %s', device_id, extime, SU.LazyDateTime(extime))
 #    LOGGER.debug(SU.getDateTimeFromUnixTime(extime))
 #    LOGGER.debug(json.dumps(_d))
 
     _body = json.dumps(_d).encode()
-    req = urllib.request.Request(
-        url = url,
-        data = _body,
-        method = _method,
-        headers = _headers
-    )
     
-    LOGGER.debug("url: {}".format(url))
+    LOGGER.debug("url: %s", url)
     try:
-        with urllib.request.urlopen(req) as res:
+        with SH.request(_method, url, headers=_headers, body=_body) as res:
             #内容のbyte型への変換 type:byte型
             data = res.read()
             #内容のbite型→文字列型へのデコード type:str型
@@ -157,7 +224,7 @@ def getSoraCamExportImages(api_key, token, device_id, extime, wide_angle_correct
                 _dict = None
             
             if 'exportId' in _dict:
-                LOGGER.debug('Exporting mage: status {}, exportid {}'.format(_dict['status'], _dict['exportId']))
+                LOGGER.debug('Exporting mage: status %s, exportid %s', _dict['status'], _dict['exportId'])
 
             return _dict
 
@@ -170,77 +237,94 @@ def getSoraCamExportImages(api_key, token, device_id, extime, wide_angle_correct
 
 
 '''
-    Sora-Camデバイスのイベント情報の取得
+    Sora-Camデバイスのイベント情報の取得（1ページ分）
 
-    Soracom APIリファレンス
-    https://users.soracom.io/ja-jp/tools/api/reference/#/SoraCam/listSoraCamDeviceEventsForDevice
+        query : APIに渡すクエリ（dict）
+        戻り値 : (イベント（SRC.Event）のリスト, 次ページのキー（無ければNone）)
+        エラーはurllib.error.HTTPError / URLErrorを送出する。
 
 '''
-def listSoraCamEventsForDevice(api_key, token, device_id, st_time, ed_time):
-    _url = 'https://api.soracom.io/v1/sora_cam/devices/{}/events'.format(device_id)
+def _fetchSoraCamEventsPage(api_key, token, device_id, query):
+    _url = SH.apiUrl('/v1/sora_cam/devices/{}/events'.format(device_id))
 
     _method = 'GET'
-    _headers = { 
-        'X-Soracom-API-Key' : api_key,
-        'X-Soracom-Token' : token
-        }
-    
+    _headers = SH.apiHeaders(api_key, token)
+
+    url = _url + '?' + urllib.parse.urlencode(query)
+    LOGGER.debug(url)
+
+    with SH.request(_method, url, headers=_headers) as res:
+        #内容のbyte型への変換 type:byte型
+        _dt = res.read()
+        #内容のbite型→文字列型へのデコード type:str型
+        data = _dt.decode("utf-8")
+        data = json.loads(data)
+#        LOGGER.debug(data)
+        if isinstance(data, list) and len(data) > 0:
+            # 使う項目だけのレコードにする（応答のdictはここで手放す）
+            _head = res.info()
+            if 'x-soracom-next-key' in _head:
+                LOGGER.debug('x-soracom-next-key exists %s', _head['x-soracom-next-key'])
+                return SRC.parseEvents(data), _head['x-soracom-next-key']
+            return SRC.parseEvents(data), None
+
+    return list(), None
+
+
+'''
+    Sora-Camデバイスのイベント情報（SRC.Event）を1件ずつ返すジェネレーター
+
+    Soracom APIリファレンス
+    https://users.soracom.io/ja-jp/tools/api/reference/#/SoraCam/listSoraCamDeviceEventsForDevice
+
+        limit : 1ページの件数（APIの上限 EVENTS_PAGE_SIZE_MAX まで）
+
+    呼び出し側が今のページのイベントを処理している間に、次のページをバックグラウンドで取得しておく。
+    エラーはurllib.error.HTTPError / URLErrorを送出する。
+
+'''
+def iterSoraCamEventsForDevice(api_key, token, device_id, st_time, ed_time, limit=None):
     _d = dict()
     _d["device_id"] = device_id
-    _d["limit"] = 10
+    _d["limit"] = EVENTS_PAGE_SIZE_MAX if limit is None else max(1, min(int(limit), EVENTS_PAGE_SIZE_MAX))
     _d["from"] = st_time
     _d["to"] = ed_time
     _d["sort"] = 'asc'
-    
-    _query = urllib.parse.urlencode(_d)
-    url = _url + '?' + _query
-    LOGGER.debug(url)
 
-    req = urllib.request.Request(
-        url = url, 
-        method = _method,
-        headers = _headers 
-    )
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        _future = executor.submit(_fetchSoraCamEventsPage, api_key, token, device_id, dict(_d))
+        while _future is not None:
+            data, _nk = _future.result()
+            _future = None
+            if _nk is not None:
+                # 次のページを先に取りに行く
+                _d["last_evaluated_key"] = _nk
+                _future = executor.submit(_fetchSoraCamEventsPage, api_key, token, device_id, dict(_d))
+
+            for _ev in data:
+                yield _ev
+
+
+'''
+    Sora-Camデバイスのイベント情報の取得
+
+    Soracom APIリファレンス
+    https://users.soracom.io/ja-jp/tools/api/reference/#/SoraCam/listSoraCamDeviceEventsForDevice
+
+    全ページを取得してSRC.Eventのリストで返す。エラーの時はNone
+
+'''
+def listSoraCamEventsForDevice(api_key, token, device_id, st_time, ed_time):
     try:
-        _ret = list()
-        _flg = True
-        while _flg:
-            with urllib.request.urlopen(req) as res:
-                #内容のbyte型への変換 type:byte型
-                _dt = res.read()
-                #内容のbite型→文字列型へのデコード type:str型
-                data = _dt.decode("utf-8")
-                data = json.loads(data)
-#                LOGGER.debug(data)
-                if isinstance(data, list) and len(data) > 0:
-                    _ret.extend(data)
-                
-                    _head = res.info()
-                    if 'x-soracom-next-key' in _head:
-                        LOGGER.debug('x-soracom-next-key exists {}'.format(_head['x-soracom-next-key']))
-                        
-                        _d["last_evaluated_key"] = _head['x-soracom-next-key']
-                        _query = urllib.parse.urlencode(_d)
-                        url = _url + '?' + _query
-                        LOGGER.debug(url)
-
-                        req = urllib.request.Request(
-                            url = url, 
-                            method = _method,
-                            headers = _headers 
-                        )
-                    else:
-                        _flg = False
-        
+        _ret = list(iterSoraCamEventsForDevice(api_key, token, device_id, st_time, ed_time))
 #        LOGGER.debug('data length = {}'.format(len(_ret)))
 
         return _ret
 
-
     except urllib.error.HTTPError as err:
-        LOGGER.error('{}: urllib.error.HTTPError. code {}. url: {}'.format(device_id, err.code, url))
+        LOGGER.error('{}: urllib.error.HTTPError. code {}. url: {}'.format(device_id, err.code, err.url))
     except urllib.error.URLError as err:
-        LOGGER.error('{}: urllib.error.URLError. reason {}. url: {}'.format(device_id, err.reason, url))
+        LOGGER.error('{}: urllib.error.URLError. reason {}'.format(device_id, err.reason))
 
     return None
 
@@ -250,68 +334,60 @@ def listSoraCamEventsForDevice(api_key, token, device_id, st_time, ed_time):
     Soracom APIリファレンス
     https://users.soracom.io/ja-jp/tools/api/reference/#/SoraCam/listSoraCamDeviceImageExports
 
+        exported_ids : 進捗を知りたいexportIdのリスト、またはSE.ExportTracker（未確定の分だけ探す）
+        ページングは、探しているexportIdが全部見つかった時点で止める。
+
+        戻り値 : 進捗（SRC.ExportStatus）のリスト。エラーの時はNone
+
 '''
 def listSoraCamExportImages(api_key, token, device_id, exported_ids):
-    url = 'https://api.soracom.io/v1/sora_cam/devices/images/exports'
+    url = SH.apiUrl('/v1/sora_cam/devices/images/exports')
 
 #    LOGGER.debug(exported_ids)
     _method = 'GET'
-    _headers = {
-        'X-Soracom-API-Key' : api_key,
-        'X-Soracom-Token' : token
-        }
+    _headers = SH.apiHeaders(api_key, token)
+
+    # 探しているexportId
+    if isinstance(exported_ids, SE.ExportTracker):
+        _wl = exported_ids.pending()
+    else:
+        _wl = set(exported_ids)
 
     _d = dict()
     _d["device_id"] = device_id
-    _d["limit"] = len(exported_ids)
+    _d["limit"] = SE.exportsPageSize(len(_wl))
     
     _query = urllib.parse.urlencode(_d)
     _url = url + '?' + _query
     LOGGER.debug(_url)
 
-    req = urllib.request.Request(
-        url = _url,
-        method = _method,
-        headers = _headers
-    )
-
     try:
         _ret = list()
         _flg = True
-        _wl = copy.deepcopy(exported_ids)
         while _flg:
-            with urllib.request.urlopen(req) as res:
+            _flg = False
+            with SH.request(_method, _url, headers=_headers) as res:
                 #内容のbyte型への変換 type:byte型
                 _dt = res.read()
                 #内容のbite型→文字列型へのデコード type:str型
                 data = _dt.decode("utf-8")
                 data = json.loads(data)
-                LOGGER.debug(data)
                 if isinstance(data, list) and len(data) > 0:
+                    data = SRC.parseExportStatuses(data)
                     _ret.extend(data)
                     # 依頼したエクスポートの進捗が全部取得できているか？
                     for _dt in data:
-                        if 'exportId' in _dt:
-                            if _dt['exportId'] in _wl:
-                                _wl.remove(_dt['exportId'])
+                        _wl.discard(_dt.export_id)
                     # 依頼したエクスポートの進捗が全部取得できていなければ、'x-soracom-next-key'をつかって次ページ。
                     if len(_wl) > 0:
                         _head = res.info()
-                        LOGGER.debug(_head)                       
                         if 'x-soracom-next-key' in _head:
-                            LOGGER.debug('x-soracom-next-key exists {}'.format(_head['x-soracom-next-key']))                     
+                            LOGGER.debug('x-soracom-next-key exists %s', _head['x-soracom-next-key'])
                             _d["last_evaluated_key"] = _head['x-soracom-next-key']
                             _query = urllib.parse.urlencode(_d)
                             _url = url + '?' + _query
                             LOGGER.debug(_url)
-
-                            req = urllib.request.Request(
-                                url = _url,
-                                method = _method,
-                                headers = _headers
-                            )
-                    else:
-                        _flg = False
+                            _flg = True
                               
 #        LOGGER.debug('data length = {}'.format(len(_ret)))
         return _ret
@@ -326,56 +402,287 @@ def listSoraCamExportImages(api_key, token, device_id, exported_ids):
 '''
     Sora-Camの静止画ダウンロードの進捗
 
-    listSoraCamExportImagesを指数バックオフで待つ処理をたくさん書くのが面倒なので関数化した
+    listSoraCamExportImagesを、完了しそうな時刻に合わせて待つ処理をたくさん書くのが面倒なので関数化した
+    待ち時間はSE.CompletionEstimator（これまでの完了時間の見積もり）で決め、合計でdeadline秒までしか待たない。
+
+        deadline : 待つ時間の上限（sec）
+        on_completed : 新たにcompletedになったエクスポートの進捗（SRC.ExportStatusのリスト）を受け取る関数。
+                       ポーリングのたびに呼ばれるので、残りのエクスポートを待つ間にダウンロードを始められる。
+        estimator : SE.CompletionEstimator。省略時はEXPORT_TIMING（完了した時間を反映する）
+
+        戻り値 : exported_idsの最終的な進捗（SRC.ExportStatusのリスト）。deadlineを超えた時はNone
 
 '''
-def waitSoraCamExportImages(api_key, token, device_id, exported_ids, MAX_ATTEMPT=7):
+def waitSoraCamExportImages(api_key, token, device_id, exported_ids, deadline=None, on_completed=None, estimator=None):
 #    LOGGER.debug(exported_ids)
-    num_of_images = len(exported_ids)
-    flag = True
-    completed = True
-    backoff = 1
-    while flag:
+    _dl = deadline if deadline is not None else EXPORT_DEADLINE
+    _es = estimator if estimator is not None else EXPORT_TIMING
+    _tr = SE.ExportTracker(exported_ids)
+    _t0 = time.monotonic()
+    _prev = None    # 前回進捗を確認した時刻
+    while True:
         # ダウンロードの進捗。
-        _l = listSoraCamExportImages(api_key, token, device_id, exported_ids)
+        _now = time.monotonic()
+        _l = listSoraCamExportImages(api_key, token, device_id, _tr)
         if isinstance(_l, list):
-            _nc = 0
+            _new = list()
             for _d in _l:
-                if 'exportId' in _d:
-                    if _d['exportId'] in exported_ids:
-                        _nc += 1
-                        # ダウンロード可能な状態
-                        if _d['status'] == 'completed':
-                            LOGGER.debug("Image export completed. device_id:{}, status:{}, export_id:{}".format(device_id, _d['status'], _d['exportId']))
-                        # ダウンロード不可能な状態
-                        elif _d['status'] == 'failed' or _d['status'] == 'limitExceeded' \
-                                or _d['status'] == 'expired':
-                            completed = False
-                            LOGGER.error("Image export could be initialized but failed. device_id:{}, status:{}, export_id:{}".format(device_id, _d['status'], _d['exportId']))
+                _st = _tr.update(_d)
+                # ダウンロード可能な状態
+                if _st == 'completed':
+                    _new.append(_d)
+                    LOGGER.debug("Image export completed. device_id:%s, status:%s, export_id:%s", device_id, _d.status, _d.export_id)
+                    # 前回の確認から今回の確認までの間に完了したとみなす
+                    # （最初の確認で完了していた分は、いつ完了したか分からないので数えない）
+                    if _prev is not None:
+                        _ct = (_prev + _now) / 2 - _t0
+                        _es.observe(_ct)
+                        SM.observe('soracom_export_completion_seconds', _ct)
+                # ダウンロード不可能な状態
+                elif _st == 'failed':
+                    LOGGER.error("Image export could be initialized but failed. device_id:{}, status:{}, export_id:{}".format(device_id, _d.status, _d.export_id))
+
+            # completedになった分は残りを待たずに渡す
+            if on_completed is not None and len(_new) > 0:
+                on_completed(_new)
 
             # exported_idに指定したダウンロード依頼の結果（可能、不可能）が判断できたら終了
-            if _nc == num_of_images:
-                if completed:
+            if _tr.isResolved():
+                if _tr.numFailed() == 0:
                     # 指定した数だけcompleteしたら終了。
                     LOGGER.debug("Exporting images finished successfully")
                 else:
                     LOGGER.error("Exporting images finished. but failed. see above errors.")
-                return _l
-
-        # 指数バックオフ
-        _sl = (2 ** backoff) + (random.randint(0, 1000) / 1000)
-        LOGGER.debug(_sl)
-        time.sleep(_sl) 
-        backoff += 1
-        if backoff > MAX_ATTEMPT:
-            LOGGER.error("Exceed MAX_ATTEMPT")
+                return _tr.results()
+
+        _el = time.monotonic() - _t0
+        if _el >= _dl:
+            LOGGER.error("Exceed deadline. {} sec, pending {}".format(_dl, _tr.numPending()))
             return None
-        
-        LOGGER.debug("Retrying {}".format(backoff))
+
+        # 見積もりの完了時刻に合わせて待つ
+        SM.inc('soracom_retries_total', endpoint=SM.endpointName('GET', SH.apiUrl('/v1/sora_cam/devices/images/exports')), reason='export_pending')
+        _sl = min(_es.delay(_el), _dl - _el)
+        LOGGER.debug("Waiting export %.2f sec (elapsed %.2f, expected %.2f)", _sl, _el, _es.mean)
+        time.sleep(_sl)
+        _prev = _now
+
+
+
+'''
+    デバイスごとの集計（summary）に件数を足す。summaryがNoneの時はメトリクスだけ
+
+'''
+def _addSummary(summary, key, num):
+    # 全デバイス合計のメトリクス（soracom_exported_total など）
+    SM.inc('soracom_{}_total'.format(key), num)
+    if summary is not None:
+        summary[key] = summary.get(key, 0) + num
+
+
+# 集計を足し合わせる（メトリクスは_addSummaryで数え済みなので数えない）
+def _mergeSummary(summary, other):
+    if summary is not None:
+        for _k, _v in other.items():
+            summary[_k] = summary.get(_k, 0) + _v
+
+
+'''
+    指定した時刻（unixtime 13桁）の静止画のエクスポートをまとめて依頼する
+
+        times : エクスポートする時刻のリスト
+        concurrency : 同時に依頼する数。1の時は1件ずつ順番に依頼する。
+        journal : SJ.Journal。指定した時は依頼したexportIdを記録する
+        id_times : 指定したdictに exportId -> 時刻 を書き込む
+
+        戻り値 : (exportIdのリスト（timesの順）, 失敗した数)
+'''
+def exportImages(api_key, token, device_id, times, concurrency=1, journal=None, id_times=None):
+
+    def _export(extime):
+        LOGGER.debug('try exporting. time:%s, %s', extime, SU.LazyDateTime(extime))
+        # 静止画のエクスポート
+        return extime, getSoraCamExportImages(api_key, token, device_id, extime, True)
+
+    if concurrency > 1:
+        # 同時実行数だけkeep-alive接続を使い回せるようにする
+        if SH.POOL.maxsize < concurrency:
+            SH.configurePool(maxsize=concurrency)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            _results = list(executor.map(_export, times))
+    else:
+        _results = map(_export, times)
+
+    _el = list()
+    _jl = list()
+    _fl = 0
+    for _i, _wk in _results:
+        # 静止画のエクスポート処理が済んだらexportIdをリストに溜め込んで、進捗にうつる。
+        # エラーの分は飛ばす。
+        if isinstance(_wk, dict):
+            if 'exportId' in _wk:
+                _el.append(_wk['exportId'])
+                _jl.append((_i, _wk['exportId']))
+        else:
+            _fl += 1
+            LOGGER.error('Export failed. this might be because of 40x Error. device_id :%s, time : %s, %s', device_id, _i, SU.LazyDateTime(_i, '%Y%m%d %H%M%S'))
+
+    if journal is not None:
+        journal.setExported(device_id, _jl)
+    if id_times is not None:
+        id_times.update((_eid, _i) for _i, _eid in _jl)
+
+    return _el, _fl
+
+
+'''
+    静止画のファイル名の先頭に付ける撮影時刻（名前順に並べると撮影順になる）
+
+        extime : unixtime 13桁
+
+    実行する環境のタイムゾーン（夏時間で時刻が戻る）によらないように、日本時間（TOKYO）で付ける。
+
+'''
+def frameSeq(extime):
+    _t = int(extime)
+    return datetime.fromtimestamp(_t // 1000, TOKYO).strftime('%Y%m%d%H%M%S') + '{:03d}'.format(_t % 1000)
+
+
+'''
+    completedになったエクスポートの静止画を1件ダウンロードする
+
+        entry : listSoraCamExportImagesが返す進捗（SRC.ExportStatus）
+        journal : SJ.Journal。指定した時はダウンロードしたファイルを記録する
+        id_times : exportId -> 時刻。時刻が分かる時はファイル名の先頭に撮影時刻を付ける
+        on_downloaded : ダウンロードしたファイルパスを受け取る関数（後処理の投入など）
+
+        FRAME_STOREがある時は、撮影時刻の分かる静止画を保管庫にも入れる
+
+        戻り値 : ダウンロードしたファイルパス。失敗した時はNone
+'''
+def _downloadExport(entry, path, journal=None, id_times=None, on_downloaded=None):
+    _seq = ''
+    if id_times is not None and entry.export_id in id_times:
+        _seq = frameSeq(id_times[entry.export_id])
+    _fp = SU.tryDownloadImage(entry.url, path, _seq)
+    if _fp is not None and journal is not None:
+        journal.setDownloaded(entry.export_id, _fp)
+    if _fp is not None and FRAME_STORE is not None and len(_seq) > 0 and entry.device_id is not None:
+        try:
+            FRAME_STORE.put(entry.device_id, id_times[entry.export_id], _fp, entry.export_id, entry.url.split('?')[0].split('/')[-1])
+        except (OSError, sqlite3.Error) as err:
+            LOGGER.error('store failed. {}. {}'.format(err, _fp))
+    if _fp is not None and on_downloaded is not None:
+        on_downloaded(_fp)
+
+    return _fp
+
+
+'''
+    completedになったエクスポートの進捗をキャッシュに記録する（EXPORT_CACHEがある時）
+
+        id_times : exportId -> 時刻。時刻の分からない進捗は記録しない
+'''
+def _cacheExports(device_id, entries, id_times):
+    if EXPORT_CACHE is None or id_times is None:
+        return None
+    try:
+        EXPORT_CACHE.put(device_id, [(id_times[_d.export_id], _d) for _d in entries if _d.export_id in id_times])
+    except sqlite3.Error as err:
+        LOGGER.error('export cache failed. {}'.format(err))
 
     return None
 
 
+'''
+    キャッシュにあるエクスポートの静止画をダウンロードする（エクスポートの依頼も進捗の確認もしない）
+
+        hits : 時刻 -> 進捗（EXPORT_CACHE.lookupの戻り値）
+
+        戻り値 : ダウンロードできなかった時刻のリスト（キャッシュから消すので、呼び出し側でエクスポートし直す）
+'''
+def _downloadCachedExports(device_id, hits, path, download_workers=1, journal=None, id_times=None, on_downloaded=None):
+    _hl = sorted(hits.items())
+    if journal is not None:
+        journal.setExported(device_id, [(_t, _d.export_id) for _t, _d in _hl])
+        journal.setStatuses([_d for _t, _d in _hl])
+    if id_times is not None:
+        id_times.update((_d.export_id, _t) for _t, _d in _hl)
+
+    if download_workers > 1:
+        if SH.POOL.maxsize < download_workers:
+            SH.configurePool(maxsize=download_workers)
+        with ThreadPoolExecutor(max_workers=download_workers) as executor:
+            _results = list(executor.map(lambda _h: _downloadExport(_h[1], path, journal, id_times, on_downloaded), _hl))
+    else:
+        _results = [_downloadExport(_d, path, journal, id_times, on_downloaded) for _t, _d in _hl]
+
+    _fl = [_t for (_t, _d), _fp in zip(_hl, _results) if _fp is None]
+    for _t in _fl:
+        EXPORT_CACHE.discard(device_id, _t)
+    if len(_fl) > 0:
+        LOGGER.warning("Cached export could not be downloaded : %d frames. exporting again", len(_fl))
+
+    return _fl
+
+
+'''
+    completedになったエクスポートの静止画をまとめてダウンロードする
+
+        戻り値 : (ダウンロードしたファイルパスのリスト, 失敗した数)
+'''
+def _downloadExports(entries, path, download_workers=1, journal=None, id_times=None, on_downloaded=None):
+    _dl = [_d for _d in entries if _d.url is not None]
+    if download_workers > 1:
+        if SH.POOL.maxsize < download_workers:
+            SH.configurePool(maxsize=download_workers)
+        with ThreadPoolExecutor(max_workers=download_workers) as executor:
+            _results = list(executor.map(lambda _d: _downloadExport(_d, path, journal, id_times, on_downloaded), _dl))
+    else:
+        _results = [_downloadExport(_d, path, journal, id_times, on_downloaded) for _d in _dl]
+
+    _pl = [_fp for _fp in _results if _fp is not None]
+
+    return _pl, len(_results) - len(_pl)
+
+
+'''
+    エクスポートの進捗を待ちながら、completedになった静止画から順にダウンロードする（パイプライン）
+
+        戻り値 : 正常に終了した時はTrue、進捗の取得に失敗した時はNone
+'''
+def _waitAndDownloadImages(api_key, token, device_id, exported_ids, deadline, path, download_workers, summary=None, journal=None, id_times=None,
+                           on_downloaded=None):
+    _futures = list()
+    if SH.POOL.maxsize < download_workers:
+        SH.configurePool(maxsize=download_workers)
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+
+        def _onCompleted(entries):
+            if journal is not None:
+                journal.setStatuses(entries)
+            _cacheExports(device_id, entries, id_times)
+            for _d in entries:
+                if _d.url is not None:
+                    _futures.append(executor.submit(_downloadExport, _d, path, journal, id_times, on_downloaded))
+
+        _l = waitSoraCamExportImages(api_key, token, device_id, exported_ids, deadline, _onCompleted)
+
+    _pl = [_f.result() for _f in _futures]
+    _df = _pl.count(None)
+    LOGGER.debug("Downloading images finished : %d frames. Failed %d frames", len(_pl) - _df, _df)
+    _addSummary(summary, 'downloaded', len(_pl) - _df)
+    _addSummary(summary, 'download_failed', _df)
+
+    if not isinstance(_l, list):
+        LOGGER.error("静止画のエクスポートの進捗処理（waitSoraCamExportImages）が正常に終了しませんでした。")
+        return None
+    if journal is not None:
+        journal.setStatuses(_l)
+    _addSummary(summary, 'export_failed', len([_d for _d in _l if _d.status != 'completed']))
+
+    return True
+
 
 '''
     開始終了時間と間隔を指定して、動画から静止画をダウンロードする。
@@ -385,83 +692,142 @@ def waitSoraCamExportImages(api_key, token, device_id, exported_ids, MAX_ATTEMPT
         ed_time : 終了時間(datetime型)
         interval : 静止画を抽出する間隔（sec）
         path: 静止画のダウンロード先
+        concurrency : エクスポート依頼の同時実行数
+        download_workers : 静止画ダウンロードの同時実行数
+        pipeline : Trueの時はエクスポートの完了を待たずに、completedになった静止画からダウンロードする
+        summary : 件数を集計するdict（events, planned, resumed, stored, cached, exported, export_failed, downloaded, download_failed, skipped）
+        journal : SJ.Journal。指定した時は進捗を記録し、記録済みのエクスポート・ダウンロードを飛ばす
+        times : エクスポートする時刻（unixtime 13桁）の並び（listまたはarray('q')）。指定した時はintervalから時刻を作らない（SP.fitPlanの計画）
+        budget : 残りフレーム数を持つdict（remainingFrames）。指定した時はexport usageを取得せずに使い、依頼した分を引く
+        on_downloaded : ダウンロードしたファイルパスを受け取る関数（SPP.PostProcessor.submitなど）
 '''
-def downloadImages(api_key, token, device_id, st_time, ed_time, interval, path):
+def downloadImages(api_key, token, device_id, st_time, ed_time, interval, path, concurrency=1, download_workers=1, pipeline=False, summary=None, journal=None,
+                   times=None, budget=None, on_downloaded=None):
 #    LOGGER.debug(st_time)
 #    LOGGER.debug(ed_time)
 #    LOGGER.debug(interval)
     
-    _st = SU.getUnixtime(st_time)
-    _ed = SU.getUnixtime(ed_time)
-    _it = int(interval*1000)
-
-    # ダウンロード間隔の作成
-    _trange = int(_ed - _st)
-    if _trange > int(_it):
-        _q = int(_trange / int(_it))
-#        LOGGER.debug(_q)
-        _rl = [ ( _st + x * int(_it)) for x in range(_q + 1)]
-#        LOGGER.debug(_rl)
-        _rl.append(_ed)
+    # ダウンロード間隔の作成（終了時刻がグリッドに乗る時も重複させない）
+    # 時刻はarray('q')のまま扱い、datetimeにするのはログを出す時だけ
+    if times is None:
+        _rl = SP.planTimes(SU.getUnixtime(st_time), SU.getUnixtime(ed_time), int(interval*1000))
     else:
-        _rl = [ _st, _ed ]
-    LOGGER.debug('Exporting times at :')
-    LOGGER.debug(_rl)
+        _rl = SP.asTimes(times)
+    if len(_rl) > 0:
+        LOGGER.debug('Exporting times : %s - %s', SU.LazyDateTime(_rl[0]), SU.LazyDateTime(_rl[-1]))
 
     _cnt = len(_rl)
-    LOGGER.debug("Estimate Num. of Frames : {}".format(_cnt))
+    LOGGER.debug("Estimate Num. of Frames : %d", _cnt)
+    _addSummary(summary, 'planned', _cnt)
+
+    # ジャーナルに記録済みの時刻は、前回の実行の続きから処理する
+    # ダウンロード済みは飛ばし、依頼済みのエクスポートは進捗の確認だけにする
+    _pend = list()
+    _times = dict() # exportId -> 時刻（ファイル名に撮影時刻を付けるため）
+    if journal is not None:
+        journal.plan(device_id, _rl)
+        _fr = journal.frames(device_id, _rl)
+        _times.update((_fr[_t][0], _t) for _t in _rl if _fr[_t][1] in SJ.PENDING_STATUSES)
+        _pend = list(dict.fromkeys([_fr[_t][0] for _t in _rl if _fr[_t][1] in SJ.PENDING_STATUSES]))
+        _rs = len([_t for _t in _rl if _fr[_t][1] not in SJ.EXPORT_STATUSES])
+        if _rs > 0:
+            LOGGER.debug("Resumed from journal : %d frames. Pending exports %d", _rs, len(_pend))
+            _addSummary(summary, 'resumed', _rs)
+        _rl = [_t for _t in _rl if _fr[_t][1] in SJ.EXPORT_STATUSES]
+        _cnt = len(_rl)
+
+    # 保管庫にある時刻は、エクスポートせずに保管庫から取り出す（エクスポートの上限も使わない）
+    # 取り出せなかった時刻は、そのままエクスポートする
+    if FRAME_STORE is not None and _cnt > 0:
+        try:
+            _sf = FRAME_STORE.lookup(device_id, _rl)
+        except sqlite3.Error as err:
+            LOGGER.error('store lookup failed. {}'.format(err))
+            _sf = dict()
+        _ok = set()
+        for _t in _rl:
+            if _t not in _sf:
+                continue
+            try:
+                _fp = FRAME_STORE.extract(_sf[_t], os.path.join(path, frameSeq(_t) + '_' + _sf[_t]['name']))
+            except OSError as err:
+                LOGGER.error('store extract failed. {}. {}'.format(err, _sf[_t]['path']))
+                continue
+            _ok.add(_t)
+            if journal is not None and _sf[_t]['export_id'] is not None:
+                journal.setExported(device_id, [(_t, _sf[_t]['export_id'])])
+                journal.setDownloaded(_sf[_t]['export_id'], _fp)
+            if on_downloaded is not None:
+                on_downloaded(_fp)
+        if len(_ok) > 0:
+            LOGGER.debug("Extracted from frame store : %d frames", len(_ok))
+            _addSummary(summary, 'stored', len(_ok))
+            _rl = [_t for _t in _rl if _t not in _ok]
+            _cnt = len(_rl)
+
+    # URLの有効期限内のエクスポート結果がキャッシュにある時刻は、エクスポートせずにダウンロードする
+    if EXPORT_CACHE is not None and _cnt > 0:
+        _hc = EXPORT_CACHE.lookup(device_id, _rl)
+        if len(_hc) > 0:
+            _fl = _downloadCachedExports(device_id, _hc, path, download_workers, journal, _times, on_downloaded)
+            LOGGER.debug("Downloaded from export cache : %d frames", len(_hc) - len(_fl))
+            _addSummary(summary, 'cached', len(_hc) - len(_fl))
+            _fs = set(_fl)
+            _rl = [_t for _t in _rl if _t not in _hc or _t in _fs]
+            _cnt = len(_rl)
 
     # ダウンロード可能な静止画数の取得
-    MAX_ATTEMPT = 5
-    _js = getSoraCamExportUsage(api_key, token, device_id)
-    if _js is not None:
-        if "image" in _js:
-            if "remainingFrames" in _js["image"]:
-                LOGGER.debug("Remaining Num. of Frames : {}".format(_js["image"]["remainingFrames"]))
-                if _cnt > int(_js["image"]["remainingFrames"]):
-                    LOGGER.error("Remaining Frames Shortage. Stopped.")
-                    return None
-                else:
-                    # 静止画のエクスポート開始
-                    _n = 0
-                    _fl = 0
-                    _el = list()
-                    for _i in _rl:
-                        LOGGER.debug('\n')
-                        LOGGER.debug('try exporting. time:{}, {}'.format(_i, SU.getDateTimeFromUnixTime(_i).strftime('%Y-%m-%d %H:%M:%S')))
-                        # 静止画のエクスポート
-                        _wk = getSoraCamExportImages(api_key, token, device_id, _i, True)
-#                        LOGGER.debug(_wk)
-                        # 静止画のエクスポート処理が済んだらexportIdをリストに溜め込んで、進捗にうつる。
-                        # エラーの分は飛ばす。
-                        if isinstance(_wk, dict):
-                            if 'exportId' in _wk:
-                                _el.append(_wk['exportId'])
-                        else:
-                            _fl += 1
-                            LOGGER.error('Export failed. this might be because of 40x Error. device_id :{}, time : {}, {}'.format(device_id, _i, SU.getDateTimeFromUnixTime(_i).strftime('%Y%m%d %H%M%S')))
-                                
-                    LOGGER.debug("Exporting images initialized : {} frames. Failed {} frames".format(str(len(_el)), str(_fl)))
-
-                    if len(_el) > 0:
-                        # 静止画エクスポートの進捗　指数バックオフでMax_ATTEMPTまでトライする。
-                        _l = waitSoraCamExportImages(api_key, token, device_id, _el, MAX_ATTEMPT)
-                        if isinstance(_l, list):
-                            pass
-                        else:
-                            LOGGER.error("静止画のエクスポートの進捗処理（waitSoraCamExportImages）が正常に終了しませんでした。")
-                            return None
-
-                        # URLからデータをダウンロードする。
-                        if len(_l) > 0:
-                            for _d in _l:
-                                if 'url' in _d:
-                                    # ファイル名を整形してDL
-                                    SU.downloadImage(_d['url'], path)
-                        
-                        return True
+    _el = list()
+    if _cnt > 0:
+        if budget is not None and 'remainingFrames' in budget:
+            _rem = budget['remainingFrames']
+        else:
+            _rem = getRemainingFrames(api_key, token, device_id)
+            if _rem is None:
+                return None
+        if _cnt > _rem:
+            LOGGER.error("Remaining Frames Shortage. Stopped. planned {}, remaining {}".format(_cnt, _rem))
+            _addSummary(summary, 'skipped', _cnt)
+            return None
 
-    return None
+        # 静止画のエクスポート開始
+        _el, _fl = exportImages(api_key, token, device_id, _rl, concurrency, journal, _times)
+        if budget is not None:
+            budget['remainingFrames'] = _rem - len(_el)
+        LOGGER.debug("Exporting images initialized : %d frames. Failed %d frames", len(_el), _fl)
+        _addSummary(summary, 'exported', len(_el))
+        _addSummary(summary, 'export_failed', _fl)
+
+    # 前回の実行で依頼済みのエクスポートも一緒に待つ
+    _el = _pend + _el
+    if len(_el) == 0:
+        # 全部ダウンロード済みの時は正常終了
+        return True if _cnt == 0 else None
+
+    if pipeline:
+        # completedになったものから順にダウンロードする
+        return _waitAndDownloadImages(api_key, token, device_id, _el, EXPORT_DEADLINE, path, download_workers, summary, journal, _times, on_downloaded)
+
+    # 静止画エクスポートの進捗　完了しそうな時刻に合わせて、EXPORT_DEADLINEまで待つ。
+    _l = waitSoraCamExportImages(api_key, token, device_id, _el, EXPORT_DEADLINE)
+    if isinstance(_l, list):
+        pass
+    else:
+        LOGGER.error("静止画のエクスポートの進捗処理（waitSoraCamExportImages）が正常に終了しませんでした。")
+        return None
+    if journal is not None:
+        journal.setStatuses(_l)
+    _cacheExports(device_id, _l, _times)
+    _addSummary(summary, 'export_failed', len([_d for _d in _l if _d.status != 'completed']))
+
+    # URLからデータをダウンロードする。
+    if len(_l) > 0:
+        _pl, _df = _downloadExports(_l, path, download_workers, journal, _times, on_downloaded)
+        LOGGER.debug("Downloading images finished : %d frames. Failed %d frames", len(_pl), _df)
+        _addSummary(summary, 'downloaded', len(_pl))
+        _addSummary(summary, 'download_failed', _df)
+
+    return True
 
 
 '''
@@ -472,44 +838,309 @@ def downloadImages(api_key, token, device_id, st_time, ed_time, interval, path):
         ed_time : 終了時間(datetime型)
         interval : 何秒間隔で静止画をDLするか
         path: 静止画のダウンロード先
+        concurrency : エクスポート依頼の同時実行数
+        download_workers : 静止画ダウンロードの同時実行数
+        pipeline : Trueの時はエクスポートの完了を待たずに、completedになった静止画からダウンロードする
+        summary : 件数を集計するdict（events, planned, resumed, stored, cached, exported, export_failed, downloaded, download_failed, skipped）
+        journal : SJ.Journal。指定した時は進捗を記録し、記録済みのエクスポート・ダウンロードを飛ばす
+        strategy : 残りフレーム数に収まらない時の計画の立て方（SP.QUOTA_STRATEGIES）。
+                   Noneの時は区間を取得した順にエクスポートし、残りフレーム数が足りない区間は飛ばす
+        on_downloaded : ダウンロードしたファイルパスを受け取る関数（SPP.PostProcessor.submitなど）
+
+        戻り値 : 正常に終了した時はTrue。イベントの取得に失敗した時や、区間が1つも終わらなかった時（全部飛ばした時など）はNone
 '''
-def downloadEventImages(api_key, token, device_id, st_time, ed_time, interval, path):
+def downloadEventImages(api_key, token, device_id, st_time, ed_time, interval, path, concurrency=1, download_workers=1, pipeline=False, summary=None, journal=None,
+                        strategy=None, on_downloaded=None):
     _st = SU.getUnixtime(st_time)
     _ed = SU.getUnixtime(ed_time)
 
     # イベントの抽出
+    # 録画が完了したモーション検知イベントの区間（unixtime 13桁）
     _cnt = 0
-    _rv = listSoraCamEventsForDevice(api_key, token, device_id, _st, _ed)
-#    LOGGER.debug(json.dumps(_rv))
-    if isinstance(_rv, list):
-        if len(_rv) > 0:
-            for _ts in _rv:
-                if 'eventInfo' in _ts:
-                    if 'atomEventV1' in _ts['eventInfo']:
-                        if _ts['eventInfo']['atomEventV1']['type'] == 'motion' and _ts['eventInfo']['atomEventV1']['recordingStatus'] == 'completed':
-                            _stt = _ts['eventInfo']['atomEventV1']['startTime']
-                            _ett = _ts['eventInfo']['atomEventV1']['endTime']
-                            _cnt += 1
-                            _st = SU.getDateTimeFromUnixTime(_stt)
-                            _ed = SU.getDateTimeFromUnixTime(_ett)
-                            LOGGER.debug('\n')
-                            LOGGER.debug('Exporting images Started. No.{}'.format(_cnt))
-                            LOGGER.debug('recorderd startTime : {} sec, {}'.format(_st, _stt))
-                            LOGGER.debug('recorderd endTime : {} sec, {}'.format(_ed, _ett))
-                            # ダウンロード間隔の調整
-                            _tl = (float(_ett) - float(_stt))/1000 # sec
-                            LOGGER.debug('recorderd time : {} sec'.format(_tl))
-                            LOGGER.debug('interval time : {} sec'.format(interval))
-                            downloadImages(api_key, token, device_id, _st, _ed, interval, path)
-        
-    else:
+    def _events():
+        nonlocal _cnt
+        for _ev in iterSoraCamEventsForDevice(api_key, token, device_id, _st, _ed):
+            if _ev.isCompletedMotion():
+                _cnt += 1
+                _addSummary(summary, 'events', 1)
+                yield _ev.start_time, _ev.end_time
+
+    # 重なる・続いているイベントは1つの区間にまとめて、同じ時刻を二度エクスポートしないようにする
+    # 残りフレーム数は最初に1回だけ取得して、区間ごとに使った分を引いていく
+    _wc = 0
+    _ok = 0         # 正常に終わった区間の数
+    _budget = dict()
+
+    def _download(_stt, _ett, times=None):
+        nonlocal _wc, _ok
+        _wc += 1
+        _st = SU.getDateTimeFromUnixTime(_stt)
+        _ed = SU.getDateTimeFromUnixTime(_ett)
+        LOGGER.debug('\n')
+        LOGGER.debug('Exporting images Started. No.%d (events so far %d)', _wc, _cnt)
+        LOGGER.debug('recorderd startTime : %s sec, %s', _st, _stt)
+        LOGGER.debug('recorderd endTime : %s sec, %s', _ed, _ett)
+        # ダウンロード間隔の調整
+        _tl = (float(_ett) - float(_stt))/1000 # sec
+        LOGGER.debug('recorderd time : %s sec', _tl)
+        LOGGER.debug('interval time : %s sec', interval)
+        if downloadImages(api_key, token, device_id, _st, _ed, interval, path, concurrency, download_workers, pipeline, summary, journal, times, _budget, on_downloaded):
+            _ok += 1
+
+    try:
+        if strategy is None:
+            # ページ単位に取得しながら、まとまった区間から順にエクスポートする
+            for _stt, _ett in SP.iterMergedIntervals(_events()):
+                if 'remainingFrames' not in _budget:
+                    _rem = getRemainingFrames(api_key, token, device_id)
+                    if _rem is None:
+                        return None
+                    _budget['remainingFrames'] = _rem
+                _download(_stt, _ett)
+        else:
+            # 全イベントの区間を取得してから、残りフレーム数に収まる計画を立てる
+            _windows = list(SP.iterMergedIntervals(_events()))
+            if len(_windows) > 0:
+                _rem = getRemainingFrames(api_key, token, device_id)
+                if _rem is None:
+                    return None
+                _budget['remainingFrames'] = _rem
+                _plan, _rp = SP.fitPlan(_windows, int(interval*1000), _rem, strategy)
+                logPlan(device_id, _rp)
+                _addSummary(summary, 'skipped', _rp['demand'] - _rp['frames'])
+                if _rp['demand'] > 0 and _rp['frames'] == 0:
+                    LOGGER.warning('{}: 残りフレーム数が無いため、静止画をエクスポートできませんでした。demand {}'.format(device_id, _rp['demand']))
+                    return None
+                for _stt, _ett, _tl in _plan:
+                    _download(_stt, _ett, _tl)
+
+    except (urllib.error.HTTPError, urllib.error.URLError) as err:
+        LOGGER.error('{}: イベントの取得に失敗しました。{}'.format(device_id, err))
         LOGGER.warning('イベントが抽出されませんでした。device: {}, {}-{}'.format(device_id, st_time.strftime('%Y%m%d %H%M%S'), ed_time.strftime('%Y%m%d %H%M%S')))
         return None
-    
+
+    # 区間はあったのに1つも終わらなかった（全部残りフレーム数が足りずに飛ばした、など）時は失敗にする
+    if _wc > 0 and _ok == 0:
+        LOGGER.warning('{}: {}区間とも静止画をダウンロードできませんでした（残りフレーム数の不足など）。'.format(device_id, _wc))
+        return None
+
     return True
 
 
 
+'''
+    device idのリストを作る
+
+        devices : カンマ区切りのdevice id
+        devices_file : 1行に1つdevice idを書いたファイル（空行と#から始まる行は無視）
+
+        戻り値 : 重複を除いたdevice idのリスト（指定順）
+'''
+def readDeviceIds(devices='', devices_file=''):
+    _dl = [_d.strip() for _d in devices.split(',')]
+    if len(devices_file) > 0:
+        with open(devices_file, 'r', encoding='utf-8') as f:
+            for _l in f:
+                if not _l.strip().startswith('#'):
+                    _dl.extend([_d.strip() for _d in _l.split(',')])
+
+    return list(dict.fromkeys([_d for _d in _dl if len(_d) > 0]))
+
+
+'''
+    複数のデバイスのイベント画像を並列にダウンロードする。
+
+        device_ids : カメラのdevice idのリスト
+        path : 静止画のダウンロード先。デバイスごとに path/<device id> にダウンロードする
+        max_devices : 同時に処理するデバイス数
+        journal : SJ.Journal（全デバイスで共有する）
+        resume : Trueの時はデバイスごとのディレクトリを消さずに続きから処理する
+        strategy : 残りフレーム数に収まらない時の計画の立て方（デバイスごと）
+        on_downloaded : ダウンロードしたファイルパスを受け取る関数（全デバイスで共有する）
+        その他の引数はdownloadEventImagesと同じ（concurrency, download_workersはデバイスごとの上限）
+
+        戻り値 : device id -> 集計（dict）。集計のresultはdownloadEventImagesの戻り値
+'''
+def downloadDevicesEventImages(api_key, token, device_ids, st_time, ed_time, interval, path,
+                               concurrency=1, download_workers=1, pipeline=False, max_devices=1, journal=None, resume=False, strategy=None,
+                               on_downloaded=None):
+
+    def _download(device_id):
+        _dp = os.path.join(path, device_id)
+        if resume:
+            os.makedirs(_dp, exist_ok=True)
+        else:
+            SU.clearDir(_dp)
+        _sm = dict()
+        _sm['result'] = downloadEventImages(api_key, token, device_id, st_time, ed_time, interval, _dp,
+                                            concurrency, download_workers, pipeline, _sm, journal, strategy, on_downloaded)
+        return _sm
+
+    # デバイスをまたいでkeep-alive接続を使い回せるようにする
+    _need = max_devices * max(concurrency, download_workers)
+    if SH.POOL.maxsize < _need:
+        SH.configurePool(maxsize=_need)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_devices)) as executor:
+        _results = list(executor.map(_download, device_ids))
+
+    return dict(zip(device_ids, _results))
+
+
+'''
+    watchモード：新しいイベントだけを取得して、録画が完了したものから順にエクスポートする
+
+        device_id : カメラのdevice id
+        cursor : イベントを取得する開始時刻（unixtime 13桁。前回までに処理したイベントの次）
+        interval : 何秒間隔で静止画をDLするか（時刻はunixtimeの0からのinterval刻みに揃える。SP.alignedTimes）
+        summary : 件数を集計するdict（events, recording, retrying, planned, resumed, exported, ...）
+        journal : SJ.Journal（必須。同じ時刻を二度エクスポートしない）
+
+        戻り値 : 次に取得を始める時刻（cursor）。イベントの取得に失敗した時はNone
+
+    録画中（recordingStatusがrecording）のイベントがあれば、次はそのイベントから取得し直す。
+    ただし WATCH_MAX_RECORDING 秒より前に始まったイベントは待たない。
+    終わらなかった区間（残りフレーム不足、エクスポート・ダウンロードの失敗、EXPORT_DEADLINE切れ）も、
+    次はその区間から取得し直す（終わった時刻はジャーナルで飛ばされる）。WATCH_MAX_RETRY 秒より前に始まった区間は諦める。
+
+'''
+def pollEventImages(api_key, token, device_id, cursor, interval, path, concurrency=1, download_workers=1, pipeline=False, summary=None, journal=None,
+                    on_downloaded=None):
+    _now = int(time.time() * 1000)
+    _hold = None    # まだ録画中のイベントのうち、いちばん早いstartTime
+    _last = None    # 取得したイベントのうち、いちばん遅いstartTime
+    _windows = list()
+
+    try:
+        for _ev in iterSoraCamEventsForDevice(api_key, token, device_id, cursor, _now):
+            if _ev.type != 'motion':
+                continue
+            _stt = _ev.start_time
+            _last = _stt if _last is None else max(_last, _stt)
+            if _ev.recording_status == 'completed':
+                _addSummary(summary, 'events', 1)
+                _windows.append((_stt, _ev.end_time))
+            elif _ev.recording_status == 'recording' and _now - _stt < WATCH_MAX_RECORDING * 1000:
+                _addSummary(summary, 'recording', 1)
+                _hold = _stt if _hold is None else min(_hold, _stt)
+    except (urllib.error.HTTPError, urllib.error.URLError) as err:
+        LOGGER.error('{}: イベントの取得に失敗しました。{}'.format(device_id, err))
+        return None
+
+    # 録画が完了したイベントを区間にまとめ、時計に揃った時刻でエクスポートする
+    # 前回のポーリングで処理済みの時刻は、ジャーナルで飛ばされる
+    _budget = dict()
+    for _stt, _ett in SP.mergeIntervals(_windows):
+        LOGGER.info('%s: new event %s - %s', device_id, SU.LazyDateTime(_stt), SU.LazyDateTime(_ett))
+        _ws = dict()
+        _rt = downloadImages(api_key, token, device_id, None, None, interval, path, concurrency, download_workers, pipeline, _ws, journal,
+                             SP.alignedTimes(_stt, _ett, int(interval*1000)), _budget, on_downloaded)
+        _mergeSummary(summary, _ws)
+        if _rt is True and _ws.get('export_failed', 0) == 0 and _ws.get('download_failed', 0) == 0:
+            continue
+        # 終わらなかった区間は、次のポーリングでやり直す
+        if _now - _stt < WATCH_MAX_RETRY * 1000:
+            LOGGER.warning('%s: event %s - %s did not finish. retry on next poll', device_id, SU.LazyDateTime(_stt), SU.LazyDateTime(_ett))
+            _addSummary(summary, 'retrying', 1)
+            _hold = _stt if _hold is None else min(_hold, _stt)
+        else:
+            LOGGER.error('%s: event %s - %s did not finish. given up', device_id, SU.LazyDateTime(_stt), SU.LazyDateTime(_ett))
+
+    if _hold is not None:
+        return _hold
+    if _last is not None:
+        return _last + 1
+
+    return cursor
+
+
+'''
+    watchモード：止めるまで（またはpolls回）、poll_interval秒ごとに全デバイスの新しいイベントを処理する
+
+        device_ids : カメラのdevice idのリスト
+        path : 静止画のダウンロード先。複数デバイスの時は path/<device id>
+        journal : SJ.Journal。デバイスごとのcursorを記録するので、再起動しても続きから処理する
+        lookback : cursorの記録が無いデバイスは、何秒前からのイベントを処理するか
+        poll_interval : 新しいイベントを確認する間隔（sec）
+        polls : 確認する回数。Noneの時は止めるまで
+        stop : threading.Event。setすると次の確認の前に終わる
+
+        戻り値 : デバイスごとの集計 {device_id: summary}。resultは最後のポーリングで全区間が終わった時にTrue
+
+'''
+def watchEventImages(api_key, token, device_ids, interval, path, concurrency=1, download_workers=1, pipeline=False, journal=None,
+                     lookback=WATCH_LOOKBACK, poll_interval=WATCH_POLL_INTERVAL, polls=None, stop=None, on_downloaded=None):
+    _stop = stop if stop is not None else threading.Event()
+    _sms = {_dev: dict() for _dev in device_ids}
+    _results = {_dev: None for _dev in device_ids}
+    _cursors = dict()
+    for _dev in device_ids:
+        _c = journal.cursor(_dev)
+        _cursors[_dev] = _c if _c is not None else int((time.time() - lookback) * 1000)
+        LOGGER.info('watch : %s from %s', _dev, SU.LazyDateTime(_cursors[_dev]))
+        os.makedirs(_watchPath(path, _dev, device_ids), exist_ok=True)
+
+    def _poll(device_id):
+        _ps = dict()
+        _c = pollEventImages(api_key, token, device_id, _cursors[device_id], interval, _watchPath(path, device_id, device_ids),
+                             concurrency, download_workers, pipeline, _ps, journal, on_downloaded)
+        _mergeSummary(_sms[device_id], _ps)
+        _results[device_id] = True if _c is not None and _ps.get('retrying', 0) == 0 else None
+        if _c is not None and _c != _cursors[device_id]:
+            _cursors[device_id] = _c
+            journal.setCursor(device_id, _c)
+        return _c
+
+    _n = 0
+    with ThreadPoolExecutor(max_workers=max(1, len(device_ids))) as executor:
+        try:
+            while not _stop.is_set():
+                _st = time.time()
+                list(executor.map(_poll, device_ids))
+                _n += 1
+                if polls is not None and _n >= polls:
+                    break
+                _stop.wait(max(0.0, poll_interval - (time.time() - _st)))
+        except KeyboardInterrupt:
+            # 処理中のデバイスは終わるまで待つ（cursorは処理し終えた分まで記録済み）
+            LOGGER.info('watch stopped.')
+
+    for _dev in device_ids:
+        _sms[_dev]['result'] = _results[_dev]
+
+    return _sms
+
+
+# watchモードの静止画のダウンロード先（複数デバイスの時はデバイスごと）
+def _watchPath(path, device_id, device_ids):
+    return os.path.join(path, device_id) if len(device_ids) > 1 else path
+
+
+'''
+    エクスポートの計画（SP.fitPlanの報告）をログに出す
+
+'''
+def logPlan(device_id, report):
+    LOGGER.info('plan : {}, strategy {}, remaining {}, demand {}, frames {}, interval {} sec, windows {}, dropped {}'.format(
+        device_id, report['strategy'], report['budget'], report['demand'], report['frames'],
+        report['interval'] / 1000, report['windows'], report['dropped']))
+
+    return None
+
+
+'''
+    デバイスごとの集計をログに出す
+
+'''
+def logSummary(summaries):
+    _keys = ['events', 'planned', 'resumed', 'stored', 'cached', 'exported', 'export_failed', 'downloaded', 'download_failed', 'skipped']
+    LOGGER.info('summary : device_id, result, {}'.format(', '.join(_keys)))
+    for _dev, _sm in summaries.items():
+        LOGGER.info('summary : {}, {}, {}'.format(_dev, 'OK' if _sm.get('result') else 'NG', ', '.join([str(_sm.get(_k, 0)) for _k in _keys])))
+
+    return None
+
+
 '''
 	main
 
@@ -522,6 +1153,18 @@ if __name__ == "__main__":
             description='Create Time Lasp Video from Soracom Cam Recorded Video')
     parser.add_argument('--device', default='',
                         help='device id')
+    parser.add_argument('--devices', default='',
+                        help='複数のdevice id（カンマ区切り）')
+    parser.add_argument('--devices-file', default='',
+                        help='device idを1行に1つ書いたファイル')
+    parser.add_argument('--max-devices', default=4, type=int,
+                        help='同時に処理するデバイス数')
+    parser.add_argument('--max-inflight', default=0, type=int,
+                        help='全デバイス合計で同時に送るAPIリクエスト数の上限（0は無制限）')
+    parser.add_argument('--rate-limit', default=0.0, type=float,
+                        help='全デバイス合計のAPIリクエスト数の上限（毎秒。0は無制限）')
+    parser.add_argument('--rate-limit-endpoint', action='append', default=list(),
+                        help='endpointごとの上限 "パターン=毎秒の数[:まとめて送れる数]"（例 "POST */images/exports=2:5"）')
     parser.add_argument('--dir', default='tmp',
                         help='作業ディレクトリ')
     parser.add_argument('--start', default="", 
@@ -530,12 +1173,106 @@ if __name__ == "__main__":
                     help='ダウンロード終了時間')
     parser.add_argument('--interval', default=60.0, type=float,
                     help='何秒間隔で静止画を抽出するか')
+    parser.add_argument('--concurrency', default=4, type=int,
+                    help='静止画のエクスポートを同時に何件依頼するか')
+    parser.add_argument('--download-workers', default=4, type=int,
+                    help='静止画を同時に何件ダウンロードするか')
+    parser.add_argument('--pipeline', action='store_true',
+                    help='エクスポートが完了した静止画から順にダウンロードする')
+    parser.add_argument('--quota-strategy', default=None, choices=SP.QUOTA_STRATEGIES,
+                    help='残りフレーム数が足りない時の計画（widen : インターバルを広げる、proportional : イベントの長さに比例して配る）')
+    parser.add_argument('--timelapse', action='store_true',
+                    help='ダウンロードした静止画からタイムラプス動画を作る（ffmpegが必要）')
+    parser.add_argument('--fps', default=ST.DEFAULT_FPS, type=int,
+                    help='タイムラプス動画のフレームレート')
+    parser.add_argument('--maxwidth', default=ST.DEFAULT_MAXWIDTH, type=int,
+                    help='タイムラプス動画の解像度（横幅）の最大値')
+    parser.add_argument('--postprocess', action='store_true',
+                    help='ダウンロードした静止画をmaxwidthに縮小・再圧縮する（Pillowが必要）')
+    parser.add_argument('--image-format', default='jpeg', choices=SPP.IMAGE_FORMATS,
+                    help='後処理で保存する形式')
+    parser.add_argument('--quality', default=SPP.DEFAULT_QUALITY, type=int,
+                    help='後処理の圧縮品質（1-100）')
+    parser.add_argument('--postprocess-workers', default=0, type=int,
+                    help='後処理のプロセス数（0はCPUコア数）')
+    parser.add_argument('--metrics', default='',
+                    help='終了時にメトリクスを書き出すファイル')
+    parser.add_argument('--metrics-format', default='json', choices=SM.METRICS_FORMATS,
+                    help='メトリクスの形式')
+    parser.add_argument('--log-level', default=None, choices=list(LU.LEVELS),
+                    help='ログのレベル（省略時は環境変数{}、無ければdebug）'.format(LU.ENV_LOG_LEVEL))
+    parser.add_argument('--log-async', action='store_true',
+                    help='ログの書き出しを別スレッドで行う（環境変数{}=1と同じ）'.format(LU.ENV_LOG_ASYNC))
+    parser.add_argument('--resume', action='store_true',
+                    help='前回の実行の続きから処理する（エクスポート・ダウンロード済みの静止画を飛ばす）')
+    parser.add_argument('--watch', action='store_true',
+                    help='新しいイベントを監視し、録画が完了したものから順にエクスポートする（Ctrl-Cで終了）')
+    parser.add_argument('--poll-interval', default=WATCH_POLL_INTERVAL, type=float,
+                    help='watchで新しいイベントを確認する間隔（sec）')
+    parser.add_argument('--lookback', default=WATCH_LOOKBACK, type=float,
+                    help='watchで初めて監視するデバイスは、何秒前からのイベントを処理するか')
+    parser.add_argument('--export-deadline', default=SE.EXPORT_WAIT_DEADLINE, type=float,
+                    help='エクスポートの完了を待つ時間の上限（sec）')
+    parser.add_argument('--export-timing', default=SE.EXPORT_TIMING_PATH,
+                    help='エクスポートの完了時間の見積もりを保存するファイル（空文字で保存しない）')
+    parser.add_argument('--export-cache', nargs='?', default='', const=SC.EXPORT_CACHE_PATH,
+                    help='エクスポート結果のキャッシュを使う（パス省略時は {}）'.format(SC.EXPORT_CACHE_PATH))
+    parser.add_argument('--store', default='',
+                    help='静止画の保管庫のディレクトリ（作業ディレクトリの外に置く）')
+    parser.add_argument('--token-cache', nargs='?', default='', const=SA.TOKEN_CACHE_PATH,
+                    help='APIトークンをキャッシュして使い回す（パス省略時は {}）'.format(SA.TOKEN_CACHE_PATH))
+    parser.add_argument('--revoke', action='store_true',
+                    help='終了時にキャッシュしたAPIトークンを無効化する')
 
     args = parser.parse_args()
 
+    if len(SORACOM_AUTH_KEY_ID) == 0 or len(SORACOM_AUTH_KEY) == 0:
+        LOGGER.error("No SORACOM_AUTH_KEY_ID / SORACOM_AUTH_KEY")
+        sys.exit()
+
+    # ログのレベルと非同期モード
+    if args.log_level is not None:
+        LU.setLevel(args.log_level)
+    if args.log_async:
+        LU.startQueueListener()
+
+    # APIのレート制限（認証を含め、全てのリクエストで共有する）
+    if args.rate_limit > 0:
+        SH.configureRateLimit(args.rate_limit)
+    for _spec in args.rate_limit_endpoint:
+        try:
+            _pat, _rate, _burst = SR.parseRateSpec(_spec)
+        except ValueError as err:
+            LOGGER.error(err)
+            sys.exit()
+        SH.configureRateLimit(_rate, _burst, _pat)
+
+    # エクスポートの完了時間は前回までの見積もりから始め、終了時に保存する
+    EXPORT_DEADLINE = args.export_deadline
+    if len(args.export_timing) > 0:
+        EXPORT_TIMING.path = args.export_timing
+        if EXPORT_TIMING.load():
+            LOGGER.debug('export timing : expected %.2f sec (%d samples)', EXPORT_TIMING.mean, EXPORT_TIMING.samples)
+        atexit.register(EXPORT_TIMING.save)
+
+    # エクスポート結果のキャッシュ（有効期限の切れたURLは開く時に消す）
+    if len(args.export_cache) > 0:
+        EXPORT_CACHE = SC.openExportCache(args.export_cache)
+        atexit.register(EXPORT_CACHE.close)
+
+    # 静止画の保管庫（作業ディレクトリと違って実行のたびに消さない）
+    if len(args.store) > 0:
+        FRAME_STORE = SF.openFrameStore(os.path.join(os.getcwd(), args.store))
+        atexit.register(FRAME_STORE.close)
+
+    # 途中で終了してもメトリクスを書き出す
+    if len(args.metrics) > 0:
+        atexit.register(SM.dump, args.metrics, args.metrics_format)
+
     ### パラメータのチェック
     #  デバイスidが引数として渡されているか
-    if len(args.device) == 0:
+    _devices = readDeviceIds(args.devices, args.devices_file)
+    if len(args.device) == 0 and len(_devices) == 0:
         LOGGER.error("No deviceid")
         sys.exit()
 
@@ -581,8 +1318,13 @@ if __name__ == "__main__":
     dpath = os.path.join(os.getcwd(), args.dir)
 
     # accessトークンの取得
-    url = 'https://api.soracom.io/v1/auth'
-    akey, token, oid, unm = SA.getToken(url, SORACOM_AUTH_KEY_ID, SORACOM_AUTH_KEY)
+    url = SA.authUrl()
+    if args.token_cache:
+        # キャッシュしたトークンを使い回す（401の時は自動で取り直す）
+        _tk = SA.getCachedToken(url, SORACOM_AUTH_KEY_ID, SORACOM_AUTH_KEY, args.token_cache)
+    else:
+        _tk = SA.getToken(url, SORACOM_AUTH_KEY_ID, SORACOM_AUTH_KEY)
+    akey, token, oid, unm = _tk if _tk is not None else (None, None, None, None)
 #    if not token == None:
 #        LOGGER.debug(akey)
 #        LOGGER.debug(oid)
@@ -592,18 +1334,104 @@ if __name__ == "__main__":
 #        LOGGER.debug("no token")
 
     if not token == None:
-        # 静止画を作業ディレクトリにダウンロードする
-        SU.clearDir(dpath)
-        _rd = downloadEventImages(akey, token, args.device, st_time, ed_time, interval, dpath)
-
-        if _rd:
-            pass
+        if args.max_inflight > 0:
+            SH.configurePool(max_inflight=args.max_inflight)
+
+        # ダウンロードと並行して、ダウンロードが済んだ静止画から縮小・再圧縮する
+        _pp = None
+        if args.postprocess:
+            _pp = SPP.createPostProcessor(args.maxwidth, args.image_format, args.quality,
+                                          args.postprocess_workers if args.postprocess_workers > 0 else None)
+        _od = _pp.submit if _pp is not None else None
+        _pps = None
+
+        # 後処理でファイル名が変わった静止画（webp）はジャーナルも付け替える
+        # ジャーナルを閉じる前に後処理を終わらせる
+        def _attachJournal(journal):
+            if _pp is not None:
+                _pp.on_processed = journal.setFile
+
+        def _closePostProcessor():
+            return _pp.close() if _pp is not None else None
+
+        if args.watch:
+            # 新しいイベントを監視する。トークンの期限が切れたら取り直す
+            if not args.token_cache:
+                def _refresh(api_key, token):
+                    _rt = SA.getToken(url, SORACOM_AUTH_KEY_ID, SORACOM_AUTH_KEY)
+                    return _rt[:2] if _rt is not None else None
+                SH.setTokenRefresher(_refresh)
+            if len(args.device) > 0 and args.device not in _devices:
+                _devices.insert(0, args.device)
+            os.makedirs(dpath, exist_ok=True)
+            with SJ.openJournal(dpath) as _jn:
+                _attachJournal(_jn)
+                _sms = watchEventImages(akey, token, _devices, interval, dpath, max(1, args.concurrency), max(1, args.download_workers),
+                                        args.pipeline, _jn, args.lookback, args.poll_interval, None, None, _od)
+                _pps = _closePostProcessor()
+            logSummary(_sms)
+        elif len(_devices) > 0:
+            # 複数デバイス：1つのトークンと接続プールを共有して並列に処理する
+            if len(args.device) > 0 and args.device not in _devices:
+                _devices.insert(0, args.device)
+            os.makedirs(dpath, exist_ok=True)
+            with SJ.openJournal(dpath, reset=not args.resume) as _jn:
+                _attachJournal(_jn)
+                _sms = downloadDevicesEventImages(akey, token, _devices, st_time, ed_time, interval, dpath,
+                                                  max(1, args.concurrency), max(1, args.download_workers), args.pipeline, max(1, args.max_devices),
+                                                  _jn, args.resume, args.quota_strategy, _od)
+                _pps = _closePostProcessor()
+            for _dev, _sm in _sms.items():
+                if not _sm['result']:
+                    LOGGER.warning('{}のイベント画像のダウンロードが０件でした。'.format(_dev))
+            logSummary(_sms)
         else:
-            LOGGER.warning('{}のイベント画像のダウンロードが０件でした。'.format(args.device))
+            # 静止画を作業ディレクトリにダウンロードする
+            # --resumeの時は前回ダウンロードした静止画とジャーナルを残す
+            if args.resume:
+                os.makedirs(dpath, exist_ok=True)
+            else:
+                SU.clearDir(dpath)
+            _sm = dict()
+            with SJ.openJournal(dpath) as _jn:
+                _attachJournal(_jn)
+                _rd = downloadEventImages(akey, token, args.device, st_time, ed_time, interval, dpath, max(1, args.concurrency), max(1, args.download_workers), args.pipeline, _sm, _jn, args.quota_strategy, _od)
+                _pps = _closePostProcessor()
+
+            if _rd:
+                pass
+            else:
+                LOGGER.warning('{}のイベント画像のダウンロードが０件でした。'.format(args.device))
+            _sm['result'] = _rd
+            logSummary({args.device: _sm})
+
+        if EXPORT_CACHE is not None:
+            _cs = EXPORT_CACHE.stats()
+            LOGGER.info('export cache : hits {}, misses {}, hit rate {:.1%}, entries {}'.format(_cs['hits'], _cs['misses'], _cs['hit_rate'], _cs['entries']))
+
+        if _pps is not None:
+            SPP.logStats(_pps)
         
         # apiキーとトークンの無効化
-        SA.revokeToken(akey, token)
-        LOGGER.debug("token was revoked.")
+        # トークンキャッシュを使う時は、--revokeを指定した時だけ無効化する
+        if not args.token_cache or args.revoke:
+            akey, token = SH.renewedCredentials(akey, token)
+            SA.revokeToken(akey, token)
+            if args.token_cache:
+                SA.clearTokenCache(args.token_cache)
+            LOGGER.debug("token was revoked.")
+
+        # タイムラプス動画の作成（デバイスごと）
+        if args.timelapse:
+            if args.watch:
+                # watchモードは1台の時はdpathに直接ダウンロードしている
+                for _dev in _devices:
+                    ST.makeTimelapseFromDir(_watchPath(dpath, _dev, _devices), None, args.fps, args.maxwidth)
+            elif len(_devices) > 0:
+                for _dev in _devices:
+                    ST.makeTimelapseFromDir(os.path.join(dpath, _dev), None, args.fps, args.maxwidth)
+            else:
+                ST.makeTimelapseFromDir(dpath, None, args.fps, args.maxwidth)
 
     elapsed_time = time.time() - start_time
     LOGGER.info('script end')
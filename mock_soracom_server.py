@@ -0,0 +1,497 @@
+'''
+    SORACOM API（ソラカメ）のローカル代役サーバー
+
+    このリポジトリのスクリプトが使うエンドポイントだけを真似る。実機やAPIキーなしで動作確認・性能測定ができる。
+
+        POST /v1/auth                                         認証（apiKey, tokenを返す）
+        POST /v1/auth/logout                                  トークンの無効化
+        GET  /v1/sora_cam/devices/{device_id}/events          イベント一覧（x-soracom-next-keyでページング）
+        POST /v1/sora_cam/devices/{device_id}/images/exports  静止画のエクスポート開始
+        GET  /v1/sora_cam/devices/images/exports              エクスポートの進捗（processing / completed / failed）
+        GET  /v1/sora_cam/devices/{device_id}/exports/usage   エクスポートの使用量（remainingFrames）
+        GET  /images/{export_id}.jpg                          エクスポートした静止画のダウンロードURL（Range: bytes=N- に対応）
+
+    引数：   port : 待ち受けポート（0は空いているポート）
+            latency : 1リクエストごとの応答遅延（sec）
+            error_rate : APIが500を返す確率（0.0 - 1.0。認証とダウンロードは除く）
+            export_delay : エクスポートがcompletedになるまでの時間（sec）
+            export_jitter : export_delayのばらつき（sec。0 - export_jitterの一様乱数を足す）
+            export_failure_rate : エクスポートがfailedになる確率
+            remaining_frames : 1デバイスあたりのエクスポート可能な残りフレーム数（デバイスごとに数える）
+            image_size : ダウンロードする静止画のサイズ（byte）
+            rate_limit : APIの1秒あたりの呼び出し回数の上限（超えると429とRetry-After。0で無制限。認証とダウンロードは除く）
+            download_cut_rate : 静止画のダウンロードがbodyの途中で切れる確率
+            events : 1デバイスあたりのモーションイベント数（--start から event_gap 秒ごと、長さ event_duration 秒）
+
+    （例）
+        python mock_soracom_server.py --port 8080 --latency 0.05 --export-delay 3 --events 20
+        SORACOM_API_ENDPOINT=http://localhost:8080 python export_sample.py --device 7C12345678AB ...
+
+'''
+import os, re
+import json
+import time
+import random
+import threading
+import uuid
+import argparse
+import urllib.parse
+
+from logging import getLogger
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import LogUtils as LU
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'info')
+
+
+'''
+    代役サーバーの状態（設定、エクスポート、イベント、統計）
+
+'''
+class MockState:
+    def __init__(self, latency=0.0, error_rate=0.0, export_delay=1.0, export_jitter=0.0,
+                 export_failure_rate=0.0, remaining_frames=100000, image_size=64 * 1024, rate_limit=0.0, download_cut_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.export_delay = export_delay
+        self.export_jitter = export_jitter
+        self.export_failure_rate = export_failure_rate
+        self.remaining_frames = remaining_frames
+        self.image_size = image_size
+        self.rate_limit = rate_limit
+        self.download_cut_rate = download_cut_rate
+
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.tokens = set()
+        self.exports = dict()         # exportId -> エクスポート
+        self.device_exports = dict()  # device_id -> exportIdのリスト（依頼順）
+        self.device_frames = dict()   # device_id -> 残りフレーム数（まだ依頼の無いデバイスはremaining_frames）
+        self.events = dict()          # device_id -> イベントのリスト（時刻順）。'*'は全デバイス共通
+        self.calls = dict()           # エンドポイント -> 呼び出し回数
+        self.inflight = 0
+        self.max_inflight = 0
+        self.throttled = 0
+        self._tokens = float(rate_limit)
+        self._refilled = time.monotonic()
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    '''
+        デバイスの残りフレーム数（exports/usageのremainingFrames）
+
+    '''
+    def remainingFrames(self, device_id):
+        with self.lock:
+            return self.device_frames.get(device_id, self.remaining_frames)
+
+    '''
+        残りフレーム数を設定する。device_idを省略した時は全デバイス
+
+    '''
+    def setRemainingFrames(self, frames, device_id=None):
+        with self.lock:
+            if device_id is None:
+                self.remaining_frames = frames
+                self.device_frames.clear()
+            else:
+                self.device_frames[device_id] = frames
+
+    '''
+        モーションイベントを追加する
+
+        device_id : '*' の時は全デバイス共通
+        start : 最初のイベントの開始時刻（unixtime 13桁）
+        duration : イベントの長さ（ミリ秒）
+        gap : イベントの開始間隔（ミリ秒）
+
+    '''
+    def addMotionEvents(self, device_id, start, count, duration=60 * 1000, gap=5 * 60 * 1000, recording_status='completed'):
+        _l = self.events.setdefault(device_id, list())
+        for _i in range(count):
+            _st = int(start + _i * gap)
+            _l.append({
+                'deviceId': device_id,
+                'time': _st,
+                'eventType': 'motion',
+                'eventInfo': {
+                    'atomEventV1': {
+                        'type': 'motion',
+                        'startTime': _st,
+                        'endTime': _st + int(duration),
+                        'recordingStatus': recording_status,
+                        }
+                    }
+                })
+        _l.sort(key=lambda _e: _e['time'])
+
+        return len(_l)
+
+    '''
+        rate_limitのトークンバケットから1件取る。超えている時は次に送れるまでの秒数（Retry-After）
+
+    '''
+    def throttle(self):
+        if self.rate_limit <= 0:
+            return None
+        with self.lock:
+            _now = time.monotonic()
+            self._tokens = min(float(self.rate_limit), self._tokens + (_now - self._refilled) * self.rate_limit)
+            self._refilled = _now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return None
+            self.throttled += 1
+
+            return (1.0 - self._tokens) / self.rate_limit
+
+    def reset(self):
+        with self.lock:
+            self.exports.clear()
+            self.device_exports.clear()
+            self.calls.clear()
+            self.max_inflight = 0
+            self.throttled = 0
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # ヘッダーとbodyを別々に書くので、Nagleで遅延しないようにする
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def handle_one_request(self):
+        with self.state.lock:
+            self.state.inflight += 1
+            self.state.max_inflight = max(self.state.max_inflight, self.state.inflight)
+        try:
+            super().handle_one_request()
+        finally:
+            with self.state.lock:
+                self.state.inflight -= 1
+
+    def _send(self, code, obj=None, headers=None, raw=None):
+        _body = raw if raw is not None else (json.dumps(obj).encode() if obj is not None else b'')
+        self.send_response(code)
+        if raw is None:
+            self.send_header('Content-Type', 'application/json')
+        for _k, _v in (headers or dict()).items():
+            self.send_header(_k, _v)
+        self.send_header('Content-Length', str(len(_body)))
+        self.end_headers()
+        self.wfile.write(_body)
+
+    def _readJson(self):
+        _n = int(self.headers.get('Content-Length') or 0)
+        _b = self.rfile.read(_n) if _n > 0 else b''
+        return json.loads(_b) if len(_b) > 0 else dict()
+
+    # 認証ヘッダーのチェック、レート制限とエラー率の適用。応答済みならTrue
+    def _reject(self, name):
+        if self.headers.get('X-Soracom-Token') not in self.state.tokens:
+            self._send(401, {'code': 'AUM0001', 'message': 'Invalid token'})
+            return True
+        _wait = self.state.throttle()
+        if _wait is not None:
+            self._send(429, {'code': 'COM0008', 'message': 'Too many requests ({})'.format(name)},
+                       headers={'Retry-After': '{:.3f}'.format(_wait)})
+            return True
+        if self.state.error_rate > 0 and self.state.random.random() < self.state.error_rate:
+            self._send(500, {'code': 'ERR0001', 'message': 'Injected error ({})'.format(name)})
+            return True
+
+        return False
+
+    def _baseUrl(self):
+        _host = self.headers.get('Host') or '{}:{}'.format(*self.server.server_address[:2])
+        return '{}://{}'.format(self.server.scheme, _host)
+
+    def do_POST(self):
+        time.sleep(self.state.latency)
+        _p = urllib.parse.urlsplit(self.path)
+        _seg = _p.path.strip('/').split('/')
+
+        if _p.path == '/v1/auth':
+            self.state.count('auth')
+            self._readJson()
+            _token = 'token-' + uuid.uuid4().hex
+            with self.state.lock:
+                self.state.tokens.add(_token)
+            return self._send(200, {'apiKey': 'api-' + uuid.uuid4().hex, 'token': _token,
+                                    'operatorId': 'OP0000000000', 'userName': 'mock'})
+
+        if _p.path == '/v1/auth/logout':
+            self.state.count('logout')
+            with self.state.lock:
+                self.state.tokens.discard(self.headers.get('X-Soracom-Token'))
+            return self._send(200)
+
+        # /v1/sora_cam/devices/{device_id}/images/exports
+        if len(_seg) == 6 and _seg[:3] == ['v1', 'sora_cam', 'devices'] and _seg[4:] == ['images', 'exports']:
+            self.state.count('exportImage')
+            # keep-alive接続なので、エラーを返す時もbodyは読み切る
+            _d = self._readJson()
+            if self._reject('exportImage'):
+                return None
+            _dev = _seg[3]
+            with self.state.lock:
+                _rem = self.state.device_frames.get(_dev, self.state.remaining_frames)
+                _limited = _rem <= 0
+                if not _limited:
+                    self.state.device_frames[_dev] = _rem - 1
+            if _limited:
+                return self._send(400, {'code': 'SCA0011', 'message': 'limit exceeded'})
+            with self.state.lock:
+                _eid = uuid.uuid4().hex
+                _delay = self.state.export_delay + self.state.random.uniform(0, self.state.export_jitter)
+                _failed = self.state.random.random() < self.state.export_failure_rate
+                self.state.exports[_eid] = {
+                    'exportId': _eid,
+                    'deviceId': _dev,
+                    'operatorId': 'OP0000000000',
+                    'time': _d.get('time'),
+                    'imageFilters': _d.get('imageFilters', list()),
+                    'requestedTime': int(time.time() * 1000),
+                    '_ready': time.time() + _delay,
+                    '_failed': _failed,
+                    }
+                self.state.device_exports.setdefault(_dev, list()).append(_eid)
+            return self._send(200, {'exportId': _eid, 'deviceId': _dev, 'status': 'initializing',
+                                    'requestedTime': int(time.time() * 1000)})
+
+        self._send(404, {'code': 'NOTFOUND'})
+
+    def do_GET(self):
+        time.sleep(self.state.latency)
+        _p = urllib.parse.urlsplit(self.path)
+        _q = dict(urllib.parse.parse_qsl(_p.query))
+        _seg = _p.path.strip('/').split('/')
+
+        # /images/{export_id}.jpg（署名付きURLの代わり。認証不要）
+        if len(_seg) == 2 and _seg[0] == 'images':
+            self.state.count('download')
+            _eid = _seg[1].split('.')[0]
+            if _eid not in self.state.exports:
+                return self._send(404, {'code': 'NOTFOUND'})
+            _body = (b'\xff\xd8' + _eid.encode() * (self.state.image_size // 32 + 1))[:self.state.image_size]
+            return self._sendImage(_eid, _body)
+
+        # /v1/sora_cam/devices/images/exports
+        if _p.path == '/v1/sora_cam/devices/images/exports':
+            self.state.count('listExports')
+            if self._reject('listExports'):
+                return None
+            return self._listExports(_q)
+
+        if len(_seg) == 5 and _seg[:3] == ['v1', 'sora_cam', 'devices']:
+            _dev = _seg[3]
+            # /v1/sora_cam/devices/{device_id}/events
+            if _seg[4] == 'events':
+                self.state.count('listEvents')
+                if self._reject('listEvents'):
+                    return None
+                return self._listEvents(_dev, _q)
+
+        # /v1/sora_cam/devices/{device_id}/exports/usage
+        if len(_seg) == 6 and _seg[:3] == ['v1', 'sora_cam', 'devices'] and _seg[4:] == ['exports', 'usage']:
+            self.state.count('exportUsage')
+            if self._reject('exportUsage'):
+                return None
+            return self._send(200, {'image': {'remainingFrames': self.state.remainingFrames(_seg[3]), 'limitFrames': 100000},
+                                    'video': {'remainingSeconds': 3600, 'limitSeconds': 3600}})
+
+        self._send(404, {'code': 'NOTFOUND'})
+
+    # 静止画を返す。Range（bytes=N-）に対応し、download_cut_rateの確率でbodyの途中で接続を切る
+    def _sendImage(self, export_id, body):
+        _headers = {'Content-Type': 'image/jpeg', 'ETag': '"{}"'.format(export_id), 'Accept-Ranges': 'bytes'}
+        _code, _start = 200, 0
+        _m = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+        if _m is not None and self.headers.get('If-Range') in (None, _headers['ETag']):
+            _start = int(_m.group(1))
+            if _start >= len(body):
+                return self._send(416, raw=b'', headers={'Content-Range': 'bytes */{}'.format(len(body))})
+            _code = 206
+            _headers['Content-Range'] = 'bytes {}-{}/{}'.format(_start, len(body) - 1, len(body))
+        _part = body[_start:]
+
+        if self.state.download_cut_rate > 0 and self.state.random.random() < self.state.download_cut_rate:
+            self.state.count('download_cut')
+            self.send_response(_code)
+            for _k, _v in _headers.items():
+                self.send_header(_k, _v)
+            self.send_header('Content-Length', str(len(_part)))
+            self.end_headers()
+            self.wfile.write(_part[:len(_part) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return None
+
+        return self._send(_code, raw=_part, headers=_headers)
+
+    # ページング：last_evaluated_keyは次ページの先頭の位置
+    def _page(self, items, q):
+        _start = int(q.get('last_evaluated_key', 0) or 0)
+        _limit = max(1, int(q.get('limit', 10) or 10))
+        _headers = dict()
+        if _start + _limit < len(items):
+            _headers['x-soracom-next-key'] = str(_start + _limit)
+        return items[_start:_start + _limit], _headers
+
+    def _listEvents(self, device_id, q):
+        _from = int(q.get('from', 0) or 0)
+        _to = int(q.get('to', 2 ** 62) or 2 ** 62)
+        _l = self.state.events.get(device_id, list()) + self.state.events.get('*', list())
+        _l = [dict(_e, deviceId=device_id) for _e in _l if _from <= _e['time'] <= _to]
+        _l.sort(key=lambda _e: _e['time'], reverse=(q.get('sort') == 'desc'))
+        _items, _headers = self._page(_l, q)
+        return self._send(200, _items, _headers)
+
+    def _listExports(self, q):
+        _dev = q.get('device_id')
+        _now = time.time()
+        _base = self._baseUrl()
+        with self.state.lock:
+            # 新しい順
+            _ids = list(reversed(self.state.device_exports.get(_dev, list())))
+            _exports = [self.state.exports[_id] for _id in _ids]
+        _items, _headers = self._page(_exports, q)
+
+        _out = list()
+        for _e in _items:
+            _d = {_k: _v for _k, _v in _e.items() if not _k.startswith('_')}
+            if _now < _e['_ready']:
+                _d['status'] = 'processing'
+            elif _e['_failed']:
+                _d['status'] = 'failed'
+            else:
+                _d['status'] = 'completed'
+                _d['url'] = '{}/images/{}.jpg?X-Amz-Expires=3600&X-Amz-Signature=mock'.format(_base, _e['exportId'])
+                _d['expiryTime'] = int((_e['_ready'] + 3600) * 1000)
+            _out.append(_d)
+
+        return self._send(200, _out, _headers)
+
+
+'''
+    代役サーバー
+
+    使い方：
+        server = MockSoracomServer(latency=0.05, export_delay=2.0)
+        server.state.addMotionEvents('*', start, 10)
+        server.start()
+        SH.setApiEndpoint(server.url)
+        ...
+        server.stop()
+
+'''
+class MockSoracomServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='localhost', port=0, ssl_context=None, **kwargs):
+        super().__init__((host, port), MockHandler)
+        self.host = host
+        self.state = MockState(**kwargs)
+        self.scheme = 'http'
+        if ssl_context is not None:
+            self.socket = ssl_context.wrap_socket(self.socket, server_side=True)
+            self.scheme = 'https'
+        self._thread = None
+
+    @property
+    def url(self):
+        return '{}://{}:{}'.format(self.scheme, self.host, self.server_address[1])
+
+    '''
+        バックグラウンドのスレッドで起動する
+
+    '''
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+        return None
+
+
+'''
+	main
+
+'''
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description='Local stand-in of the SORACOM API used by these samples')
+    parser.add_argument('--host', default='localhost',
+                        help='待ち受けアドレス')
+    parser.add_argument('--port', default=8080, type=int,
+                        help='待ち受けポート')
+    parser.add_argument('--latency', default=0.0, type=float,
+                        help='応答遅延（sec）')
+    parser.add_argument('--error-rate', default=0.0, type=float,
+                        help='APIが500を返す確率')
+    parser.add_argument('--export-delay', default=1.0, type=float,
+                        help='エクスポートがcompletedになるまでの時間（sec）')
+    parser.add_argument('--export-jitter', default=0.0, type=float,
+                        help='export-delayのばらつき（sec）')
+    parser.add_argument('--export-failure-rate', default=0.0, type=float,
+                        help='エクスポートがfailedになる確率')
+    parser.add_argument('--remaining-frames', default=100000, type=int,
+                        help='1デバイスあたりのエクスポート可能な残りフレーム数')
+    parser.add_argument('--image-size', default=64 * 1024, type=int,
+                        help='静止画のサイズ（byte）')
+    parser.add_argument('--rate-limit', default=0.0, type=float,
+                        help='APIの1秒あたりの呼び出し回数の上限（0で無制限）')
+    parser.add_argument('--download-cut-rate', default=0.0, type=float,
+                        help='静止画のダウンロードが途中で切れる確率')
+    parser.add_argument('--events', default=10, type=int,
+                        help='1デバイスあたりのモーションイベント数')
+    parser.add_argument('--start', default='',
+                        help='最初のイベントの開始時刻。フォーマット "%%Y%%m%%d %%H%%M%%S"（省略時は1時間前）')
+    parser.add_argument('--event-duration', default=60.0, type=float,
+                        help='イベントの長さ（sec）')
+    parser.add_argument('--event-gap', default=300.0, type=float,
+                        help='イベントの開始間隔（sec）')
+
+    args = parser.parse_args()
+
+    if len(args.start) > 0:
+        from datetime import datetime
+        _st = int(datetime.strptime(args.start + ' +0900', '%Y%m%d %H%M%S %z').timestamp() * 1000)
+    else:
+        _st = int((time.time() - 3600) * 1000)
+
+    server = MockSoracomServer(args.host, args.port, latency=args.latency, error_rate=args.error_rate,
+                               export_delay=args.export_delay, export_jitter=args.export_jitter,
+                               export_failure_rate=args.export_failure_rate,
+                               remaining_frames=args.remaining_frames, image_size=args.image_size,
+                               rate_limit=args.rate_limit, download_cut_rate=args.download_cut_rate)
+    server.state.addMotionEvents('*', _st, args.events, int(args.event_duration * 1000), int(args.event_gap * 1000))
+
+    LOGGER.info('mock SORACOM API listening on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
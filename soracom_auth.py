@@ -11,19 +11,35 @@ import time
 from datetime import datetime
 
 import json, ast
-import urllib.request
+import urllib.error
 
 import LogUtils as LU
+import soracom_http as SH
 
 SCRIPT_NAME = os.path.basename(__file__)
 SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
 
+# トークンキャッシュの保存先
+TOKEN_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.soracom_token_cache.json')
+# トークンの有効期間（sec）。SORACOM APIのデフォルトは86400
+TOKEN_TIMEOUT_SECONDS = 86400
+# 有効期限のこの秒数前になったらキャッシュを使わずに取り直す
+TOKEN_EXPIRY_MARGIN = 300
+
 # logging
 LOGGER = getLogger(os.path.basename(__file__))
 LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
 
 LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
 
+'''
+    認証APIのURL
+
+'''
+def authUrl():
+    return SH.apiUrl('/v1/auth')
+
+
 '''
     Access Tokenの取得
 
@@ -31,23 +47,19 @@ LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
     https://users.soracom.io/ja-jp/tools/api/key-and-token/#sam-%e3%83%a6%e3%83%bc%e3%82%b6%e3%83%bc%e3%81%ae-api-%e3%82%ad%e3%83%bc%e3%81%a8-api-%e3%83%88%e3%83%bc%e3%82%af%e3%83%b3%e3%82%92%e7%99%ba%e8%a1%8c%e3%81%99%e3%82%8b
 
 '''
-def getToken(url, auth_key_id, auth_key):
+def getToken(url, auth_key_id, auth_key, token_timeout_seconds=None):
 
     _d = dict()
     _d["authKeyId"] = auth_key_id
     _d["authKey"] = auth_key
+    if token_timeout_seconds is not None:
+        _d["tokenTimeoutSeconds"] = int(token_timeout_seconds)
 
     _method = 'POST'
     _headers = { 'Content-Type': 'application/json; charset=utf-8' }
     _body = json.dumps(_d).encode()
-    req = urllib.request.Request(
-        url = url, 
-        data = _body, 
-        method = _method,
-        headers = _headers 
-    )
     try:
-        with urllib.request.urlopen(req) as res:
+        with SH.request(_method, url, headers=_headers, body=_body) as res:
             # https://qiita.com/krang/items/119bff51c30d3b7637dd
             #内容のbyte型への変換 type:byte型
             data = res.read()
@@ -75,23 +87,14 @@ def getToken(url, auth_key_id, auth_key):
 
 '''
 def revokeToken(api_key, token):
-    url = 'https://api.soracom.io/v1/auth/logout'
+    url = SH.apiUrl('/v1/auth/logout')
 
     _method = 'POST'
-    _headers = { 
-        'X-Soracom-API-Key' : api_key,
-        'X-Soracom-Token' : token
-        }
+    _headers = SH.apiHeaders(api_key, token)
     _body = None
 
-    req = urllib.request.Request(
-        url = url, 
-        data = _body, 
-        method = _method,
-        headers = _headers 
-    )
     try:
-        with urllib.request.urlopen(req) as res:
+        with SH.request(_method, url, headers=_headers, body=_body) as res:
             #内容のbyte型への変換 type:byte型
             data = res.read()
             #内容のbite型→文字列型へのデコード type:str型
@@ -114,6 +117,113 @@ def revokeToken(api_key, token):
     return None
 
 
+'''
+    トークンキャッシュの読み込み
+
+    戻り値 : キャッシュの内容（dict）。ファイルが無い、壊れている時はNone
+
+'''
+def loadTokenCache(cache_path=TOKEN_CACHE_PATH):
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            _c = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as err:
+        LOGGER.warning('token cache is broken. ignored. {}: {}'.format(cache_path, err))
+        return None
+
+    if not isinstance(_c, dict) or 'token' not in _c or 'expiresAt' not in _c:
+        return None
+
+    return _c
+
+
+'''
+    トークンキャッシュの保存
+
+    トークンは認証情報なので、所有者だけが読み書きできるパーミッション（0600）で書き込む。
+
+'''
+def saveTokenCache(cache, cache_path=TOKEN_CACHE_PATH):
+    _dir = os.path.dirname(os.path.abspath(cache_path))
+    os.makedirs(_dir, exist_ok=True)
+
+    # 一時ファイルに書いてから付け替える（書きかけのキャッシュを読ませない）
+    _tp = '{}.{}.tmp'.format(cache_path, os.getpid())
+    _fd = os.open(_tp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(_fd, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.chmod(_tp, 0o600)
+        os.replace(_tp, cache_path)
+    except BaseException:
+        if os.path.exists(_tp):
+            os.remove(_tp)
+        raise
+
+    return cache_path
+
+
+'''
+    トークンキャッシュの削除
+
+'''
+def clearTokenCache(cache_path=TOKEN_CACHE_PATH):
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+
+    return None
+
+
+'''
+    キャッシュ付きのAccess Tokenの取得
+
+    キャッシュしたトークンが有効期限のmargin秒前までならそれを使い、それ以外は getToken で取り直して保存する。
+    また、API呼び出しが401（トークン切れ、無効化済み）になった時には透過的にトークンを取り直すよう
+    SH.setTokenRefresherに登録する。
+    キャッシュしたトークンは使い回すので、revokeTokenは明示的に呼んだ時だけ行うこと。
+
+    戻り値 : getTokenと同じ (apiKey, token, operatorId, userName)。取得できない時はNone
+
+'''
+def getCachedToken(url, auth_key_id, auth_key, cache_path=TOKEN_CACHE_PATH,
+                   token_timeout_seconds=TOKEN_TIMEOUT_SECONDS, margin=TOKEN_EXPIRY_MARGIN):
+
+    def _issue():
+        _rt = getToken(url, auth_key_id, auth_key, token_timeout_seconds)
+        if _rt is None:
+            return None
+
+        _c = dict()
+        _c['authKeyId'] = auth_key_id
+        _c['apiKey'], _c['token'], _c['operatorId'], _c['userName'] = _rt
+        _c['expiresAt'] = int(time.time()) + int(token_timeout_seconds)
+        try:
+            saveTokenCache(_c, cache_path)
+        except OSError as err:
+            LOGGER.warning('could not write token cache. {}: {}'.format(cache_path, err))
+
+        return _rt
+
+    def _refresh(api_key, token):
+        _rt = _issue()
+        if _rt is None:
+            return None
+        return _rt[0], _rt[1]
+
+    SH.setTokenRefresher(_refresh)
+
+    _c = loadTokenCache(cache_path)
+    if _c is not None and _c.get('authKeyId') == auth_key_id:
+        if time.time() < _c['expiresAt'] - margin:
+            LOGGER.debug('use cached token. expires at {}'.format(datetime.fromtimestamp(_c['expiresAt'])))
+            return _c['apiKey'], _c['token'], _c.get('operatorId'), _c.get('userName')
+        LOGGER.debug('cached token is expiring. refreshing.')
+
+    return _issue()
+
+
 '''
 	main：関数テスト用
 
@@ -130,7 +240,7 @@ if __name__ == "__main__":
     LOGGER.debug(auth_key)
 
     # accessトークンの取得
-    url = 'https://api.soracom.io/v1/auth'
+    url = authUrl()
     akey, token, oid, unm = getToken(url, auth_key_id, auth_key)
     if not token == None:
         LOGGER.debug(akey)
@@ -0,0 +1,315 @@
+'''
+    ライブラリとして使うためのクライアント
+
+    export_sample.pyの処理を、常駐するワーカーなどからimportして使うためのクラス。
+    認証情報・トークン・通信（接続プール、レート制限）・ロガー・設定をまとめて持ち、
+    api_key, tokenを毎回渡さなくてよい。1つのクライアントを使い回せば、ジョブごとにimportや認証をし直さない
+    （トークンは最初に使う時に取得し、期限が切れたら401を受けた時に取り直す）。
+
+    importしただけでは何もしない（環境変数を読まない、画面出力のハンドラーを付けない。LU.setLibraryMode）。
+    ログはpropagateで呼び出し側のロガーに渡るので、出し先とレベルは呼び出し側のロギングの設定で決める。
+
+    時刻の引数（st_time, ed_time, extime）はdatetime型。watchのcursorだけはunixtime 13桁（pollEventImagesの戻り値をそのまま渡す）。
+
+    （注意）接続プール・レート制限・エクスポートの待ち時間・キャッシュ・保管庫は、モジュール単位（プロセスで1つ）の設定なので、
+    1つのプロセスでは1つのクライアントを使い回すこと。
+
+    使い方：
+        import soracom_client as SCL
+
+        with SCL.SoraCamClient(auth_key_id, auth_key, concurrency=8, download_workers=8, pipeline=True) as _cl:
+            _rd, _sm = _cl.downloadEventImages(device_id, st_time, ed_time, 10, path)
+            ...
+
+'''
+import os
+import threading
+
+from logging import getLogger
+
+import LogUtils as LU
+# ライブラリとして使うので、各モジュールのロガーに画面出力を付けない（これより後にimportするモジュールも）
+LU.setLibraryMode()
+import soracom_auth as SA
+import soracom_http as SH
+import soracom_utils as SU
+import soracom_exports as SE
+import soracom_journal as SJ
+import soracom_framestore as SF
+import soracom_exportcache as SC
+import soracom_metrics as SM
+import export_sample as ES
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
+
+ENV_AUTH_KEY_ID = 'SORACOM_AUTH_KEY_ID'
+ENV_AUTH_KEY = 'SORACOM_AUTH_KEY'
+
+
+'''
+    ソラカメAPIのクライアント
+
+        auth_key_id, auth_key : 認証キー。省略時はクライアントを作る時に環境変数 SORACOM_AUTH_KEY_ID / SORACOM_AUTH_KEY を読む
+        api_endpoint : APIのURL（代役サーバーなど）。省略時はSH.API_ENDPOINT
+        token_cache : トークンのキャッシュファイル。指定した時はトークンを使い回し、close()でも無効化しない
+        concurrency : エクスポート依頼の同時実行数
+        download_workers : 静止画ダウンロードの同時実行数
+        pipeline : Trueの時はエクスポートの完了を待たずに、completedになった静止画からダウンロードする
+        max_inflight : 同時に送るAPIリクエスト数の上限
+        rate_limit : APIリクエスト数の上限（毎秒）
+        export_deadline : エクスポートの完了を待つ時間の上限（sec）
+        export_timing : エクスポートの完了時間の見積もりを保存するファイル（close()で保存する）
+        export_cache : エクスポート結果のキャッシュ（SC.ExportCache）のファイル
+        store : 静止画の保管庫（SF.FrameStore）のディレクトリ
+        logger : クライアントのログの出し先。省略時はこのモジュールのロガー
+        log_level : 指定した時は、全モジュールのロガーのレベルをこのレベルにする（debug / info / warning / error）
+
+    複数スレッドから使ってよい。
+
+'''
+class SoraCamClient:
+    def __init__(self, auth_key_id=None, auth_key=None, api_endpoint=None, token_cache=None,
+                 concurrency=1, download_workers=1, pipeline=False, max_inflight=None, rate_limit=None,
+                 export_deadline=SE.EXPORT_WAIT_DEADLINE, export_timing=None, export_cache=None, store=None,
+                 logger=None, log_level=None):
+        self.auth_key_id = auth_key_id if auth_key_id is not None else os.environ.get(ENV_AUTH_KEY_ID, '')
+        self.auth_key = auth_key if auth_key is not None else os.environ.get(ENV_AUTH_KEY, '')
+        if len(self.auth_key_id) == 0 or len(self.auth_key) == 0:
+            raise ValueError('auth_key_id and auth_key must be set (or {} / {})'.format(ENV_AUTH_KEY_ID, ENV_AUTH_KEY))
+        self.token_cache = token_cache
+        self.concurrency = max(1, concurrency)
+        self.download_workers = max(1, download_workers)
+        self.pipeline = pipeline
+        self.logger = logger if logger is not None else LOGGER
+        self.api_key = None
+        self.token = None
+        self.operator_id = None
+        self._lock = threading.Lock()
+
+        if log_level is not None:
+            LU.setLevel(log_level)
+
+        # 通信
+        if api_endpoint is not None:
+            SH.setApiEndpoint(api_endpoint)
+        if max_inflight is not None:
+            SH.configurePool(max_inflight=max_inflight)
+        if rate_limit is not None:
+            SH.configureRateLimit(rate_limit)
+
+        # エクスポートの待ち方と、エクスポート結果・静止画の使い回し
+        ES.EXPORT_DEADLINE = export_deadline
+        if export_timing is not None:
+            ES.EXPORT_TIMING.path = export_timing
+            ES.EXPORT_TIMING.load()
+        if export_cache is not None:
+            ES.EXPORT_CACHE = SC.openExportCache(export_cache)
+        if store is not None:
+            ES.FRAME_STORE = SF.openFrameStore(store)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    '''
+        トークンを取得する（取得済みの時は何もしない）
+
+        戻り値 : 取得できた時はTrue
+
+    '''
+    def login(self):
+        with self._lock:
+            if self.token is not None:
+                return True
+
+            _url = SA.authUrl()
+            if self.token_cache is not None:
+                # SA.getCachedTokenが期限切れの時の取り直しを登録する
+                _tk = SA.getCachedToken(_url, self.auth_key_id, self.auth_key, self.token_cache)
+            else:
+                _tk = SA.getToken(_url, self.auth_key_id, self.auth_key)
+                SH.setTokenRefresher(self._refresh)
+            if _tk is None:
+                self.logger.error('could not get token')
+                return False
+
+            self.api_key, self.token, self.operator_id, _unm = _tk
+            self.logger.debug('logged in. operator %s', self.operator_id)
+
+        return True
+
+    def _refresh(self, api_key, token):
+        _tk = SA.getToken(SA.authUrl(), self.auth_key_id, self.auth_key)
+        return _tk[:2] if _tk is not None else None
+
+    '''
+        最新の(api_key, token)。未取得の時は取得する
+
+    '''
+    def credentials(self):
+        if self.token is None and not self.login():
+            raise RuntimeError('not logged in')
+
+        return SH.renewedCredentials(self.api_key, self.token)
+
+    '''
+        後片付け（トークンの無効化、見積もりの保存、キャッシュと保管庫を閉じる）
+
+        token_cacheを指定した時は、revoke=Trueの時だけトークンを無効化する
+
+    '''
+    def close(self, revoke=None):
+        _rv = revoke if revoke is not None else self.token_cache is None
+        with self._lock:
+            if self.token is not None and _rv:
+                SA.revokeToken(*SH.renewedCredentials(self.api_key, self.token))
+                if self.token_cache is not None:
+                    SA.clearTokenCache(self.token_cache)
+                self.logger.debug('token was revoked.')
+            self.api_key = None
+            self.token = None
+
+        if ES.EXPORT_TIMING.path is not None:
+            ES.EXPORT_TIMING.save()
+        if ES.EXPORT_CACHE is not None:
+            ES.EXPORT_CACHE.close()
+            ES.EXPORT_CACHE = None
+        if ES.FRAME_STORE is not None:
+            ES.FRAME_STORE.close()
+            ES.FRAME_STORE = None
+
+        return None
+
+    '''
+        残りエクスポート可能フレーム数（取得できなかった時はNone）
+
+    '''
+    def remainingFrames(self, device_id):
+        return ES.getRemainingFrames(*self.credentials(), device_id)
+
+    '''
+        エクスポート上限（APIの戻り値のdict）
+
+    '''
+    def exportUsage(self, device_id):
+        return ES.getSoraCamExportUsage(*self.credentials(), device_id)
+
+    '''
+        静止画のエクスポートを1件依頼する（extime はdatetime型。APIの戻り値のdict）
+
+    '''
+    def exportImage(self, device_id, extime, wide_angle_correction=True):
+        return ES.getSoraCamExportImages(*self.credentials(), device_id, SU.getUnixtime(extime), wide_angle_correction)
+
+    '''
+        イベント（SRC.Event）を1件ずつ返すジェネレーター（st_time, ed_time はdatetime型）
+
+    '''
+    def iterEvents(self, device_id, st_time, ed_time, limit=None):
+        return ES.iterSoraCamEventsForDevice(*self.credentials(), device_id, SU.getUnixtime(st_time), SU.getUnixtime(ed_time), limit)
+
+    '''
+        イベント（SRC.Event）のリスト（st_time, ed_time はdatetime型）
+
+    '''
+    def listEvents(self, device_id, st_time, ed_time):
+        return ES.listSoraCamEventsForDevice(*self.credentials(), device_id, SU.getUnixtime(st_time), SU.getUnixtime(ed_time))
+
+    '''
+        エクスポートの進捗（SRC.ExportStatusのリスト）
+
+    '''
+    def listExports(self, device_id, export_ids):
+        return ES.listSoraCamExportImages(*self.credentials(), device_id, export_ids)
+
+    '''
+        エクスポートの完了を待つ（ES.waitSoraCamExportImages）
+
+    '''
+    def waitExports(self, device_id, export_ids, deadline=None, on_completed=None):
+        return ES.waitSoraCamExportImages(*self.credentials(), device_id, export_ids, deadline, on_completed)
+
+    '''
+        時間帯の静止画をintervalごとにダウンロードする（ES.downloadImages。st_time, ed_time はdatetime型）
+
+        戻り値 : (結果（正常に終了した時はTrue）, 集計（dict）)
+
+    '''
+    def downloadImages(self, device_id, st_time, ed_time, interval, path, journal=None, times=None, on_downloaded=None):
+        _sm = dict()
+        _rd = ES.downloadImages(*self.credentials(), device_id, st_time, ed_time, interval, path,
+                                self.concurrency, self.download_workers, self.pipeline, _sm, journal, times, None, on_downloaded)
+
+        return _rd, _sm
+
+    '''
+        時間帯のイベント録画から静止画をダウンロードする（ES.downloadEventImages。st_time, ed_time はdatetime型）
+
+        戻り値 : (結果（正常に終了した時はTrue）, 集計（dict）)
+
+    '''
+    def downloadEventImages(self, device_id, st_time, ed_time, interval, path, journal=None, strategy=None, on_downloaded=None):
+        _sm = dict()
+        _rd = ES.downloadEventImages(*self.credentials(), device_id, st_time, ed_time, interval, path,
+                                     self.concurrency, self.download_workers, self.pipeline, _sm, journal, strategy, on_downloaded)
+
+        return _rd, _sm
+
+    '''
+        複数デバイスのイベント画像をダウンロードする（ES.downloadDevicesEventImages。st_time, ed_time はdatetime型。静止画は path/<device id>）
+
+        戻り値 : device_id -> 集計（dict。resultに結果）
+
+    '''
+    def downloadDevicesEventImages(self, device_ids, st_time, ed_time, interval, path, max_devices=1, journal=None, resume=False,
+                                   strategy=None, on_downloaded=None):
+        return ES.downloadDevicesEventImages(*self.credentials(), device_ids, st_time, ed_time, interval, path,
+                                             self.concurrency, self.download_workers, self.pipeline, max_devices, journal, resume, strategy,
+                                             on_downloaded)
+
+    '''
+        新しいイベントを1回確認して、録画が完了したものをダウンロードする（ES.pollEventImages。cursor はunixtime 13桁）
+
+        戻り値 : (次のcursor, 集計（dict）)
+
+    '''
+    def pollEventImages(self, device_id, cursor, interval, path, journal, on_downloaded=None):
+        _sm = dict()
+        _c = ES.pollEventImages(*self.credentials(), device_id, cursor, interval, path,
+                                self.concurrency, self.download_workers, self.pipeline, _sm, journal, on_downloaded)
+
+        return _c, _sm
+
+    '''
+        新しいイベントを監視する（ES.watchEventImages）。stop（threading.Event）をセットすると終了する
+
+        戻り値 : device_id -> 集計（dict）
+
+    '''
+    def watchEventImages(self, device_ids, interval, path, journal, lookback=ES.WATCH_LOOKBACK, poll_interval=ES.WATCH_POLL_INTERVAL,
+                         polls=None, stop=None, on_downloaded=None):
+        return ES.watchEventImages(*self.credentials(), device_ids, interval, path, self.concurrency, self.download_workers, self.pipeline,
+                                   journal, lookback, poll_interval, polls, stop, on_downloaded)
+
+    '''
+        作業ディレクトリのジャーナルを開く（SJ.openJournal）
+
+    '''
+    def openJournal(self, path, reset=False):
+        return SJ.openJournal(path, reset=reset)
+
+    '''
+        メトリクス（SM.REGISTRY.toDict()）
+
+    '''
+    def metrics(self):
+        return SM.REGISTRY.toDict()
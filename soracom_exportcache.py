@@ -0,0 +1,177 @@
+'''
+    エクスポート結果のキャッシュ
+
+    (device_id, 撮影時刻, wide_angle_correction) ごとに、completedになったエクスポートの
+    exportId・状態・ダウンロードURL・URLの有効期限（expiryTime）をSQLiteに記録する。
+    期間の重なるジョブや再実行で同じ時刻をエクスポートする時は、URLの有効期限内ならキャッシュのURLから
+    ダウンロードするだけで済む（エクスポートの依頼も進捗の確認もしない。remainingFramesも使わない）。
+
+    有効期限を過ぎた（またはEXPIRY_MARGIN秒以内に切れる）エントリーは使わず、evict()で消す。
+
+'''
+import os
+import time
+
+from logging import getLogger
+
+import LogUtils as LU
+import soracom_metrics as SM
+import soracom_records as SRC
+import soracom_sqlite as SQ
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
+
+# キャッシュのファイル
+EXPORT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.soracam_export_cache.sqlite3')
+# URLの有効期限がこれ（sec）より近いエントリーは使わない（ダウンロードの途中で切れないように）
+EXPIRY_MARGIN = 300
+# expiryTimeが無い時の有効期間（sec）
+DEFAULT_TTL = 3600
+
+
+'''
+    エクスポート結果のキャッシュ
+
+        path : SQLiteのファイル
+
+    複数スレッドから使ってよい（SQ.SQLiteStore）。
+
+    使い方：
+        with ExportCache(path) as _ec:
+            _hits = _ec.lookup(device_id, times)        # time -> 進捗（SRC.ExportStatus）
+            ...
+            _ec.put(device_id, [(extime, entry)])       # completedになった進捗を記録する
+            LOGGER.info(_ec.stats())
+
+'''
+class ExportCache(SQ.SQLiteStore):
+    SCHEMA = (
+        '''
+        CREATE TABLE IF NOT EXISTS exports (
+            device_id TEXT NOT NULL,
+            time INTEGER NOT NULL,
+            wide_angle_correction INTEGER NOT NULL,
+            export_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            url TEXT NOT NULL,
+            expiry_time INTEGER NOT NULL,
+            updated_at REAL,
+            PRIMARY KEY (device_id, time, wide_angle_correction)
+        )''',
+        'CREATE INDEX IF NOT EXISTS exports_expiry_time ON exports (expiry_time)',
+    )
+
+    def __init__(self, path=EXPORT_CACHE_PATH):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        super().__init__(path)
+
+    '''
+        時刻ごとの使えるエクスポート結果（ヒット・ミスを数える）
+
+        times : unixtime 13桁の並び
+
+        戻り値 : time -> 進捗（SRC.ExportStatus）。使えない時刻は含まない
+
+    '''
+    def lookup(self, device_id, times, wide_angle_correction=True):
+        _ts = set(int(_t) for _t in times)
+        if len(_ts) == 0:
+            return dict()
+
+        _valid = int((time.time() + EXPIRY_MARGIN) * 1000)
+        with self._lock:
+            _rows = self._conn.execute(
+                'SELECT time, export_id, status, url, expiry_time FROM exports '
+                'WHERE device_id = ? AND wide_angle_correction = ? AND time BETWEEN ? AND ? AND expiry_time > ?',
+                (device_id, int(bool(wide_angle_correction)), min(_ts), max(_ts), _valid)).fetchall()
+        _rt = {_r[0]: SRC.ExportStatus(_r[1], device_id, _r[0], _r[2], _r[3], _r[4]) for _r in _rows if _r[0] in _ts}
+
+        with self._lock:
+            self.hits += len(_rt)
+            self.misses += len(_ts) - len(_rt)
+        SM.inc('soracom_export_cache_total', len(_rt), result='hit')
+        SM.inc('soracom_export_cache_total', len(_ts) - len(_rt), result='miss')
+
+        return _rt
+
+    '''
+        completedになったエクスポートの進捗を記録する（url・expiryTimeの無い進捗は記録しない）
+
+        entries : (time, 進捗（SRC.ExportStatus）) のリスト
+
+    '''
+    def put(self, device_id, entries, wide_angle_correction=True):
+        _now = time.time()
+        _rows = list()
+        for _t, _d in entries:
+            if _d.status != 'completed' or _d.url is None:
+                continue
+            _ex = _d.expiry_time if _d.expiry_time is not None else int((_now + DEFAULT_TTL) * 1000)
+            _rows.append((device_id, int(_t), int(bool(wide_angle_correction)), _d.export_id, _d.status, _d.url, _ex, _now))
+        if len(_rows) == 0:
+            return 0
+
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO exports (device_id, time, wide_angle_correction, export_id, status, url, expiry_time, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', _rows)
+            self._conn.commit()
+
+        return len(_rows)
+
+    '''
+        エントリーを消す（キャッシュのURLでダウンロードできなかった時）
+
+    '''
+    def discard(self, device_id, extime, wide_angle_correction=True):
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM exports WHERE device_id = ? AND time = ? AND wide_angle_correction = ?',
+                (device_id, int(extime), int(bool(wide_angle_correction))))
+            self._conn.commit()
+
+    '''
+        URLの有効期限が切れたエントリーを消す
+
+        戻り値 : 消した数
+
+    '''
+    def evict(self):
+        with self._lock:
+            _n = self._conn.execute('DELETE FROM exports WHERE expiry_time <= ?', (int(time.time() * 1000),)).rowcount
+            self._conn.commit()
+
+        return _n
+
+    '''
+        ヒット率など（エントリー数、ヒット、ミス、ヒット率）
+
+    '''
+    def stats(self):
+        with self._lock:
+            _n = self._conn.execute('SELECT COUNT(*) FROM exports').fetchone()[0]
+            _h, _m = self.hits, self.misses
+
+        return {'entries': _n, 'hits': _h, 'misses': _m, 'hit_rate': _h / (_h + _m) if _h + _m > 0 else 0.0}
+
+
+'''
+    キャッシュを開き、有効期限の切れたエントリーを消す
+
+'''
+def openExportCache(path=EXPORT_CACHE_PATH):
+    _ec = ExportCache(path)
+    _n = _ec.evict()
+    if _n > 0:
+        LOGGER.debug('evicted %d expired exports', _n)
+
+    return _ec
@@ -0,0 +1,252 @@
+'''
+    静止画エクスポートの進捗管理
+
+    エクスポートを依頼したexportIdごとの状態（processing → completed / failed ...）をdictとsetで持ち、
+    listSoraCamExportImagesの結果を1件ずつO(1)で反映する。
+    何千件もエクスポートを依頼しても、ポーリング1回あたりの処理は取得した件数に比例するだけで済む。
+
+    CompletionEstimatorは、エクスポートが完了するまでの時間を実行をまたいで学習し、進捗を確認する間隔を決める。
+
+'''
+import os
+import json
+import time
+import random
+import threading
+
+from logging import getLogger
+
+import LogUtils as LU
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
+
+# listSoraCamDeviceImageExportsで1ページに取得できる件数の上限
+EXPORTS_PAGE_SIZE_MAX = 100
+
+# ダウンロード可能な状態
+COMPLETED_STATUSES = frozenset(['completed'])
+# ダウンロード不可能な状態
+FAILED_STATUSES = frozenset(['failed', 'limitExceeded', 'expired'])
+
+# エクスポートの完了時間の見積もりを保存するファイル
+EXPORT_TIMING_PATH = os.path.join(os.path.expanduser('~'), '.soracam_export_timing.json')
+# 見積もりが無い時の完了時間（sec）
+DEFAULT_COMPLETION_SECONDS = 3.0
+# 指数移動平均の重み
+COMPLETION_ALPHA = 0.2
+# 進捗を確認する間隔の下限・上限（sec）と、ずらす割合
+POLL_MIN_SECONDS = 0.5
+POLL_MAX_SECONDS = 30.0
+POLL_JITTER = 0.1
+# 進捗を待つ時間の上限（sec）
+EXPORT_WAIT_DEADLINE = 300.0
+
+
+'''
+    listSoraCamExportImagesの1ページの件数
+
+    未解決のexportIdの数に合わせるが、APIの上限（EXPORTS_PAGE_SIZE_MAX）は超えない。
+
+'''
+def exportsPageSize(num_of_ids):
+    return max(1, min(int(num_of_ids), EXPORTS_PAGE_SIZE_MAX))
+
+
+'''
+    エクスポートの進捗
+
+        export_ids : 追跡するexportIdのリスト
+
+    使い方：
+        _tr = ExportTracker(exported_ids)
+        for _d in listSoraCamExportImages(...):
+            if _tr.update(_d) == 'completed':
+                ...
+        if _tr.isResolved():
+            ...
+
+'''
+class ExportTracker:
+    def __init__(self, export_ids=()):
+        self._order = list()        # 依頼順のexportId
+        self._entries = dict()      # exportId -> 最後に取得した進捗（SRC.ExportStatus）。未取得はNone
+        self._pending = set()       # 結果（可能、不可能）が未確定のexportId
+        self._completed = set()
+        self._failed = set()
+        for _id in export_ids:
+            self.add(_id)
+
+    def add(self, export_id):
+        if export_id in self._entries:
+            return False
+
+        self._order.append(export_id)
+        self._entries[export_id] = None
+        self._pending.add(export_id)
+
+        return True
+
+    '''
+        進捗を1件反映する
+
+        entry : listSoraCamExportImagesが返す進捗（SRC.ExportStatus。export_id, status, url ...）
+        戻り値 : 今回 completed / failed に確定した時はそのステータス名（'completed' / 'failed'）。それ以外はNone
+                 追跡していないexportIdや、確定済みのexportIdは無視する。
+
+    '''
+    def update(self, entry):
+        _id = entry.export_id
+        if _id not in self._pending:
+            return None
+
+        self._entries[_id] = entry
+        _st = entry.status
+        if _st in COMPLETED_STATUSES:
+            self._pending.discard(_id)
+            self._completed.add(_id)
+            return 'completed'
+        if _st in FAILED_STATUSES:
+            self._pending.discard(_id)
+            self._failed.add(_id)
+            return 'failed'
+
+        return None
+
+    def __contains__(self, export_id):
+        return export_id in self._entries
+
+    def __len__(self):
+        return len(self._order)
+
+    def isResolved(self):
+        return len(self._pending) == 0
+
+    def pending(self):
+        return set(self._pending)
+
+    def numPending(self):
+        return len(self._pending)
+
+    def numCompleted(self):
+        return len(self._completed)
+
+    def numFailed(self):
+        return len(self._failed)
+
+    def entry(self, export_id):
+        return self._entries.get(export_id)
+
+    '''
+        確定した進捗（SRC.ExportStatus）のリスト（依頼順）
+
+    '''
+    def results(self):
+        return [self._entries[_id] for _id in self._order if _id not in self._pending]
+
+    '''
+        completedになった進捗（SRC.ExportStatus）のリスト（依頼順）
+
+    '''
+    def completed(self):
+        return [self._entries[_id] for _id in self._order if _id in self._completed]
+
+
+'''
+    エクスポートが完了するまでの時間の見積もり
+
+    エクスポートを依頼してからcompletedになるまでの時間の指数移動平均（EWMA）と平均偏差を持ち、
+    次に進捗を確認するまでの待ち時間を決める（waitSoraCamExportImages）。
+    見積もりより前は完了しそうな時刻までまとめて待ち、見積もりを過ぎたら遅れに応じて間隔を広げる。
+    見積もりはファイルに保存して、次の実行でも使う。
+
+        path : 保存するファイル（JSON）。Noneの時は保存しない
+
+'''
+class CompletionEstimator:
+    def __init__(self, path=None, alpha=COMPLETION_ALPHA):
+        self.path = path
+        self.alpha = alpha
+        self.mean = DEFAULT_COMPLETION_SECONDS
+        self.dev = DEFAULT_COMPLETION_SECONDS / 2
+        self.samples = 0
+        self._lock = threading.Lock()
+        if path is not None:
+            self.load()
+
+    '''
+        完了までの時間を1件反映する（sec）
+
+    '''
+    def observe(self, seconds):
+        with self._lock:
+            if self.samples == 0:
+                self.mean = seconds
+                self.dev = seconds / 2
+            else:
+                # RFC 6298のRTTの見積もりと同じ更新
+                self.dev += self.alpha / 2 * (abs(seconds - self.mean) - self.dev)
+                self.mean += self.alpha * (seconds - self.mean)
+            self.samples += 1
+
+    '''
+        次に進捗を確認するまでの待ち時間（sec）
+
+        elapsed : 依頼してからの経過時間（sec）
+
+    '''
+    def delay(self, elapsed):
+        with self._lock:
+            _mean, _dev = self.mean, self.dev
+
+        if elapsed < _mean:
+            # 見積もりの完了時刻まで待つ
+            _dl = _mean - elapsed
+        else:
+            # 見積もりを過ぎた分の半分と偏差だけ待つ（遅れるほど間隔が広がる）
+            _dl = (elapsed - _mean) / 2 + _dev
+        # 複数デバイスの確認が重ならないように少しずらす
+        _dl *= 1 + random.uniform(0, POLL_JITTER)
+
+        return min(max(_dl, POLL_MIN_SECONDS), POLL_MAX_SECONDS)
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                _d = json.load(f)
+            _mean, _dev, _n = float(_d['mean']), float(_d['dev']), int(_d['samples'])
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, TypeError, KeyError) as err:
+            LOGGER.warning('export timing is broken. ignored. {}: {}'.format(self.path, err))
+            return False
+
+        with self._lock:
+            self.mean, self.dev, self.samples = _mean, _dev, _n
+
+        return True
+
+    def save(self):
+        if self.path is None or self.samples == 0:
+            return None
+
+        with self._lock:
+            _d = {'mean': self.mean, 'dev': self.dev, 'samples': self.samples, 'updatedAt': int(time.time())}
+        # 一時ファイルに書いてから付け替える
+        _tp = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(_tp, 'w', encoding='utf-8') as f:
+                json.dump(_d, f)
+            os.replace(_tp, self.path)
+        except OSError as err:
+            LOGGER.warning('could not write export timing. {}: {}'.format(self.path, err))
+            if os.path.exists(_tp):
+                os.remove(_tp)
+
+        return self.path
@@ -0,0 +1,269 @@
+'''
+    静止画の保管庫（コンテンツアドレス）
+
+    ダウンロードした静止画を内容のハッシュ（SHA-256）で1回だけ保存し、
+    (device_id, 撮影時刻, exportId, ハッシュ, サイズ) の索引をSQLiteに持つ。
+    作業ディレクトリ（--dir）は実行のたびに消えるが、保管庫は消さないので、
+    「カメラXのT1からT2までの静止画」はディレクトリを探したりダウンロードし直したりせずに索引から引ける。
+
+    構成：   <store>/index.sqlite3               索引
+            <store>/objects/ab/abcdef....jpg     静止画（ハッシュの先頭2文字でディレクトリを分ける）
+
+    作業ディレクトリの静止画とはハードリンクで中身を共有する（同じファイルシステムでない時はコピー）。
+
+    引数：   store : 保管庫のディレクトリ
+            device : device id
+            start, end : 撮影時刻の範囲。フォーマット "%Y%m%d %H%M%S"の文字列
+            dir : 指定した時は、範囲の静止画を取り出す（ファイル名は "撮影時刻（unixtime 13桁）_元のファイル名" なので名前順が撮影順）
+
+'''
+import sys, os
+import time
+import shutil
+import hashlib
+import threading
+
+from logging import getLogger
+
+import argparse
+
+import LogUtils as LU
+import soracom_utils as SU
+import soracom_sqlite as SQ
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
+
+INDEX_FILE_NAME = 'index.sqlite3'
+OBJECTS_DIR_NAME = 'objects'
+
+
+'''
+    ファイルのSHA-256（16進）
+
+'''
+def fileHash(path, chunk_size=SU.DOWNLOAD_CHUNK_SIZE):
+    _h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            _chunk = f.read(chunk_size)
+            if not _chunk:
+                break
+            _h.update(_chunk)
+
+    return _h.hexdigest()
+
+
+# ハードリンクを張る。できない時（別のファイルシステムなど）はコピー
+def _linkOrCopy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+'''
+    静止画の保管庫
+
+        path : 保管庫のディレクトリ（無ければ作る）
+
+    複数スレッドから使ってよい（索引はSQ.SQLiteStore）。
+
+    使い方：
+        with FrameStore('store') as _fs:
+            _fs.put(device_id, capture_time, downloaded_path, export_id)
+            for _r in _fs.query(device_id, st, ed):
+                ...
+
+'''
+class FrameStore(SQ.SQLiteStore):
+    SCHEMA = (
+        '''
+        CREATE TABLE IF NOT EXISTS frames (
+            device_id TEXT NOT NULL,
+            capture_time INTEGER NOT NULL,
+            export_id TEXT,
+            hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            name TEXT,
+            stored_at REAL,
+            PRIMARY KEY (device_id, capture_time)
+        )''',
+        'CREATE INDEX IF NOT EXISTS frames_hash ON frames (hash)',
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = os.path.join(path, OBJECTS_DIR_NAME)
+        os.makedirs(self.objects, exist_ok=True)
+        super().__init__(os.path.join(path, INDEX_FILE_NAME))
+
+    '''
+        ハッシュに対応する静止画のパス
+
+    '''
+    def objectPath(self, hash, name=''):
+        _ext = os.path.splitext(name)[1] or '.jpg'
+        return os.path.join(self.objects, hash[:2], hash + _ext)
+
+    '''
+        静止画を保管する。同じ内容の静止画が保管済みの時は索引だけ追加する
+
+        device_id, capture_time : 撮影したカメラと時刻（unixtime 13桁）
+        src : 静止画のファイル（そのまま残す。保管庫とはハードリンクで中身を共有する）
+        export_id : エクスポートのexportId
+        name : 元のファイル名（URLのファイル名）。省略時はsrcのファイル名
+
+        戻り値 : ハッシュ
+
+    '''
+    def put(self, device_id, capture_time, src, export_id=None, name=None):
+        _hash = fileHash(src)
+        _size = os.path.getsize(src)
+        _name = name if name is not None else os.path.basename(src)
+        _op = self.objectPath(_hash, _name)
+
+        if not os.path.exists(_op):
+            os.makedirs(os.path.dirname(_op), exist_ok=True)
+            # 同じディレクトリの一時ファイルに張ってから付け替える（同時に同じ内容を保管しても壊れない）
+            _tp = os.path.join(os.path.dirname(_op), '.{}.{}.{}.tmp'.format(_hash[:8], os.getpid(), threading.get_ident()))
+            try:
+                _linkOrCopy(src, _tp)
+                os.replace(_tp, _op)
+            except BaseException:
+                if os.path.exists(_tp):
+                    os.remove(_tp)
+                raise
+
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO frames (device_id, capture_time, export_id, hash, size, name, stored_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (device_id, int(capture_time), export_id, _hash, _size, _name, time.time()))
+            self._conn.commit()
+
+        return _hash
+
+    '''
+        撮影時刻の範囲の静止画（撮影順）
+
+        st, ed : unixtime 13桁（両端を含む）。Noneの時は制限しない
+
+        戻り値 : dict（device_id, capture_time, export_id, hash, size, name, path）のリスト
+
+    '''
+    def query(self, device_id, st=None, ed=None):
+        _st = int(st) if st is not None else -2 ** 63
+        _ed = int(ed) if ed is not None else 2 ** 63 - 1
+        with self._lock:
+            _rows = self._conn.execute(
+                'SELECT device_id, capture_time, export_id, hash, size, name FROM frames '
+                'WHERE device_id = ? AND capture_time BETWEEN ? AND ? ORDER BY capture_time',
+                (device_id, _st, _ed)).fetchall()
+
+        return [self._row(_r) for _r in _rows]
+
+    '''
+        撮影時刻ごとの保管済みの静止画
+
+        times : unixtime 13桁の並び
+
+        戻り値 : 撮影時刻 -> dict（queryと同じ）。保管されていない時刻は含まない
+
+    '''
+    def lookup(self, device_id, times):
+        _ts = set(int(_t) for _t in times)
+        if len(_ts) == 0:
+            return dict()
+
+        return {_r['capture_time']: _r for _r in self.query(device_id, min(_ts), max(_ts)) if _r['capture_time'] in _ts}
+
+    def _row(self, row):
+        _d = dict(zip(('device_id', 'capture_time', 'export_id', 'hash', 'size', 'name'), row))
+        _d['path'] = self.objectPath(_d['hash'], _d['name'] or '')
+
+        return _d
+
+    '''
+        保管した静止画をファイルとして取り出す（ハードリンク、またはコピー）
+
+        frame : queryの戻り値の1件
+        dst : 取り出すファイルパス
+
+    '''
+    def extract(self, frame, dst):
+        if os.path.exists(dst):
+            os.remove(dst)
+        _linkOrCopy(frame['path'], dst)
+
+        return dst
+
+    '''
+        保管している数（索引の件数、静止画の数、静止画の合計サイズ）
+
+    '''
+    def stats(self):
+        with self._lock:
+            _n = self._conn.execute('SELECT COUNT(*) FROM frames').fetchone()[0]
+            _o, _s = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM (SELECT hash, MAX(size) AS size FROM frames GROUP BY hash)').fetchone()
+
+        return {'frames': _n, 'objects': _o, 'bytes': _s}
+
+
+'''
+    保管庫を開く
+
+'''
+def openFrameStore(path):
+    return FrameStore(path)
+
+
+'''
+	main
+
+'''
+if __name__ == "__main__":
+    LOGGER.info('script start')
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+            description='Query frames in the content-addressed frame store')
+    parser.add_argument('--store', default='store',
+                        help='保管庫のディレクトリ')
+    parser.add_argument('--device', default='',
+                        help='device id')
+    parser.add_argument('--start', default='',
+                        help='撮影時刻の範囲の開始。フォーマット "%%Y%%m%%d %%H%%M%%S"')
+    parser.add_argument('--end', default='',
+                        help='撮影時刻の範囲の終了。フォーマット "%%Y%%m%%d %%H%%M%%S"')
+    parser.add_argument('--dir', default='',
+                        help='範囲の静止画を取り出すディレクトリ')
+
+    args = parser.parse_args()
+
+    if len(args.device) == 0:
+        LOGGER.error("No deviceid")
+        sys.exit(1)
+
+    _st = SU.getUnixtime(SU.convertFormattedStringDateTime(args.start)) if len(args.start) > 0 else None
+    _ed = SU.getUnixtime(SU.convertFormattedStringDateTime(args.end)) if len(args.end) > 0 else None
+
+    with FrameStore(os.path.join(os.getcwd(), args.store)) as _fs:
+        _fl = _fs.query(args.device, _st, _ed)
+        for _f in _fl:
+            LOGGER.info('{} {} {} {} bytes'.format(SU.LazyDateTime(_f['capture_time']), _f['export_id'], _f['hash'], _f['size']))
+        if len(args.dir) > 0:
+            _dp = os.path.join(os.getcwd(), args.dir)
+            os.makedirs(_dp, exist_ok=True)
+            for _f in _fl:
+                _fs.extract(_f, os.path.join(_dp, '{:013d}_{}'.format(_f['capture_time'], _f['name'])))
+        LOGGER.info('{} frames. store : {}'.format(len(_fl), _fs.stats()))
+
+    elapsed_time = time.time() - start_time
+    LOGGER.info('script end')
+    LOGGER.info('elapsed time : {} [sec]'.format(str(elapsed_time)))
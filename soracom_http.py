@@ -0,0 +1,465 @@
+'''
+    SORACOM API呼び出し用のHTTPトランスポート
+
+    urllib.request.urlopenは呼び出しのたびにTCP/TLS接続を張り直すので、大量のエクスポート依頼では
+    ハンドシェイクに時間の大半を取られる。
+    ここではホストごとにHTTP/1.1のkeep-alive接続をプールして、全てのAPI呼び出しで使い回す。
+
+    エラー時はurllibと同じ例外（urllib.error.HTTPError / URLError）を送出するので、
+    呼び出し側のエラー処理はurlopenの時と同じでよい。
+
+    使い方：
+        with SH.request('GET', url, headers=SH.apiHeaders(api_key, token)) as res:
+            data = res.read()
+
+'''
+import os, io
+import ssl
+import time
+import threading
+import http.client
+import urllib.parse, urllib.error
+
+from logging import getLogger
+
+import LogUtils as LU
+import soracom_metrics as SM
+import soracom_ratelimit as SR
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
+
+# SORACOM APIのエンドポイント。環境変数 SORACOM_API_ENDPOINT で差し替えられる（ローカルの代役サーバーなど）
+API_ENDPOINT = os.environ.get('SORACOM_API_ENDPOINT', 'https://api.soracom.io')
+
+# ホストごとに保持するアイドル接続の上限
+DEFAULT_POOL_SIZE = 10
+# ソケットのタイムアウト（sec）
+DEFAULT_TIMEOUT = 60
+# リダイレクトを追いかける回数の上限（urlopenと同じ）
+MAX_REDIRECTS = 5
+
+# keep-alive接続が相手側で閉じられていた時に出る例外。再利用した接続でのみ張り直して再送する。
+_STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, ConnectionAbortedError)
+
+
+'''
+    SORACOM APIのURL
+
+    path : '/v1/auth' など
+
+'''
+def apiUrl(path):
+    return API_ENDPOINT.rstrip('/') + path
+
+
+'''
+    SORACOM APIのエンドポイントを変更する
+
+'''
+def setApiEndpoint(endpoint):
+    global API_ENDPOINT
+    API_ENDPOINT = endpoint
+
+    return API_ENDPOINT
+
+
+'''
+    SORACOM APIの認証ヘッダー
+
+    api_key, token : SA.getTokenで取得したAPIキーとトークン
+    content_type : POSTでbodyを送るときに指定
+
+'''
+def apiHeaders(api_key, token, content_type=None):
+    _headers = {
+        'X-Soracom-API-Key' : api_key,
+        'X-Soracom-Token' : token
+        }
+    if content_type is not None:
+        _headers['Content-Type'] = content_type
+
+    return _headers
+
+
+'''
+    レスポンス
+
+    urlopenの戻り値と同じように read() / info() / with 文で扱える。
+    stream=Trueの時はbodyを読み切るかclose()するまで接続を占有し、読み切った接続はプールに戻す。
+
+'''
+class Response:
+    def __init__(self, url, status, reason, headers, data=None, raw=None, release=None):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._data = data
+        self._raw = raw
+        self._release = release
+        self._on_close = None
+
+    def info(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self, amt=None):
+        if self._raw is None:
+            if amt is None:
+                _rt, self._data = self._data, b''
+            else:
+                _rt, self._data = self._data[:amt], self._data[amt:]
+            return _rt
+
+        try:
+            return self._raw.read(amt)
+        except (OSError, http.client.HTTPException) as err:
+            raise urllib.error.URLError(err)
+
+    def close(self):
+        if self._raw is not None:
+            _raw, self._raw = self._raw, None
+            # bodyを読み切っていれば接続を再利用できる
+            self._release(_raw.isclosed())
+            _raw.close()
+        if self._on_close is not None:
+            _on_close, self._on_close = self._on_close, None
+            _on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+'''
+    keep-alive接続のプール
+
+    (scheme, host, port)ごとにアイドル接続を保持する。スレッドセーフ。
+    アイドル接続が無ければ新しく張るので、同時実行数がmaxsizeを超えてもブロックはしない
+    （返却時にmaxsizeを超える分は閉じる）。
+    max_inflightを指定すると、プール全体で同時に処理中のリクエスト数をその数までに抑える（超えた分は待つ）。
+
+'''
+class ConnectionPool:
+    def __init__(self, maxsize=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, context=None, max_inflight=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.context = context if context is not None else ssl.create_default_context()
+        self._idle = dict()
+        self._lock = threading.Lock()
+        self._inflight = None
+        self.setMaxInFlight(max_inflight)
+
+    '''
+        プール全体の同時リクエスト数の上限。Noneまたは0で無制限
+
+    '''
+    def setMaxInFlight(self, max_inflight):
+        self.max_inflight = max_inflight
+        self._inflight = threading.BoundedSemaphore(max_inflight) if max_inflight else None
+
+    def _newConnection(self, key):
+        _scheme, _host, _port = key
+        if _scheme == 'https':
+            return http.client.HTTPSConnection(_host, _port, timeout=self.timeout, context=self.context)
+
+        return http.client.HTTPConnection(_host, _port, timeout=self.timeout)
+
+    def _getConnection(self, key):
+        with self._lock:
+            _l = self._idle.get(key)
+            if _l:
+                return _l.pop(), True
+
+        return self._newConnection(key), False
+
+    def _putConnection(self, key, conn):
+        with self._lock:
+            _l = self._idle.setdefault(key, list())
+            if len(_l) < self.maxsize:
+                _l.append(conn)
+                return
+
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            _idle, self._idle = self._idle, dict()
+        for _l in _idle.values():
+            for _c in _l:
+                _c.close()
+
+    def _send(self, method, url, headers, body):
+        _p = urllib.parse.urlsplit(url)
+        _scheme = _p.scheme.lower()
+        if _scheme not in ('http', 'https'):
+            raise urllib.error.URLError('unknown url type: {}'.format(_scheme))
+        _port = _p.port or (443 if _scheme == 'https' else 80)
+        _key = (_scheme, _p.hostname, _port)
+
+        _path = _p.path or '/'
+        if _p.query:
+            _path += '?' + _p.query
+
+        while True:
+            _conn, _reused = self._getConnection(_key)
+            try:
+                _conn.request(method, _path, body=body, headers=headers)
+                _res = _conn.getresponse()
+                return _key, _conn, _res
+            except _STALE_ERRORS as err:
+                _conn.close()
+                if _reused:
+                    # 相手側で閉じられたkeep-alive接続。新しい接続で送り直す。
+                    LOGGER.debug('stale connection. reconnecting. %s', _key)
+                    SM.inc('soracom_retries_total', endpoint=SM.endpointName(method, url), reason='stale_connection')
+                    continue
+                raise urllib.error.URLError(err)
+            except (OSError, http.client.HTTPException) as err:
+                _conn.close()
+                raise urllib.error.URLError(err)
+
+    '''
+        HTTPリクエスト
+
+        method : 'GET', 'POST' など
+        url : スキーム付きのURL
+        headers : リクエストヘッダー（dict）
+        body : bytes
+        stream : Trueの時はbodyを読まずにResponseを返す（大きなファイルのダウンロード用）
+
+        ステータス400以上はurllib.error.HTTPError、接続エラーはurllib.error.URLErrorを送出する。
+
+    '''
+    def request(self, method, url, headers=None, body=None, stream=False):
+        _sem = self._inflight
+        if _sem is None:
+            return self._request(method, url, headers, body, stream)
+
+        # stream=Trueの時はbodyを読み終えてclose()するまで1件と数える
+        _sem.acquire()
+        try:
+            _res = self._request(method, url, headers, body, stream)
+        except BaseException:
+            _sem.release()
+            raise
+        if _res._raw is None:
+            _sem.release()
+        else:
+            _res._on_close = _sem.release
+
+        return _res
+
+    def _request(self, method, url, headers, body, stream):
+        _headers = dict(headers) if headers is not None else dict()
+        _headers.setdefault('Connection', 'keep-alive')
+
+        for _i in range(MAX_REDIRECTS + 1):
+            _key, _conn, _res = self._send(method, url, _headers, body)
+
+            if _res.status in (301, 302, 303, 307, 308) and _res.getheader('Location'):
+                # urlopenと同様にリダイレクトを追いかける
+                self._finish(_key, _conn, _res)
+                url = urllib.parse.urljoin(url, _res.getheader('Location'))
+                if _res.status == 303:
+                    method, body = 'GET', None
+                continue
+
+            if _res.status >= 400 or not stream:
+                _data = self._finish(_key, _conn, _res)
+                if _res.status >= 400:
+                    raise urllib.error.HTTPError(url, _res.status, _res.reason, _res.headers, io.BytesIO(_data))
+                return Response(url, _res.status, _res.reason, _res.headers, data=_data)
+
+            def _release(reusable, key=_key, conn=_conn, res=_res):
+                if reusable and not res.will_close:
+                    self._putConnection(key, conn)
+                else:
+                    conn.close()
+
+            return Response(url, _res.status, _res.reason, _res.headers, raw=_res, release=_release)
+
+        raise urllib.error.URLError('too many redirects. url: {}'.format(url))
+
+    # bodyを読み切って接続をプールに戻す
+    def _finish(self, key, conn, res):
+        try:
+            _data = res.read()
+        except (OSError, http.client.HTTPException) as err:
+            conn.close()
+            raise urllib.error.URLError(err)
+
+        if res.will_close:
+            conn.close()
+        else:
+            self._putConnection(key, conn)
+
+        return _data
+
+
+# 全てのAPI呼び出しで共有するプール
+POOL = ConnectionPool()
+
+
+# 401の時に新しいトークンを取ってくる関数（SA.getCachedTokenが登録する）
+_TOKEN_REFRESHER = None
+_TOKEN_LOCK = threading.Lock()
+# 期限切れになったトークン -> 取り直した(APIキー, トークン)
+_RENEWED_TOKENS = dict()
+
+
+'''
+    トークンの自動更新を登録する
+
+    func : func(api_key, token) -> (新しいapi_key, 新しいtoken) または None
+    登録すると、X-Soracom-Tokenを付けたリクエストが401になった時にfuncでトークンを取り直して1回だけ再送する。
+    以降、古いトークンで呼ばれたリクエストは新しいトークンに差し替えて送る。
+
+'''
+def setTokenRefresher(func):
+    global _TOKEN_REFRESHER
+    with _TOKEN_LOCK:
+        _TOKEN_REFRESHER = func
+        _RENEWED_TOKENS.clear()
+
+
+'''
+    トークンを取り直していれば、最新の(APIキー, トークン)を返す
+
+'''
+def renewedCredentials(api_key, token):
+    with _TOKEN_LOCK:
+        while token in _RENEWED_TOKENS:
+            api_key, token = _RENEWED_TOKENS[token]
+
+    return api_key, token
+
+
+def _withCredentials(headers, api_key, token):
+    _headers = dict(headers)
+    _headers['X-Soracom-API-Key'] = api_key
+    _headers['X-Soracom-Token'] = token
+    return _headers
+
+
+# 401になったトークンを取り直す。複数スレッドが同時に401を受けても取り直すのは1回だけ。
+def _refreshToken(headers):
+    _key = headers.get('X-Soracom-API-Key')
+    _token = headers.get('X-Soracom-Token')
+    with _TOKEN_LOCK:
+        if _token not in _RENEWED_TOKENS:
+            LOGGER.info('token expired. refreshing.')
+            _new = _TOKEN_REFRESHER(_key, _token)
+            if _new is None:
+                return None
+            _RENEWED_TOKENS[_token] = tuple(_new)
+
+        return _withCredentials(headers, *_RENEWED_TOKENS[_token])
+
+
+# 全てのAPI呼び出しで共有するレート制限（configureRateLimitで設定するまでは制限なし。429への対応は常に行う）
+RATE_LIMITER = SR.RateLimiter()
+
+
+'''
+    共有プールでHTTPリクエストを送る
+    引数はConnectionPool.requestと同じ
+
+        endpoint : メトリクスとレート制限のendpoint名。省略時はURLから作る（SM.endpointName）
+
+    送る前にRATE_LIMITERで順番を待つ。429（Too Many Requests）の時はRetry-Afterの間そのendpointを止めて、
+    SR.MAX_THROTTLE_RETRIES回まで送り直す（その間は呼び出し側にはエラーにならない）。
+    レスポンスヘッダーを受け取るまでの時間とステータスをSMに記録する。
+
+'''
+def request(method, url, headers=None, body=None, stream=False, endpoint=None):
+    _ep = endpoint if endpoint is not None else SM.endpointName(method, url)
+    _i = 0
+    while True:
+        RATE_LIMITER.acquire(_ep)
+        _st = time.perf_counter()
+        try:
+            _res = _request(method, url, headers, body, stream, _ep)
+        except urllib.error.HTTPError as err:
+            SM.observeRequest(_ep, time.perf_counter() - _st, err.code)
+            if err.code != 429 or _i >= SR.MAX_THROTTLE_RETRIES:
+                raise
+            # Retry-Afterの間は同じendpointへの送信を全スレッドで止め、さらにスレッドごとにずらして送り直す
+            _wait = SR.retryAfter(err.headers, _i)
+            LOGGER.info('throttled. retry after %.1f sec. %s', _wait, _ep)
+            RATE_LIMITER.pause(_ep, _wait)
+            SM.inc('soracom_retries_total', endpoint=_ep, reason='throttled')
+            time.sleep(SR.backoff(_i))
+            _i += 1
+            continue
+        except urllib.error.URLError:
+            SM.observeRequest(_ep, time.perf_counter() - _st, 'error')
+            raise
+        SM.observeRequest(_ep, time.perf_counter() - _st, _res.status)
+
+        return _res
+
+
+# 401の時はトークンを取り直して1回だけ送り直す
+def _request(method, url, headers, body, stream, endpoint):
+    if _TOKEN_REFRESHER is None or headers is None or 'X-Soracom-Token' not in headers:
+        return POOL.request(method, url, headers=headers, body=body, stream=stream)
+
+    _headers = _withCredentials(headers, *renewedCredentials(headers.get('X-Soracom-API-Key'), headers['X-Soracom-Token']))
+    try:
+        return POOL.request(method, url, headers=_headers, body=body, stream=stream)
+    except urllib.error.HTTPError as err:
+        if err.code != 401:
+            raise
+        _headers = _refreshToken(_headers)
+        if _headers is None:
+            raise
+        SM.inc('soracom_retries_total', endpoint=endpoint, reason='unauthorized')
+
+    return POOL.request(method, url, headers=_headers, body=body, stream=stream)
+
+
+'''
+    共有プールの設定を変更する
+
+    maxsize : ホストごとに保持するアイドル接続の上限（同時実行数に合わせる）
+    max_inflight : 全スレッド合計で同時に処理中のリクエスト数の上限（0で無制限）
+
+'''
+def configurePool(maxsize=None, timeout=None, context=None, max_inflight=None):
+    if maxsize is not None:
+        POOL.maxsize = maxsize
+    if max_inflight is not None:
+        POOL.setMaxInFlight(max_inflight)
+    if timeout is not None:
+        POOL.timeout = timeout
+    if context is not None:
+        POOL.context = context
+        POOL.clear()
+
+    return POOL
+
+
+'''
+    共有のレート制限を設定する
+
+    rate : 1秒あたりのリクエスト数。0またはNoneで、そのパターンの制限を外す
+    burst : まとめて送れる数。省略時はrate
+    pattern : 対象のendpoint（fnmatchのパターン）。省略時はSORACOM APIの全endpoint（SR.API_PATTERN）
+
+'''
+def configureRateLimit(rate, burst=None, pattern=SR.API_PATTERN):
+    RATE_LIMITER.configure(pattern, rate, burst)
+
+    return RATE_LIMITER
@@ -0,0 +1,221 @@
+'''
+    ジョブの記録（ジャーナル）
+
+    エクスポートする時刻ごとに、exportId・進捗・ダウンロードしたファイルをSQLiteに記録する。
+    処理が途中で止まっても、再実行（--resume）の時にエクスポート済み・ダウンロード済みの分を飛ばして、
+    未完了のエクスポートの進捗だけを確認すればよい（remainingFramesを無駄に使わない）。
+
+    状態：   planned    エクスポート予定
+            exported   エクスポートを依頼した（exportIdあり、進捗待ち）
+            completed  エクスポート完了（ダウンロード待ち）
+            failed     エクスポートできなかった（再実行時にもう一度依頼する）
+            downloaded ダウンロード済み
+
+    watchモードでは、デバイスごとにどのイベントまで処理したか（イベントのstartTime）も記録する（cursor）。
+
+'''
+import os
+import time
+
+from logging import getLogger
+
+import LogUtils as LU
+import soracom_sqlite as SQ
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
+
+# 作業ディレクトリに置くジャーナルのファイル名
+JOURNAL_FILE_NAME = '.soracam_journal.sqlite3'
+
+PLANNED = 'planned'
+EXPORTED = 'exported'
+COMPLETED = 'completed'
+FAILED = 'failed'
+DOWNLOADED = 'downloaded'
+
+# 再実行時にエクスポートを依頼し直す状態
+EXPORT_STATUSES = frozenset([PLANNED, FAILED])
+# 再実行時に進捗を確認する状態
+PENDING_STATUSES = frozenset([EXPORTED, COMPLETED])
+
+
+'''
+    ジャーナル
+
+        path : SQLiteのファイル
+
+    複数スレッドから使ってよい（SQ.SQLiteStore）。
+
+'''
+class Journal(SQ.SQLiteStore):
+    SCHEMA = (
+        '''
+        CREATE TABLE IF NOT EXISTS frames (
+            device_id TEXT NOT NULL,
+            time INTEGER NOT NULL,
+            export_id TEXT,
+            status TEXT NOT NULL,
+            file TEXT,
+            updated_at REAL,
+            PRIMARY KEY (device_id, time)
+        )''',
+        'CREATE INDEX IF NOT EXISTS frames_export_id ON frames (export_id)',
+        'CREATE INDEX IF NOT EXISTS frames_file ON frames (file)',
+        '''
+        CREATE TABLE IF NOT EXISTS cursors (
+            device_id TEXT NOT NULL PRIMARY KEY,
+            start_time INTEGER NOT NULL,
+            updated_at REAL
+        )''',
+    )
+
+    def __init__(self, path):
+        self.path = path
+        super().__init__(path)
+
+    '''
+        エクスポートする時刻を記録する（記録済みの時刻はそのまま）
+
+    '''
+    def plan(self, device_id, times):
+        _now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO frames (device_id, time, status, updated_at) VALUES (?, ?, ?, ?)',
+                [(device_id, int(_t), PLANNED, _now) for _t in times])
+            self._conn.commit()
+
+    '''
+        時刻ごとの記録
+
+        戻り値 : time -> (export_id, status, file)
+
+    '''
+    def frames(self, device_id, times=None):
+        if times is None:
+            with self._lock:
+                _rows = self._conn.execute(
+                    'SELECT time, export_id, status, file FROM frames WHERE device_id = ?', (device_id,)).fetchall()
+            return {_r[0]: _r[1:] for _r in _rows}
+
+        _ts = set(int(_t) for _t in times)
+        if len(_ts) == 0:
+            return dict()
+        # 主キー（device_id, time）の範囲で絞り込む
+        with self._lock:
+            _rows = self._conn.execute(
+                'SELECT time, export_id, status, file FROM frames WHERE device_id = ? AND time BETWEEN ? AND ?',
+                (device_id, min(_ts), max(_ts))).fetchall()
+
+        return {_r[0]: _r[1:] for _r in _rows if _r[0] in _ts}
+
+    '''
+        エクスポートを依頼した
+
+        exports : (time, export_id) のリスト
+
+    '''
+    def setExported(self, device_id, exports):
+        _now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE frames SET export_id = ?, status = ?, file = NULL, updated_at = ? WHERE device_id = ? AND time = ?',
+                [(_eid, EXPORTED, _now, device_id, int(_t)) for _t, _eid in exports])
+            self._conn.commit()
+
+    '''
+        エクスポートの進捗を記録する
+
+        entries : listSoraCamExportImagesが返す進捗（SRC.ExportStatus）のリスト。completed / 失敗系の状態だけ反映する。
+        ダウンロード済みの記録は戻さない。
+
+    '''
+    def setStatuses(self, entries):
+        _now = time.time()
+        _rows = list()
+        for _d in entries:
+            if _d.export_id is None:
+                continue
+            if _d.status == 'completed':
+                _rows.append((COMPLETED, _now, _d.export_id))
+            elif _d.status in ('failed', 'limitExceeded', 'expired'):
+                _rows.append((FAILED, _now, _d.export_id))
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE frames SET status = ?, updated_at = ? WHERE export_id = ? AND status != \'{}\''.format(DOWNLOADED), _rows)
+            self._conn.commit()
+
+    '''
+        ダウンロードしたファイルを記録する
+
+    '''
+    def setDownloaded(self, export_id, file):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE frames SET status = ?, file = ?, updated_at = ? WHERE export_id = ?',
+                (DOWNLOADED, file, time.time(), export_id))
+            self._conn.commit()
+
+    '''
+        ダウンロードしたファイルのパスを付け替える（後処理でwebpにした時など）
+
+    '''
+    def setFile(self, file, new_file):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE frames SET file = ?, updated_at = ? WHERE file = ?', (new_file, time.time(), file))
+            self._conn.commit()
+
+    '''
+        状態ごとの件数
+
+    '''
+    def counts(self, device_id=None):
+        with self._lock:
+            if device_id is None:
+                _rows = self._conn.execute('SELECT status, COUNT(*) FROM frames GROUP BY status').fetchall()
+            else:
+                _rows = self._conn.execute(
+                    'SELECT status, COUNT(*) FROM frames WHERE device_id = ? GROUP BY status', (device_id,)).fetchall()
+
+        return dict(_rows)
+
+    '''
+        watchモードで次にイベントを取得する開始時刻（unixtime 13桁）。記録が無い時はNone
+
+    '''
+    def cursor(self, device_id):
+        with self._lock:
+            _row = self._conn.execute('SELECT start_time FROM cursors WHERE device_id = ?', (device_id,)).fetchone()
+
+        return _row[0] if _row is not None else None
+
+    def setCursor(self, device_id, start_time):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO cursors (device_id, start_time, updated_at) VALUES (?, ?, ?)',
+                (device_id, int(start_time), time.time()))
+            self._conn.commit()
+
+
+'''
+    作業ディレクトリのジャーナルを開く
+
+        reset : Trueの時は前回までの記録を消してから開く（--resumeを指定しない時）
+
+'''
+def openJournal(path, reset=False):
+    _fp = os.path.join(path, JOURNAL_FILE_NAME)
+    if reset:
+        for _f in (_fp, _fp + '-wal', _fp + '-shm'):
+            if os.path.exists(_f):
+                os.remove(_f)
+
+    return Journal(_fp)
@@ -0,0 +1,207 @@
+'''
+    実行時の計測（メトリクス）
+
+    SORACOM APIの呼び出しごとのレイテンシ（ヒストグラム）、HTTPステータスの件数、リトライ回数、
+    ダウンロードしたバイト数、エクスポートした・失敗した・飛ばしたフレーム数などを集計し、
+    終了時にJSONまたはPrometheusのテキスト形式で書き出す。
+
+    soracom_http.requestを通るリクエストは自動で計測される（endpointはURLのパスのidを{id}に置き換えたもの）。
+
+'''
+import os
+import re
+import json
+import threading
+
+from logging import getLogger
+
+import LogUtils as LU
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
+
+# レイテンシのヒストグラムの区切り（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRICS_FORMATS = ('json', 'prometheus')
+
+_HELP = {
+    'soracom_request_duration_seconds': 'SORACOM API request latency (until response headers).',
+    'soracom_requests_total': 'SORACOM API requests by endpoint and HTTP status code.',
+    'soracom_retries_total': 'Requests sent again by endpoint and reason.',
+    'soracom_downloaded_bytes_total': 'Bytes of downloaded images.',
+    'soracom_export_completion_seconds': 'Time from waiting for an image export until it was seen completed.',
+    'soracom_export_cache_total': 'Export cache lookups by result (hit / miss).',
+}
+
+# パスの中のid（数字を含む6文字以上の要素）
+_ID_SEGMENT = re.compile(r'^(?=[^/]*\d)[^/]{6,}$')
+
+
+'''
+    ヒストグラム（Prometheusと同じく、各区切り以下の件数を持つ）
+
+'''
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # 最後は+Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        _i = 0
+        while _i < len(self.buckets) and value > self.buckets[_i]:
+            _i += 1
+        self.counts[_i] += 1
+        self.sum += value
+        self.count += 1
+
+    '''
+        区切りごとの累積件数 [(le, count), ...]
+
+    '''
+    def cumulative(self):
+        _rl = list()
+        _n = 0
+        for _le, _c in zip(list(self.buckets) + ['+Inf'], self.counts):
+            _n += _c
+            _rl.append((_le, _n))
+
+        return _rl
+
+
+'''
+    カウンターとヒストグラムの入れ物
+
+    名前ごとに、ラベル（dict）の組み合わせごとの値を持つ。複数スレッドから使ってよい。
+
+'''
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict()   # name -> {labels(tuple) -> value}
+        self._histograms = dict() # name -> {labels(tuple) -> Histogram}
+
+    def inc(self, name, value=1, **labels):
+        _key = tuple(sorted(labels.items()))
+        with self._lock:
+            _c = self._counters.setdefault(name, dict())
+            _c[_key] = _c.get(_key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        _key = tuple(sorted(labels.items()))
+        with self._lock:
+            _h = self._histograms.setdefault(name, dict())
+            if _key not in _h:
+                _h[_key] = Histogram(buckets)
+            _h[_key].observe(value)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def toDict(self):
+        _d = dict()
+        with self._lock:
+            _d['counters'] = {_n: [{'labels': dict(_k), 'value': _v} for _k, _v in sorted(_c.items())]
+                              for _n, _c in sorted(self._counters.items())}
+            _d['histograms'] = {_n: [{'labels': dict(_k),
+                                      'buckets': {str(_le): _c for _le, _c in _hs.cumulative()},
+                                      'sum': _hs.sum, 'count': _hs.count} for _k, _hs in sorted(_h.items())]
+                                for _n, _h in sorted(self._histograms.items())}
+
+        return _d
+
+    def toPrometheus(self):
+        _rl = list()
+        _d = self.toDict()
+        for _n, _l in _d['counters'].items():
+            if _n in _HELP:
+                _rl.append('# HELP {} {}'.format(_n, _HELP[_n]))
+            _rl.append('# TYPE {} counter'.format(_n))
+            for _e in _l:
+                _rl.append('{}{} {}'.format(_n, _labels(_e['labels']), _e['value']))
+        for _n, _l in _d['histograms'].items():
+            if _n in _HELP:
+                _rl.append('# HELP {} {}'.format(_n, _HELP[_n]))
+            _rl.append('# TYPE {} histogram'.format(_n))
+            for _e in _l:
+                for _le, _c in _e['buckets'].items():
+                    _rl.append('{}_bucket{} {}'.format(_n, _labels(dict(_e['labels'], le=_le)), _c))
+                _rl.append('{}_sum{} {}'.format(_n, _labels(_e['labels']), _e['sum']))
+                _rl.append('{}_count{} {}'.format(_n, _labels(_e['labels']), _e['count']))
+
+        return '\n'.join(_rl) + '\n'
+
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ''
+    _l = ['{}="{}"'.format(_k, str(_v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+          for _k, _v in labels.items()]
+
+    return '{' + ','.join(_l) + '}'
+
+
+REGISTRY = Registry()
+
+
+def inc(name, value=1, **labels):
+    REGISTRY.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    REGISTRY.observe(name, value, **labels)
+
+
+'''
+    URLからendpoint名を作る（例 'GET /v1/sora_cam/devices/{id}/exports/usage'）
+
+'''
+def endpointName(method, url):
+    _path = url.split('?')[0]
+    if '://' in _path:
+        _path = '/' + _path.split('://', 1)[1].partition('/')[2]
+    _path = '/'.join(['{id}' if _ID_SEGMENT.match(_s) else _s for _s in _path.split('/')])
+
+    return '{} {}'.format(method, _path)
+
+
+'''
+    APIリクエスト1件を記録する
+
+        status : HTTPステータス。接続エラーの時は'error'
+
+'''
+def observeRequest(endpoint, seconds, status):
+    REGISTRY.observe('soracom_request_duration_seconds', seconds, endpoint=endpoint)
+    REGISTRY.inc('soracom_requests_total', endpoint=endpoint, code=str(status))
+
+
+'''
+    集計をファイルに書き出す
+
+        fmt : 'json' / 'prometheus'
+
+'''
+def dump(path, fmt='json'):
+    if fmt not in METRICS_FORMATS:
+        raise ValueError('unknown format {}'.format(fmt))
+
+    if fmt == 'json':
+        _text = json.dumps(REGISTRY.toDict(), ensure_ascii=False, indent=2)
+    else:
+        _text = REGISTRY.toPrometheus()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(_text)
+    LOGGER.info('metrics : {}'.format(path))
+
+    return None
@@ -0,0 +1,349 @@
+'''
+    静止画をエクスポートする時刻の計画
+
+    モーション検知イベントの録画区間は重なったり、隙間なく続いたりすることがある。
+    イベントごとに時刻を割り当てると同じ瞬間を何度もエクスポートしてしまう（remainingFramesとAPI呼び出しの無駄）ので、
+    区間を和集合にまとめてから、インターバルごとの重複のない時刻を作る。
+
+    時刻はすべてunixtime（13桁、ミリ秒）。
+    時刻の並びは array('q')（8バイト整数の配列）で返す。何日分をサブ秒間隔で計画してもlistのintより小さく、
+    numpyがあれば全区間の時刻をまとめて計算する。datetimeにするのはログを出す時だけ（SU.LazyDateTime）。
+
+'''
+import os
+import bisect
+from array import array
+
+from logging import getLogger
+
+import LogUtils as LU
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+'''
+    開始時刻順に並んだ区間を、重なり・隙間なく続くものをまとめながら1つずつ返すジェネレーター
+
+        intervals : (開始, 終了) のiterable。開始時刻の昇順であること（listSoraCamDeviceEventsForDeviceのsort=asc）
+        gap : この間隔（ミリ秒）以下の隙間もまとめる。0の時は重なるか接する区間だけ
+
+    次の区間がまとめられないと分かった時点で、それまでの区間を返す（全イベントの取得を待たない）。
+
+'''
+def iterMergedIntervals(intervals, gap=0):
+    _cur = None
+    for _st, _ed in intervals:
+        _st, _ed = int(_st), int(_ed)
+        if _ed < _st:
+            _st, _ed = _ed, _st
+        if _cur is None:
+            _cur = [_st, _ed]
+        elif _st <= _cur[1] + gap:
+            if _st < _cur[0]:
+                # 昇順でない区間が来た
+                LOGGER.warning('interval is not sorted. {} < {}'.format(_st, _cur[0]))
+                _cur[0] = _st
+            _cur[1] = max(_cur[1], _ed)
+        else:
+            yield _cur[0], _cur[1]
+            _cur = [_st, _ed]
+
+    if _cur is not None:
+        yield _cur[0], _cur[1]
+
+
+'''
+    区間の和集合（並び順は問わない）
+
+    戻り値 : 重なりのない (開始, 終了) のリスト（開始時刻の昇順）
+
+'''
+def mergeIntervals(intervals, gap=0):
+    return list(iterMergedIntervals(sorted((int(_st), int(_ed)) if _st <= _ed else (int(_ed), int(_st)) for _st, _ed in intervals), gap))
+
+
+'''
+    時刻の並びをarray('q')にする（array('q')はそのまま返す）
+
+'''
+def asTimes(times):
+    if isinstance(times, array) and times.typecode == 'q':
+        return times
+    if np is not None and isinstance(times, np.ndarray):
+        _rl = array('q')
+        _rl.frombytes(times.astype(np.int64).tobytes())
+        return _rl
+
+    return array('q', (int(_t) for _t in times))
+
+
+'''
+    複数の区間の時刻をまとめて作る
+
+        windows : 重なりのない (開始, 終了) のリスト（開始時刻の昇順。mergeIntervalsの戻り値）
+        interval : 間隔（ミリ秒）
+
+    戻り値 : 区間ごとに、開始からinterval刻みの時刻と終了時刻を並べたarray('q')（昇順、重複なし）
+             区間の長さがinterval以下の時は開始と終了だけ
+
+'''
+def gridTimes(windows, interval):
+    _windows = [(int(_st), int(_ed)) for _st, _ed in windows]
+    _it = int(interval)
+    if np is not None and len(_windows) > 0:
+        return asTimes(_gridTimesNumpy(_windows, _it))
+
+    _rl = array('q')
+    for _st, _ed in _windows:
+        if _it <= 0 or _ed - _st <= _it:
+            _rl.append(_st)
+            if _ed != _st:
+                _rl.append(_ed)
+            continue
+        _rl.extend(range(_st, _ed + 1, _it))
+        # 終了時刻がグリッドに乗らない時は最後に足す
+        if _rl[-1] != _ed:
+            _rl.append(_ed)
+
+    return _rl
+
+
+# gridTimesのnumpy版。区間ごとのループを使わずに全区間の時刻を1回で並べる
+def _gridTimesNumpy(windows, interval):
+    _w = np.asarray(windows, dtype=np.int64).reshape(-1, 2)
+    _st, _ed = _w[:, 0], _w[:, 1]
+    _span = _ed - _st
+    # 区間の長さがinterval以下の時は、開始と終了だけになるように刻みを区間の長さにする
+    _step = np.full_like(_span, interval) if interval > 0 else np.maximum(_span, 1)
+    _step = np.where(_span <= _step, np.maximum(_span, 1), _step)
+    _n = _span // _step + 1                 # グリッドに乗る時刻の数
+    _tail = (_span % _step) != 0            # 終了時刻を足す区間
+    _cnt = _n + _tail
+    _off = np.cumsum(_cnt) - _cnt           # 区間ごとの先頭の位置
+
+    _k = np.arange(int(_n.sum()), dtype=np.int64) - np.repeat(np.cumsum(_n) - _n, _n)
+    _rl = np.empty(int(_cnt.sum()), dtype=np.int64)
+    _rl[np.repeat(_off, _n) + _k] = np.repeat(_st, _n) + _k * np.repeat(_step, _n)
+    _rl[(_off + _n)[_tail]] = _ed[_tail]
+
+    return _rl
+
+
+'''
+    昇順の時刻を区間ごとに切り分ける（二分探索なので時刻の数によらず区間の数だけの手間）
+
+        times : 時刻の並び（昇順）
+        windows : (開始, 終了) のリスト
+
+    戻り値 : 区間ごとの、区間内（両端を含む）の時刻のarray('q')のリスト
+
+'''
+def splitTimes(times, windows):
+    _tl = asTimes(times)
+    _rl = list()
+    for _st, _ed in windows:
+        _rl.append(_tl[bisect.bisect_left(_tl, int(_st)):bisect.bisect_right(_tl, int(_ed))])
+
+    return _rl
+
+
+'''
+    1つの区間の中で、インターバルごとにエクスポートする時刻
+
+        st, ed : 区間の開始と終了
+        interval : 間隔（ミリ秒）
+
+    戻り値 : 開始からinterval刻みの時刻と終了時刻のarray('q')（昇順、重複なし）
+
+'''
+def planTimes(st, ed, interval):
+    return gridTimes([(st, ed)], interval)
+
+
+'''
+    1つの区間の中で、unixtimeの0からのinterval刻み（時計に揃った時刻）と開始時刻
+
+    同じイベントを何度取得しても（区間が伸びても）同じ時刻になるので、ジャーナルで重複を飛ばせる（watchモード）。
+
+    戻り値 : array('q')（昇順、重複なし）
+
+'''
+def alignedTimes(st, ed, interval):
+    _st, _ed, _it = int(st), int(ed), int(interval)
+    if _it <= 0:
+        return planTimes(_st, _ed, 0)
+
+    _rl = array('q', [_st])
+    _rl.extend(range(_st - _st % _it + (_it if _st % _it else 0), _ed + 1, _it))
+    if len(_rl) > 1 and _rl[1] == _st:
+        del _rl[0]
+
+    return _rl
+
+
+# 残りフレーム数に収まらない時の計画の立て方
+QUOTA_STRATEGIES = ('widen', 'proportional')
+
+
+'''
+    planTimesが返す時刻の数（リストを作らずに数える）
+
+'''
+def countTimes(st, ed, interval):
+    _st, _ed, _it = int(st), int(ed), int(interval)
+    if _it <= 0 or _ed - _st <= _it:
+        return 1 if _st == _ed else 2
+
+    _q, _r = divmod(_ed - _st, _it)
+
+    return _q + 1 + (1 if _r != 0 else 0)
+
+
+'''
+    区間の中に等間隔にnum個の時刻を取る（開始と終了を含む）
+
+'''
+def spreadTimes(st, ed, num):
+    _st, _ed = int(st), int(ed)
+    if num <= 0:
+        return array('q')
+    if num == 1 or _st == _ed:
+        return array('q', [_st])
+
+    return array('q', sorted(set(_st + round(_k * (_ed - _st) / (num - 1)) for _k in range(num))))
+
+
+'''
+    全区間の時刻の合計がbudget以下になる、いちばん狭いインターバル（ミリ秒）
+
+    戻り値 : インターバル。区間ごとに開始・終了の2枚にしても収まらない時はNone
+
+'''
+def _widenInterval(windows, interval, budget):
+    def _total(it):
+        return sum(countTimes(_st, _ed, it) for _st, _ed in windows)
+
+    _lo = int(interval)
+    _hi = max([_ed - _st for _st, _ed in windows] + [_lo]) + 1
+    if _total(_hi) > budget:
+        return None
+
+    # _loは収まらない、_hiは収まる
+    while _hi - _lo > 1:
+        _mid = (_lo + _hi) // 2
+        if _total(_mid) <= budget:
+            _hi = _mid
+        else:
+            _lo = _mid
+
+    return _hi
+
+
+'''
+    budgetを区間の長さに比例して配る（各区間の上限はcaps）
+
+    戻り値 : 区間ごとの枚数のリスト
+
+'''
+def _allocateProportional(windows, caps, budget):
+    _weights = [max(_ed - _st, 1) for _st, _ed in windows]
+    _alloc = [0] * len(windows)
+    _left = budget
+    _open = [_i for _i in range(len(windows)) if caps[_i] > 0]
+    while _left > 0 and len(_open) > 0:
+        _w = sum(_weights[_i] for _i in _open)
+        _add = {_i: min(caps[_i] - _alloc[_i], int(_left * _weights[_i] / _w)) for _i in _open}
+        if sum(_add.values()) == 0:
+            # 端数は長い区間から1枚ずつ
+            for _i in sorted(_open, key=lambda _i: -_weights[_i]):
+                if _left == 0:
+                    break
+                _alloc[_i] += 1
+                _left -= 1
+        else:
+            for _i, _n in _add.items():
+                _alloc[_i] += _n
+                _left -= _n
+        _open = [_i for _i in _open if _alloc[_i] < caps[_i]]
+
+    return _alloc
+
+
+'''
+    区間ごとの時刻の計画を、残りフレーム数（budget）に収める
+
+        windows : 重なりのない (開始, 終了) のリスト（mergeIntervalsの戻り値）
+        interval : 希望するインターバル（ミリ秒）
+        budget : 使えるフレーム数（getSoraCamExportUsageのremainingFrames）
+        strategy : 収まらない時の立て方
+                   'widen'        全区間のインターバルを同じだけ広げる
+                   'proportional' インターバルはそのままの上限として、区間の長さに比例して枚数を配る
+
+    戻り値 : (計画, 報告)
+             計画 : (開始, 終了, 時刻のarray('q')) のリスト。時刻が0件の区間は含めない
+             報告 : dict（strategy, budget, demand, frames, interval, windows, dropped）
+
+'''
+def fitPlan(windows, interval, budget, strategy='widen'):
+    if strategy not in QUOTA_STRATEGIES:
+        raise ValueError('unknown strategy {}'.format(strategy))
+
+    _windows = list(windows)
+    _it = int(interval)
+    _budget = max(0, int(budget))
+    _caps = [countTimes(_st, _ed, _it) for _st, _ed in _windows]
+    _demand = sum(_caps)
+    _dropped = 0
+
+    if _demand <= _budget:
+        _plan = [(_st, _ed, _tl) for (_st, _ed), _tl in zip(_windows, splitTimes(gridTimes(_windows, _it), _windows))]
+    elif strategy == 'widen':
+        _wi = _widenInterval(_windows, _it, _budget)
+        if _wi is None:
+            # 開始・終了の2枚ずつでも収まらない時は、前の区間から収まるだけ
+            _plan = list()
+            _left = _budget
+            for _st, _ed in _windows:
+                _n = countTimes(_st, _ed, 0)
+                if _n > _left:
+                    break
+                _plan.append((_st, _ed, planTimes(_st, _ed, 0)))
+                _left -= _n
+            _dropped = len(_windows) - len(_plan)
+            _it = max([_ed - _st for _st, _ed in _windows] + [_it]) + 1
+        else:
+            _it = _wi
+            _plan = [(_st, _ed, _tl) for (_st, _ed), _tl in zip(_windows, splitTimes(gridTimes(_windows, _it), _windows))]
+    else:
+        _alloc = _allocateProportional(_windows, _caps, _budget)
+        _plan = list()
+        for (_st, _ed), _n, _cap in zip(_windows, _alloc, _caps):
+            if _n == 0:
+                _dropped += 1
+            elif _n == _cap:
+                _plan.append((_st, _ed, planTimes(_st, _ed, _it)))
+            else:
+                _plan.append((_st, _ed, spreadTimes(_st, _ed, _n)))
+
+    _report = dict()
+    _report['strategy'] = strategy if _demand > _budget else None
+    _report['budget'] = _budget
+    _report['demand'] = _demand
+    _report['frames'] = sum(len(_p[2]) for _p in _plan)
+    _report['interval'] = _it
+    _report['windows'] = len(_windows)
+    _report['dropped'] = _dropped
+
+    return _plan, _report
@@ -0,0 +1,206 @@
+'''
+    ダウンロードした静止画の後処理（縮小・再圧縮）
+
+    カメラの解像度のままの静止画を、maxwidthに縮小してJPEG / WebPで保存し直す。
+    縮小・圧縮はCPUを使うのでプロセスプールで並列に処理し、ダウンロードが済んだ静止画から順に投入する
+    （ダウンロードと後処理が重なって進む）。
+
+    Pillowが必要です（pip install pillow）。無い時は後処理をせずに警告を出す。
+
+'''
+import os
+import time
+import tempfile
+import threading
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from logging import getLogger
+
+import LogUtils as LU
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
+
+IMAGE_FORMATS = ('jpeg', 'webp')
+DEFAULT_QUALITY = 80
+
+_EXTENSIONS = {'jpeg': '.jpg', 'webp': '.webp'}
+
+
+'''
+    静止画を1枚縮小・再圧縮する（プロセスプールのワーカーで実行する）
+
+        path : 静止画のファイルパス
+        maxwidth : 横幅の最大値。0の時は縮小しない
+        fmt : 保存する形式（IMAGE_FORMATS）。webpの時は拡張子を付け替えて元のファイルを消す
+        quality : 圧縮の品質（1-100）
+
+        戻り値 : (保存したファイルパス, 元のサイズ, 後のサイズ)
+                 縮小も無く再圧縮で大きくなる時は元のファイルのまま
+
+'''
+def processFrame(path, maxwidth=0, fmt='jpeg', quality=DEFAULT_QUALITY):
+    _size = os.path.getsize(path)
+    _out = os.path.splitext(path)[0] + _EXTENSIONS[fmt]
+    _dir = os.path.dirname(path)
+
+    with Image.open(path) as _im:
+        _resize = maxwidth > 0 and _im.width > maxwidth
+        if _resize:
+            _im.thumbnail((maxwidth, _im.height * maxwidth // _im.width + 1), Image.LANCZOS)
+        if _im.mode not in ('RGB', 'L'):
+            _im = _im.convert('RGB')
+
+        # 同じディレクトリの一時ファイルに書き出してから付け替える
+        _fd, _tp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=_dir)
+        try:
+            with os.fdopen(_fd, 'wb') as f:
+                _im.save(f, fmt.upper(), quality=quality)
+            _new = os.path.getsize(_tp)
+            if not _resize and fmt == 'jpeg' and _new >= _size:
+                os.remove(_tp)
+                return path, _size, _size
+            os.replace(_tp, _out)
+        except BaseException:
+            if os.path.exists(_tp):
+                os.remove(_tp)
+            raise
+
+    if _out != path:
+        os.remove(path)
+
+    return _out, _size, _new
+
+
+'''
+    後処理をプロセスプールで並列に行う
+
+        maxwidth, fmt, quality : processFrameの引数
+        workers : プロセス数（省略時はCPUコア数）
+        on_processed : ファイルパスが変わった時（webpにした時）に (元のパス, 新しいパス) を受け取る関数（SJ.Journal.setFileなど）
+
+    使い方：
+        with PostProcessor(640) as _pp:
+            _pp.submit(downloaded_path)   # ダウンロードしたスレッドからすぐ戻る
+        _pp.stats()
+
+'''
+class PostProcessor:
+    def __init__(self, maxwidth=0, fmt='jpeg', quality=DEFAULT_QUALITY, workers=None, on_processed=None):
+        if fmt not in IMAGE_FORMATS:
+            raise ValueError('unknown format {}'.format(fmt))
+
+        self.maxwidth = maxwidth
+        self.fmt = fmt
+        self.quality = quality
+        self.on_processed = on_processed
+        # ダウンロード用のスレッドが動いている中でforkしないようにspawnで起動する
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self._lock = threading.Lock()
+        self._started = None
+        self._finished = None
+        self._frames = 0
+        self._failed = 0
+        self._bytes_in = 0
+        self._bytes_out = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    '''
+        静止画を1枚投入する（待たずに戻る）
+
+    '''
+    def submit(self, path):
+        with self._lock:
+            if self._started is None:
+                self._started = time.perf_counter()
+            _f = self._executor.submit(processFrame, path, self.maxwidth, self.fmt, self.quality)
+        # 終わっていればその場で呼ばれるのでロックの外で登録する
+        _f.add_done_callback(functools.partial(self._done, path))
+
+        return _f
+
+    def _done(self, path, future):
+        with self._lock:
+            self._finished = time.perf_counter()
+            try:
+                _fp, _in, _out = future.result()
+            except Exception as err:
+                self._failed += 1
+                LOGGER.error('postprocess failed. {}'.format(err))
+                return
+            self._frames += 1
+            self._bytes_in += _in
+            self._bytes_out += _out
+        if _fp != path and self.on_processed is not None:
+            self.on_processed(path, _fp)
+
+    '''
+        投入した静止画を全部処理し終わるまで待って、プロセスプールを閉じる
+
+    '''
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+        return self.stats()
+
+    '''
+        集計（frames, failed, bytes_in, bytes_out, saved, elapsed, fps）
+
+    '''
+    def stats(self):
+        with self._lock:
+            _el = 0.0
+            if self._started is not None and self._finished is not None:
+                _el = self._finished - self._started
+            _st = dict()
+            _st['frames'] = self._frames
+            _st['failed'] = self._failed
+            _st['bytes_in'] = self._bytes_in
+            _st['bytes_out'] = self._bytes_out
+            _st['saved'] = self._bytes_in - self._bytes_out
+            _st['elapsed'] = _el
+            _st['fps'] = self._frames / _el if _el > 0 else 0.0
+
+        return _st
+
+
+'''
+    PostProcessorを作る。Pillowが無い時は警告を出してNone
+
+'''
+def createPostProcessor(maxwidth=0, fmt='jpeg', quality=DEFAULT_QUALITY, workers=None, on_processed=None):
+    if Image is None:
+        LOGGER.warning('Pillow is not installed. postprocess is disabled. (pip install pillow)')
+        return None
+
+    return PostProcessor(maxwidth, fmt, quality, workers, on_processed)
+
+
+'''
+    後処理の集計をログに出す
+
+'''
+def logStats(stats):
+    LOGGER.info('postprocess : {} frames, failed {}, {} -> {} bytes (saved {} bytes, {:.1f}%), {:.1f} fps'.format(
+        stats['frames'], stats['failed'], stats['bytes_in'], stats['bytes_out'], stats['saved'],
+        100.0 * stats['saved'] / stats['bytes_in'] if stats['bytes_in'] > 0 else 0.0, stats['fps']))
+
+    return None
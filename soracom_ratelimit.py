@@ -0,0 +1,202 @@
+'''
+    クライアント側のレート制限（トークンバケット）
+
+    SORACOM APIには呼び出し回数の制限があり、超えると429（Too Many Requests）が返る。
+    エクスポートの依頼やダウンロードを並列に送る時は、ここで送る速さを抑え、
+    429が返った時はRetry-Afterの間そのendpointへの送信を止めてから送り直す（soracom_http.request）。
+
+    endpointはsoracom_metrics.endpointNameの名前（例 'POST /v1/sora_cam/devices/{id}/images/exports'）で、
+    fnmatchのパターンごとに別のバケットを設定できる。1つのリクエストは一致した全てのバケットを通る。
+
+    使い方：
+        SH.configureRateLimit(10)                                    # API全体で毎秒10件
+        SH.configureRateLimit(2, 5, 'POST */images/exports')         # エクスポートの依頼は毎秒2件（5件までまとめて可）
+
+'''
+import os
+import time
+import random
+import threading
+import fnmatch
+import email.utils
+
+from logging import getLogger
+
+import LogUtils as LU
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
+
+# SORACOM APIの全endpoint（ダウンロードURLは含まない）
+API_PATTERN = '* /v1/*'
+
+# 429の時に送り直す回数の上限
+MAX_THROTTLE_RETRIES = 8
+# Retry-Afterが無い時の待ち時間（sec。2倍ずつ増やす）
+DEFAULT_RETRY_AFTER = 1.0
+# 送り直す時に各スレッドが足す待ち時間の幅（sec。2倍ずつ増やす）。同時に429を受けたスレッドが一斉に送らないように
+BACKOFF_BASE = 0.25
+# Retry-Afterの上限（sec）
+MAX_RETRY_AFTER = 60.0
+
+
+'''
+    トークンバケット
+
+        rate : 1秒あたりに送れる数
+        burst : まとめて送れる数（バケットの大きさ）。省略時はrate（最低1）
+
+'''
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst else max(1.0, self.rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    '''
+        1件分のトークンを取る。足りない時は貯まるまで待つ
+
+        戻り値 : 待った時間（sec）
+
+    '''
+    def acquire(self):
+        _waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return _waited
+                _wait = (1.0 - self._tokens) / self.rate
+            time.sleep(_wait)
+            _waited += _wait
+
+    '''
+        トークンを空にして、seconds後から貯め直す（429を受けた時）
+
+    '''
+    def drain(self, seconds):
+        with self._lock:
+            self._tokens = 0.0
+            self._last = max(self._last, time.monotonic() + seconds)
+
+
+'''
+    endpointごとのトークンバケットと、429による一時停止
+
+'''
+class RateLimiter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = list()  # (パターン, TokenBucket) 設定順
+        self._paused = dict()   # endpoint -> この時刻（time.monotonic）まで送らない
+
+    '''
+        パターンに一致するendpointの速さを設定する
+
+        rate : 1秒あたりの数。Noneまたは0以下の時は、そのパターンの制限を外す
+
+    '''
+    def configure(self, pattern, rate, burst=None):
+        with self._lock:
+            self._buckets = [_b for _b in self._buckets if _b[0] != pattern]
+            if rate is not None and rate > 0:
+                self._buckets.append((pattern, TokenBucket(rate, burst)))
+
+    def clear(self):
+        with self._lock:
+            self._buckets = list()
+            self._paused.clear()
+
+    def _matching(self, endpoint):
+        with self._lock:
+            return [_b for _p, _b in self._buckets if fnmatch.fnmatchcase(endpoint, _p)]
+
+    '''
+        endpointへ1件送ってよくなるまで待つ
+
+        戻り値 : 待った時間（sec）
+
+    '''
+    def acquire(self, endpoint):
+        _waited = 0.0
+        while True:
+            with self._lock:
+                _wait = self._paused.get(endpoint, 0.0) - time.monotonic()
+            if _wait <= 0:
+                break
+            time.sleep(_wait)
+            _waited += _wait
+
+        for _b in self._matching(endpoint):
+            _waited += _b.acquire()
+
+        return _waited
+
+    '''
+        429を受けたendpointへの送信をseconds秒止める（他のスレッドも待たせる）
+
+    '''
+    def pause(self, endpoint, seconds):
+        _until = time.monotonic() + seconds
+        with self._lock:
+            self._paused[endpoint] = max(self._paused.get(endpoint, 0.0), _until)
+        for _b in self._matching(endpoint):
+            _b.drain(seconds)
+
+
+'''
+    429の時に待つ時間（sec）
+
+        headers : レスポンスヘッダー（Retry-After は秒数またはHTTP日付）
+        attempt : 何回目の送り直しか（0から）。Retry-Afterが無い時は DEFAULT_RETRY_AFTER * 2**attempt
+
+'''
+def retryAfter(headers, attempt=0):
+    _ra = headers.get('Retry-After') if headers is not None else None
+    _sec = None
+    if _ra is not None:
+        try:
+            _sec = float(_ra)
+        except ValueError:
+            try:
+                _sec = email.utils.parsedate_to_datetime(_ra).timestamp() - time.time()
+            except (TypeError, ValueError):
+                _sec = None
+    if _sec is None:
+        _sec = DEFAULT_RETRY_AFTER * (2 ** attempt) + random.uniform(0, DEFAULT_RETRY_AFTER)
+
+    return min(max(_sec, 0.0), MAX_RETRY_AFTER)
+
+
+'''
+    送り直す前に各スレッドが足す待ち時間（sec。0 - BACKOFF_BASE * 2**attempt の一様乱数）
+
+'''
+def backoff(attempt):
+    return random.uniform(0, min(BACKOFF_BASE * (2 ** attempt), MAX_RETRY_AFTER))
+
+
+'''
+    'パターン=毎秒の数[:まとめて送れる数]' を (パターン, rate, burst) にする（コマンドライン用）
+
+'''
+def parseRateSpec(spec):
+    _p, _sep, _r = spec.rpartition('=')
+    if len(_sep) == 0 or len(_p) == 0:
+        raise ValueError('rate limit must be PATTERN=RATE[:BURST]. {}'.format(spec))
+    _rate, _sep, _burst = _r.partition(':')
+
+    return _p, float(_rate), (float(_burst) if len(_burst) > 0 else None)
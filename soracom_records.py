@@ -0,0 +1,151 @@
+'''
+    APIの応答を小さなレコードにする
+
+    listSoraCamDeviceEventsForDevice のイベントと listSoraCamDeviceImageExports の進捗は、
+    JSONのままだと入れ子のdictで、使わない項目も全部メモリに残る（_ts['eventInfo']['atomEventV1']['startTime'] ...）。
+    ここで使う項目だけを __slots__ のクラスに取り出し、以後は属性で読む。
+    カメラの台数や日数が増えても、1件あたりのメモリと項目を読む時間が小さく済む。
+
+    文字列の項目（type, status など）は sys.intern して、同じ値を1つのオブジェクトで共有する。
+
+'''
+import sys, os
+
+from logging import getLogger
+
+import LogUtils as LU
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _int(value):
+    return int(value) if value is not None else None
+
+
+'''
+    イベント（atomEventV1）
+
+        device_id : device id
+        time : イベントの時刻（unixtime 13桁）
+        type : 'motion' など
+        recording_status : 'completed' / 'recording' など
+        start_time, end_time : 録画の開始・終了時刻（unixtime 13桁）。録画中はend_timeがNoneのことがある
+
+'''
+class Event:
+    __slots__ = ('device_id', 'time', 'type', 'recording_status', 'start_time', 'end_time')
+
+    def __init__(self, device_id, time, type, recording_status, start_time, end_time=None):
+        self.device_id = device_id
+        self.time = time
+        self.type = type
+        self.recording_status = recording_status
+        self.start_time = start_time
+        self.end_time = end_time
+
+    def __repr__(self):
+        return 'Event({!r}, {}, {!r}, {!r}, {}, {})'.format(self.device_id, self.time, self.type, self.recording_status,
+                                                           self.start_time, self.end_time)
+
+    '''
+        録画が完了したモーション検知イベントか
+
+    '''
+    def isCompletedMotion(self):
+        return self.type == 'motion' and self.recording_status == 'completed'
+
+
+'''
+    エクスポートの進捗
+
+        export_id : exportId
+        device_id : device id
+        time : エクスポートした時刻（unixtime 13桁）
+        status : 'initializing' / 'processing' / 'completed' / 'failed' など
+        url : ダウンロードURL（completedの時だけ）
+        expiry_time : URLの有効期限（unixtime 13桁）
+
+'''
+class ExportStatus:
+    __slots__ = ('export_id', 'device_id', 'time', 'status', 'url', 'expiry_time')
+
+    def __init__(self, export_id, device_id=None, time=None, status=None, url=None, expiry_time=None):
+        self.export_id = export_id
+        self.device_id = device_id
+        self.time = time
+        self.status = status
+        self.url = url
+        self.expiry_time = expiry_time
+
+    def __repr__(self):
+        return 'ExportStatus({!r}, {!r}, {}, {!r}, {!r}, {})'.format(self.export_id, self.device_id, self.time, self.status,
+                                                                     self.url, self.expiry_time)
+
+
+'''
+    イベント（APIの応答の1件のdict）をEventにする
+
+    戻り値 : Event。atomEventV1やstartTimeの無いイベントはNone
+
+'''
+def parseEvent(obj):
+    _ev = obj.get('eventInfo')
+    _ev = _ev.get('atomEventV1') if isinstance(_ev, dict) else None
+    if _ev is None or _ev.get('startTime') is None:
+        return None
+
+    return Event(_intern(obj.get('deviceId')), _int(obj.get('time')), _intern(_ev.get('type')), _intern(_ev.get('recordingStatus')),
+                 int(_ev['startTime']), _int(_ev.get('endTime')))
+
+
+'''
+    イベントのリストをEventのリストにする（変換できないイベントは飛ばす）
+
+'''
+def parseEvents(objs):
+    _rl = list()
+    for _o in objs:
+        _ev = parseEvent(_o)
+        if _ev is not None:
+            _rl.append(_ev)
+
+    return _rl
+
+
+'''
+    エクスポートの進捗（APIの応答の1件のdict）をExportStatusにする
+
+    戻り値 : ExportStatus。exportIdの無い時はNone
+
+'''
+def parseExportStatus(obj):
+    if obj.get('exportId') is None:
+        return None
+
+    return ExportStatus(obj['exportId'], _intern(obj.get('deviceId')), _int(obj.get('time')), _intern(obj.get('status')),
+                        obj.get('url'), _int(obj.get('expiryTime')))
+
+
+'''
+    進捗のリストをExportStatusのリストにする（exportIdの無いものは飛ばす）
+
+'''
+def parseExportStatuses(objs):
+    _rl = list()
+    for _o in objs:
+        _es = parseExportStatus(_o)
+        if _es is not None:
+            _rl.append(_es)
+
+    return _rl
@@ -0,0 +1,56 @@
+'''
+    SQLiteのファイルを1つ持つクラスの共通部分
+
+    ジャーナル（SJ.Journal）・静止画の保管庫の索引（SF.FrameStore）・エクスポート結果のキャッシュ（SC.ExportCache）で使う。
+    WALモードで開き、1つの接続を複数スレッドで共有する（書き込みはロックで直列化する）。
+
+'''
+import os
+import sqlite3
+import threading
+
+from logging import getLogger
+
+import LogUtils as LU
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
+
+
+'''
+    SQLiteのファイルを1つ持つクラス
+
+        db_path : SQLiteのファイル
+
+    SCHEMAのSQL（CREATE TABLE IF NOT EXISTS ...）を開いた時に実行する。
+    複数スレッドから使ってよい（self._lockを取ってからself._connを使う）。
+
+'''
+class SQLiteStore:
+    SCHEMA = ()
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            for _sql in self.SCHEMA:
+                self._conn.execute(_sql)
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
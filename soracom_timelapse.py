@@ -0,0 +1,184 @@
+'''
+    ダウンロードした静止画からタイムラプス動画を作る
+
+    静止画（JPEG、または後処理でWebPにしたもの）を撮影時刻の順にffmpegの標準入力へ流し込み（-f image2pipe）、maxwidthに縮小してエンコードする。
+    ファイルは1つずつ、DOWNLOAD_CHUNK_SIZEずつ読んで書くので、何千枚あってもメモリに載るのは数チャンク分だけ。
+
+    ffmpegが必要です（PATHが通っていること）。
+
+    引数：   dir : 静止画のディレクトリ
+            output : 出力する動画ファイル
+            fps : フレームレート。1秒間に静止画を何枚見るか。
+            maxwidth : 解像度（横幅）の最大値
+
+    （注記）
+    ソラコム公式「タイムラプス動画を作成する」
+    https://users.soracom.io/ja-jp/docs/soracom-cloud-camera-services/api-examples-creating-time-lapse-video/
+    を参考にしています。
+
+'''
+import sys, os
+import time
+import shutil
+import subprocess
+
+from logging import getLogger
+
+import argparse
+
+import LogUtils as LU
+import soracom_utils as SU
+
+SCRIPT_NAME = os.path.basename(__file__)
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
+
+# logging
+LOGGER = getLogger(os.path.basename(__file__))
+LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
+
+LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
+
+FFMPEG = 'ffmpeg'
+DEFAULT_FPS = 10
+DEFAULT_MAXWIDTH = 1280
+TIMELAPSE_FILE_NAME = 'timelapse.mp4'
+
+FRAME_EXTENSIONS = ('.jpg', '.jpeg', '.webp')
+# 拡張子 -> ffmpegのデコーダー（image2pipeは1つの動画に1つのデコーダーしか使えない）
+_DECODERS = {'.jpg': 'mjpeg', '.jpeg': 'mjpeg', '.webp': 'webp'}
+
+
+'''
+    ディレクトリの静止画を撮影順（ファイル名順）に並べる
+
+    export_sample.pyでダウンロードした静止画は、ファイル名の先頭が撮影時刻（export_sample.frameSeq）なので名前順が撮影順になる。
+
+'''
+def listFrames(path):
+    _fl = [_f for _f in os.listdir(path) if _f.lower().endswith(FRAME_EXTENSIONS) and not _f.startswith('.')]
+
+    return [os.path.join(path, _f) for _f in sorted(_fl)]
+
+
+'''
+    ffmpegのコマンドライン
+
+        fps : フレームレート
+        maxwidth : 横幅の最大値（小さい静止画は拡大しない）。0の時は縮小しない
+        decoder : 静止画のデコーダー（'mjpeg' / 'webp'）
+
+'''
+def ffmpegCommand(output, fps=DEFAULT_FPS, maxwidth=DEFAULT_MAXWIDTH, ffmpeg=FFMPEG, decoder='mjpeg'):
+    _cmd = [ffmpeg, '-y', '-loglevel', 'error',
+            '-f', 'image2pipe', '-framerate', str(fps), '-c:v', decoder, '-i', '-']
+    # yuv420pは縦横とも偶数である必要がある
+    if maxwidth > 0:
+        _cmd += ['-vf', "scale='trunc(min({},iw)/2)*2':-2".format(int(maxwidth))]
+    else:
+        _cmd += ['-vf', "scale='trunc(iw/2)*2':-2"]
+    _cmd += ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', output]
+
+    return _cmd
+
+
+'''
+    静止画からタイムラプス動画を作る
+
+        frames : 静止画のファイルパスのリスト（この順に並べる）
+        output : 出力する動画ファイル
+
+        戻り値 : 動画に入れた静止画の数。ffmpegが無い、または失敗した時はNone
+
+    JPEGとWebPが混ざっている時（後処理に失敗した静止画があるなど）は、多い方の形式だけを使う。
+
+'''
+def makeTimelapse(frames, output, fps=DEFAULT_FPS, maxwidth=DEFAULT_MAXWIDTH, ffmpeg=FFMPEG, chunk_size=SU.DOWNLOAD_CHUNK_SIZE):
+    if shutil.which(ffmpeg) is None:
+        LOGGER.error('ffmpeg not found. {}'.format(ffmpeg))
+        return None
+    if len(frames) == 0:
+        LOGGER.warning('no frames. {}'.format(output))
+        return None
+
+    _dl = [_DECODERS.get(os.path.splitext(_fp)[1].lower(), 'mjpeg') for _fp in frames]
+    _dec = max(set(_dl), key=_dl.count)
+    if _dl.count(_dec) < len(frames):
+        LOGGER.warning('mixed image formats. {} frames other than {} are skipped.'.format(len(frames) - _dl.count(_dec), _dec))
+        frames = [_fp for _fp, _d in zip(frames, _dl) if _d == _dec]
+
+    _cmd = ffmpegCommand(output, fps, maxwidth, ffmpeg, _dec)
+    LOGGER.debug(' '.join(_cmd))
+
+    _cnt = 0
+    _proc = subprocess.Popen(_cmd, stdin=subprocess.PIPE)
+    try:
+        for _fp in frames:
+            with open(_fp, 'rb') as f:
+                shutil.copyfileobj(f, _proc.stdin, chunk_size)
+            _cnt += 1
+    except BrokenPipeError:
+        LOGGER.error('ffmpeg stopped. {} frames written.'.format(_cnt))
+    except OSError as err:
+        LOGGER.error('timelapse failed. {}'.format(err))
+        _proc.kill()
+    finally:
+        # 標準入力を閉じるとffmpegが書き出しを終える
+        try:
+            _proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        _rc = _proc.wait()
+
+    if _rc != 0:
+        LOGGER.error('ffmpeg failed. returncode {}'.format(_rc))
+        return None
+
+    LOGGER.info('timelapse {} : {} frames, {} fps'.format(output, _cnt, fps))
+
+    return _cnt
+
+
+'''
+    ディレクトリの静止画からタイムラプス動画を作る
+
+        output : 出力する動画ファイル。省略時は path/timelapse.mp4
+
+'''
+def makeTimelapseFromDir(path, output=None, fps=DEFAULT_FPS, maxwidth=DEFAULT_MAXWIDTH, ffmpeg=FFMPEG):
+    if output is None:
+        output = os.path.join(path, TIMELAPSE_FILE_NAME)
+
+    return makeTimelapse(listFrames(path), output, fps, maxwidth, ffmpeg)
+
+
+'''
+	main
+
+'''
+if __name__ == "__main__":
+    LOGGER.info('script start')
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+            description='Create Time Lapse Video from downloaded images')
+    parser.add_argument('--dir', default='tmp',
+                        help='静止画のディレクトリ')
+    parser.add_argument('--output', default='',
+                        help='出力する動画ファイル（省略時は dir/{}）'.format(TIMELAPSE_FILE_NAME))
+    parser.add_argument('--fps', default=DEFAULT_FPS, type=int,
+                        help='フレームレート')
+    parser.add_argument('--maxwidth', default=DEFAULT_MAXWIDTH, type=int,
+                        help='解像度（横幅）の最大値')
+    parser.add_argument('--ffmpeg', default=FFMPEG,
+                        help='ffmpegのパス')
+
+    args = parser.parse_args()
+
+    dpath = os.path.join(os.getcwd(), args.dir)
+    _rt = makeTimelapseFromDir(dpath, args.output if len(args.output) > 0 else None, args.fps, args.maxwidth, args.ffmpeg)
+    if _rt is None:
+        sys.exit(1)
+
+    elapsed_time = time.time() - start_time
+    LOGGER.info('script end')
+    LOGGER.info('elapsed time : {} [sec]'.format(str(elapsed_time)))
@@ -4,10 +4,13 @@ from logging import getLogger, Formatter, FileHandler, StreamHandler, DEBUG, INF
 from datetime import datetime, timedelta
 import time
 import shutil
-import urllib
+import hashlib
+import urllib.error
 
 import LogUtils as LU
 import soracom_auth as SA
+import soracom_http as SH
+import soracom_metrics as SM
 
 SCRIPT_NAME = os.path.basename(__file__)
 SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__)) # スクリプトのあるディレクトリの絶対パス
@@ -18,6 +21,15 @@ LOG_FMT = "[%(name)s] %(asctime)s %(levelname)s %(lineno)s %(message)s"
 
 LOGGER = LU.setScreenLogger(LOGGER, LOG_FMT, 'debug') # develop
 
+# ダウンロード時に一度に読み書きするサイズ（byte）。画像の大きさに関係なくメモリ使用量はこのサイズで頭打ちになる。
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# ダウンロードが途中で切れた時に、続きから取り直す回数
+DOWNLOAD_MAX_RESUMES = 5
+# 続きから取り直す前に待つ時間（sec。2倍ずつ増やす）
+DOWNLOAD_RESUME_BACKOFF = 0.5
+# 作りかけのファイルの拡張子
+PART_SUFFIX = '.part'
+
 '''
     Unixtimeを取得するためのユーティリティー
     dt : datetime型
@@ -43,30 +55,186 @@ def getDateTimeFromUnixTime(ut):
 
     return _rt
 
+'''
+    ログ用。文字列にする時（実際にログを出す時）に初めてdatetimeに変換する
+    ut : int型 unixtime（13桁）
+
+    （例）LOGGER.debug('time %s', SU.LazyDateTime(extime))
+
+'''
+class LazyDateTime:
+    __slots__ = ('ut', 'fmt')
+
+    def __init__(self, ut, fmt='%Y-%m-%d %H:%M:%S'):
+        self.ut = ut
+        self.fmt = fmt
+
+    def __str__(self):
+        return getDateTimeFromUnixTime(self.ut).strftime(self.fmt)
+
 '''
     urlを指定して静止画をダウンロードする。
     https://note.nkmk.me/python-download-web-images/
 
     seq : ダウンロードしたイメージにsequence numberを振りたい時指定（イベント画像のダウンロード時）
+    chunk_size : 一度に読み書きするサイズ（byte）
+    checksum : 指定した時は、ダウンロードしたファイルのハッシュを確かめる。"アルゴリズム:16進"（例 "sha256:ab12..."）、または16進だけ（sha256）
+    max_resumes : 途中で切れた時に続きから取り直す回数
+
+    bodyはchunk_sizeずつ "ファイル名.part" に書き出し、途中で切れた（接続エラー、5xx）時は
+    受け取った分を残したままRangeリクエストで続きから取り直す（最初の応答にETag / Last-Modifiedがあれば If-Range を付ける）。
+    max_resumes回取り直しても切れる時や、処理が中断された時も ".part" は残すので、次に同じurlをダウンロードする時
+    （--resumeでの再実行など）はその大きさから続きを取得する。
+    大きさ（Content-Length / Content-Range）とchecksumが一致したらファイル名を付け替える。
+    一致しない時は ".part" を消して urllib.error.ContentTooShortError / URLError を送出する。
 
 '''
-def downloadImage(url, path, seq=''):
+def downloadImage(url, path, seq='', chunk_size=DOWNLOAD_CHUNK_SIZE, checksum=None, max_resumes=DOWNLOAD_MAX_RESUMES):
 
     # ファイル名
     _fn = url.split('?')[0] # パラメータを削除
     _fn = _fn.split('/')[-1] # urlからファイル名&パラメータを取得
-    if len(seq) > 0:
+    if len(str(seq)) > 0:
         _fn = str(seq) + '_' + _fn
-    _fp = path + '/' + _fn
-    with urllib.request.urlopen(url) as web_file:
-        with open(_fp, 'wb') as local_file:
-            local_file.write(web_file.read())
-
-    LOGGER.debug('write {}'.format(_fn))
+    _fp = os.path.join(path, _fn)
+
+    # 同じディレクトリに作りかけのファイルを作る（os.replaceでアトミックに付け替えるため）
+    # 前回の作りかけがあれば続きから取得する
+    _pp = _fp + PART_SUFFIX
+    _st = {'total': None, 'validator': None}
+    _i = 0
+    while True:
+        _size = os.path.getsize(_pp) if os.path.exists(_pp) else 0
+        try:
+            _downloadPart(url, _pp, _size, _st, chunk_size)
+            break
+        except urllib.error.HTTPError as err:
+            if err.code == 416 and _size > 0:
+                _m = re.match(r'bytes\s+\*/(\d+)', err.headers.get('Content-Range') or '')
+                _total = int(_m.group(1)) if _m is not None else _st['total']
+                if _size == _total:
+                    # 前回（前の実行）で最後まで受け取っていた
+                    _st['total'] = _total
+                    break
+                # 作りかけの方が大きい（別のファイルだった）ので最初から取り直す
+                os.remove(_pp)
+                if _i >= max_resumes:
+                    raise
+            elif err.code < 500 or _i >= max_resumes:
+                raise
+            _reason = 'code {}'.format(err.code)
+        except urllib.error.URLError as err:
+            if _i >= max_resumes:
+                raise
+            _reason = err.reason
+        _size = os.path.getsize(_pp) if os.path.exists(_pp) else 0
+        LOGGER.info('download interrupted (%s). resume from %d bytes. %s', _reason, _size, _fn)
+        SM.inc('soracom_retries_total', endpoint='download', reason='download_resumed')
+        time.sleep(DOWNLOAD_RESUME_BACKOFF * (2 ** _i))
+        _i += 1
+
+    # 大きさ・checksumが一致しない作りかけは、続きを取っても直らないので消す
+    _size = os.path.getsize(_pp)
+    if _st['total'] is not None and _size != _st['total']:
+        os.remove(_pp)
+        raise urllib.error.ContentTooShortError(
+            'retrieval incomplete: got only {} out of {} bytes'.format(_size, _st['total']), None)
+    if checksum is not None:
+        _alg, _sep, _hex = checksum.rpartition(':')
+        _hd = fileDigest(_pp, _alg or 'sha256', chunk_size)
+        if _hd != _hex.lower():
+            os.remove(_pp)
+            raise urllib.error.URLError('checksum mismatch: expected {}, got {}'.format(_hex, _hd))
+
+    os.replace(_pp, _fp)
+
+    LOGGER.debug('write %s (%d bytes)', _fn, _size)
 
     return _fp
 
 
+# Rangeリクエストで offset 以降を取得して part に書く。state に全体の大きさと If-Range に使う値を持つ
+def _downloadPart(url, part, offset, state, chunk_size):
+    _headers = None
+    if offset > 0:
+        _headers = {'Range': 'bytes={}-'.format(offset)}
+        if state['validator'] is not None:
+            _headers['If-Range'] = state['validator']
+
+    with SH.request('GET', url, headers=_headers, stream=True, endpoint='download') as web_file:
+        if web_file.status == 206:
+            _start, _total = _contentRange(web_file.getheader('Content-Range'))
+        else:
+            # Rangeを無視した（または変わっていた）時は最初から
+            _cl = web_file.getheader('Content-Length')
+            _start, _total = 0, (int(_cl) if _cl is not None else None)
+            state['validator'] = web_file.getheader('ETag') or web_file.getheader('Last-Modified')
+        if _total is not None:
+            state['total'] = _total
+
+        with open(part, 'r+b' if _start > 0 else 'wb') as local_file:
+            local_file.seek(_start)
+            local_file.truncate()
+            while True:
+                _chunk = web_file.read(chunk_size)
+                if not _chunk:
+                    break
+                local_file.write(_chunk)
+                SM.inc('soracom_downloaded_bytes_total', len(_chunk))
+            _size = local_file.tell()
+
+    # 接続が正常に閉じられても、足りない分は続きから取り直す
+    if state['total'] is not None and _size < state['total']:
+        raise urllib.error.URLError('retrieval incomplete: got only {} out of {} bytes'.format(_size, state['total']))
+
+    return _size
+
+
+# Content-Range "bytes 100-199/200" を (100, 200) にする（全体の大きさが "*" の時はNone）
+def _contentRange(value):
+    _m = re.match(r'bytes\s+(\d+)-\d+/(\d+|\*)', value or '')
+    if _m is None:
+        raise urllib.error.URLError('invalid Content-Range: {}'.format(value))
+
+    return int(_m.group(1)), (int(_m.group(2)) if _m.group(2) != '*' else None)
+
+
+'''
+    ファイルのハッシュ（16進）
+
+        algorithm : hashlibのアルゴリズム名（sha256, md5 など）
+
+'''
+def fileDigest(path, algorithm='sha256', chunk_size=DOWNLOAD_CHUNK_SIZE):
+    _h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            _chunk = f.read(chunk_size)
+            if not _chunk:
+                break
+            _h.update(_chunk)
+
+    return _h.hexdigest()
+
+
+'''
+    downloadImageのエラーをログに出してNoneを返す版（並列ダウンロード用）
+
+    戻り値 : ダウンロードしたファイルパス。失敗した時はNone
+
+'''
+def tryDownloadImage(url, path, seq='', chunk_size=DOWNLOAD_CHUNK_SIZE, checksum=None):
+    try:
+        return downloadImage(url, path, seq, chunk_size, checksum)
+    except urllib.error.HTTPError as err:
+        LOGGER.error('download failed. urllib.error.HTTPError. code {}. url: {}'.format(err.code, url.split('?')[0]))
+    except urllib.error.URLError as err:
+        LOGGER.error('download failed. urllib.error.URLError. reason {}. url: {}'.format(err.reason, url.split('?')[0]))
+    except OSError as err:
+        LOGGER.error('download failed. {}. url: {}'.format(err, url.split('?')[0]))
+
+    return None
+
 
 '''
     ディレクトリを空にする